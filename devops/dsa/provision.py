@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
 import configparser
+import contextlib
+import copy
 import datetime
 import logging
+import math
 import os
+import re
+import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import yaml
@@ -17,6 +25,196 @@ logger = logging.getLogger(__name__)
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 
+class PhaseTimer:
+    """
+    Record the duration, memory use, and number of mongo commands of
+    provisioning phases so that slow starts can be attributed.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []
+        self.mongoCommands = None
+
+    def count_mongo_commands(self):
+        """
+        Count mongo commands issued by clients created after this is called.
+        """
+        try:
+            import pymongo.monitoring
+        except ImportError:
+            return
+        timer = self
+
+        class CommandCounter(pymongo.monitoring.CommandListener):
+            def started(self, event):
+                timer.mongoCommands += 1
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        self.mongoCommands = 0
+        pymongo.monitoring.register(CommandCounter())
+
+    @staticmethod
+    def rss():
+        """
+        Get the resident memory of this process in bytes, or None if it is
+        unavailable.
+        """
+        try:
+            with open('/proc/self/statm') as fptr:
+                return int(fptr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except Exception:
+            return None
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        """
+        Time a phase of provisioning.
+
+        :param phase: the name of the phase.
+        """
+        start = time.time()
+        commands = self.mongoCommands
+        record = {'phase': phase, 'start': start - self.started, 'timestamp': start}
+        try:
+            yield record
+        finally:
+            record['duration'] = time.time() - start
+            rss = self.rss()
+            if rss is not None:
+                record['rss'] = rss
+            if commands is not None:
+                record['mongo_commands'] = self.mongoCommands - commands
+            self.spans.append(record)
+            logger.info('Phase %s took %5.3f s', phase, record['duration'])
+
+    def add_span(self, phase, start, end):
+        """
+        Record a phase that was timed externally, such as by another process.
+
+        :param phase: the name of the phase.
+        :param start: the epoch time when the phase started.
+        :param end: the epoch time when the phase ended.
+        """
+        self.spans.append({
+            'phase': phase, 'start': start - self.started, 'timestamp': start,
+            'duration': end - start})
+        logger.info('Phase %s took %5.3f s', phase, end - start)
+
+    def write_timeline(self, directory, run):
+        """
+        Combine the reports of all provisioning processes of the same run
+        (for instance, preprovisioning and main provisioning, which run as
+        different users) into a single timeline.
+
+        :param directory: the directory with the reports.
+        :param run: the run identifier shared by the processes.
+        """
+        import glob
+        import json
+
+        phases = []
+        for path in sorted(glob.glob(os.path.join(directory, 'provision_timing_*.json'))):
+            try:
+                with open(path) as fptr:
+                    report = json.load(fptr)
+            except (OSError, ValueError):
+                continue
+            if report.get('run') == run:
+                phases.extend(dict(span, portion=report['portion'])
+                              for span in report['phases'])
+        if not phases:
+            return
+        phases.sort(key=lambda span: span['timestamp'])
+        start = phases[0]['timestamp']
+        for span in phases:
+            span['start'] = span['timestamp'] - start
+        timeline = {
+            'run': run,
+            'duration': max(span['start'] + span['duration'] for span in phases),
+            'phases': phases,
+        }
+        path = os.path.join(directory, 'provision_timeline.json')
+        with open(path + '.tmp', 'w') as fptr:
+            json.dump(timeline, fptr, indent=2)
+        os.replace(path + '.tmp', path)
+        for span in phases:
+            logger.info('Timeline: %8.3f - %8.3f %s %s', span['start'],
+                        span['start'] + span['duration'], span['portion'], span['phase'])
+
+    def write_report(self, directory, portion):
+        """
+        Write the recorded phases as a json report and as a Prometheus text
+        format file.
+
+        :param directory: the directory for the reports.  If falsy or not an
+            existing directory, no report is written.
+        :param portion: the portion of provisioning that was run.
+        """
+        import json
+        import resource
+
+        if not directory or not os.path.isdir(directory) or not self.spans:
+            return
+        report = {
+            'portion': portion,
+            'started': datetime.datetime.fromtimestamp(
+                self.started, datetime.timezone.utc).isoformat(),
+            'duration': time.time() - self.started,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'versions': os.environ.get('DSA_VERSIONS') or None,
+            'run': os.environ.get('DSA_PROVISION_RUN') or None,
+            'phases': self.spans,
+        }
+        metrics = [
+            ('duration', 'dsa_provision_phase_seconds', 'Duration of a provisioning phase.'),
+            ('rss', 'dsa_provision_phase_rss_bytes',
+             'Resident memory at the end of a provisioning phase.'),
+            ('mongo_commands', 'dsa_provision_phase_mongo_commands',
+             'Mongo commands issued during a provisioning phase.'),
+        ]
+        # Prometheus series must be unique, so combine repeated phases
+        phases = {}
+        for span in self.spans:
+            combined = phases.setdefault(span['phase'], {})
+            for key in ('duration', 'mongo_commands'):
+                if key in span:
+                    combined[key] = combined.get(key, 0) + span[key]
+            if 'rss' in span:
+                combined['rss'] = max(combined.get('rss', 0), span['rss'])
+        lines = []
+        for key, name, desc in metrics:
+            lines.extend(['# HELP %s %s' % (name, desc), '# TYPE %s gauge' % name])
+            for phase, combined in phases.items():
+                if key in combined:
+                    lines.append('%s{portion="%s",phase="%s"} %s' % (
+                        name, portion, phase, combined[key]))
+        lines.extend([
+            '# HELP dsa_provision_seconds Total duration of provisioning.',
+            '# TYPE dsa_provision_seconds gauge',
+            'dsa_provision_seconds{portion="%s"} %s' % (portion, report['duration']),
+        ])
+        base = os.path.join(directory, 'provision_timing_%s' % portion)
+        try:
+            for path, data in [(base + '.json', json.dumps(report, indent=2)),
+                               (base + '.prom', '\n'.join(lines) + '\n')]:
+                with open(path + '.tmp', 'w') as fptr:
+                    fptr.write(data)
+                os.replace(path + '.tmp', path)
+            if report['run']:
+                self.write_timeline(directory, report['run'])
+        except OSError:
+            logger.warning('Could not write provisioning timing report to %s', directory)
+
+
+timer = PhaseTimer()
+
+
 def get_collection_folder(adminUser, collName, folderName):
     from girder.models.collection import Collection
     from girder.models.folder import Folder
@@ -34,385 +232,3956 @@ def get_collection_folder(adminUser, collName, folderName):
     return folder
 
 
-def get_sample_data(adminUser, collName='Sample Images', folderName='Images'):
+class _IteratorReader:
+    """
+    Present an iterator of byte chunks as a minimal readable file object so
+    that it can be streamed into an upload without a temporary file.
+    """
+
+    def __init__(self, iterator):
+        self._iterator = iterator
+        self._buffer = bytearray()
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer.extend(next(self._iterator))
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.bytesRead += len(data)
+        return data
+
+
+def get_download_cache(opts):
+    """
+    Get the shared download cache if one is configured.  A cache is used if
+    a cache directory, offline mode, or a mirror directory is specified.
+
+    :param opts: the argparse options.
+    :returns: a DownloadCache or None.
+    """
+    cacheDir = getattr(opts, 'download-cache', None) or os.environ.get('DSA_DOWNLOAD_CACHE')
+    offline = getattr(opts, 'offline', None)
+    if not cacheDir and not offline and not getattr(opts, 'download-mirror', None):
+        return None
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils'))
+    try:
+        from download_cache import DownloadCache
+    except ImportError:
+        logger.error('download_cache is unavailable.  Downloads will not be cached.')
+        return None
+    return DownloadCache(
+        cacheDir, getattr(opts, 'download-cache-size', None), offline,
+        getattr(opts, 'download-mirror', None))
+
+
+def ingest_sample_item(remote, remoteItem, folder, adminUser, cache=None):
+    """
+    Copy a remote item to a local folder if the local item has no files.
+    Without a cache, the file contents are streamed directly into the local
+    upload.
+
+    :param remote: a girder client connected to the remote server.
+    :param remoteItem: the remote item document.  If this has a 'files' key,
+        it is used rather than listing the remote files.
+    :param folder: the local folder document.
+    :param adminUser: a user to create and modify items.
+    :param cache: an optional DownloadCache.
+    :returns: the local item.
+    """
+    from girder.models.item import Item
+    from girder.models.upload import Upload
+
+    item = Item().findOne({'folderId': folder['_id'], 'name': remoteItem['name']})
+    if item and len(list(Item().childFiles(item, limit=1))):
+        return item
+    if not item:
+        item = Item().createItem(remoteItem['name'], creator=adminUser, folder=folder)
+    remoteFiles = remoteItem.get('files')
+    if remoteFiles is None:
+        remoteFiles = remote.listFile(remoteItem['_id'])
+    for remoteFile in remoteFiles:
+        logger.info('Downloading %s', remoteFile['name'])
+        start = time.time()
+        if cache is not None:
+            path = cache.fetch(remoteFile, lambda dest: remote.downloadFile(
+                remoteFile['_id'], dest))
+            with open(path, 'rb') as fptr:
+                reader = _IteratorReader(iter(lambda: fptr.read(1024 ** 2), b''))
+                Upload().uploadFromFile(
+                    reader, os.path.getsize(path), name=remoteItem['name'],
+                    parentType='item', parent=item, user=adminUser,
+                    mimeType=remoteFile.get('mimeType'))
+        else:
+            reader = _IteratorReader(remote.downloadFileAsIterator(remoteFile['_id']))
+            Upload().uploadFromFile(
+                reader, remoteFile['size'], name=remoteItem['name'],
+                parentType='item', parent=item, user=adminUser,
+                mimeType=remoteFile.get('mimeType'))
+        duration = max(time.time() - start, 1e-6)
+        logger.info('Ingested %s: %d bytes in %5.3f s (%5.3f MB/s)',
+                    remoteFile['name'], reader.bytesRead, duration,
+                    reader.bytesRead / duration / 1024 ** 2)
+    return item
+
+
+def get_sample_data(adminUser, collName='Sample Images', folderName='Images',
+                    concurrency=4, cache=None):
     """
     As needed, download sample data.
 
     :param adminUser: a user to create and modify collections and folders.
     :param collName: the collection name where the data will be added.
     :param folderName: the folder name where the data will be added.
+    :param concurrency: the maximum number of items to download at once.
+    :param cache: an optional DownloadCache.  When this is in offline mode,
+        the remote server is not contacted.
     :returns: the folder where the sample data is located.
     """
+    import concurrent.futures
+
+    try:
+        import girder_client
+        import requests
+        import urllib3
+    except ImportError:
+        logger.error('girder_client is unavailable.  Cannot get sample data.')
+        return
+    from girder_large_image.models.image_item import ImageItem
+
+    folder = get_collection_folder(adminUser, collName, folderName)
+    remote = girder_client.GirderClient(apiUrl='https://data.kitware.com/api/v1')
+    session = requests.Session()
+    retries = urllib3.util.retry.Retry(
+        total=10, backoff_factor=0.1, status_forcelist=[104, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(
+        max_retries=retries, pool_maxsize=max(10, int(concurrency or 1)))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    remote._session = session
+
+    remotePath = '/collection/HistomicsTK/Deployment test images'
+    if cache is not None:
+        from download_cache import cached_remote_listing
+
+        remoteItems = cached_remote_listing(cache, remote, remotePath)
+    else:
+        remoteFolder = remote.resourceLookup(remotePath)
+        remoteItems = list(remote.listItem(remoteFolder['_id']))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(concurrency or 1))) as pool:
+        sampleItems = list(pool.map(
+            lambda remoteItem: ingest_sample_item(
+                remote, remoteItem, folder, adminUser, cache),
+            remoteItems))
+    if cache is not None:
+        logger.info(cache.summary())
+    for item in sampleItems:
+        if 'largeImage' not in item:
+            logger.info('Making large_item %s', item['name'])
+            try:
+                ImageItem().createImageItem(item, createJob=False)
+            except Exception:
+                pass
+            logger.info('done')
+    return folder
+
+
+def backfill_format(item):
+    """
+    Get a short description of the format of an item for reporting.
+
+    :param item: an item document.
+    :returns: the lowercase extension of the item's name or '(none)'.
+    """
+    name = item.get('name', '') if item else ''
+    ext = name.lower().rsplit('.', 2)[1:]
+    if len(ext) == 2 and ext[0] in {'ome', 'nii', 'tar'}:
+        return '.'.join(ext)
+    return ext[-1] if ext and '.' in name else '(none)'
+
+
+def backfill_worker_init():
+    """
+    Configure girder in a backfill worker process.
+    """
+    from girder.utility.server import configureServer
+
+    configureServer()
+
+
+def backfill_item(itemId):
+    """
+    Create a large image for an item in a backfill worker process.
+
+    :param itemId: the id of the item.
+    :returns: the item id, the item's format, and an error message or None.
+    """
+    from girder.models.item import Item
+    from girder_large_image.models.image_item import ImageItem
+
+    item = Item().load(itemId, force=True)
+    fmt = backfill_format(item)
+    if item is None or 'largeImage' in item:
+        return itemId, fmt, None
+    try:
+        ImageItem().createImageItem(item, createJob=False)
+    except Exception as exc:
+        return itemId, fmt, str(exc) or exc.__class__.__name__
+    return itemId, fmt, None
+
+
+def resource_items_query(paths):
+    """
+    Get a query for all items within a set of folders, collections, or users.
+
+    :param paths: a list of resource paths.
+    :returns: a query for the item collection or None if there are no paths.
+    """
+    import girder.utility.path as path_util
+    from girder.models.folder import Folder
+
+    queries = []
+    for resPath in paths:
+        resource = path_util.lookUpPath(resPath, force=True)
+        if resource['model'] == 'item':
+            queries.append({'_id': resource['document']['_id']})
+        elif resource['model'] != 'folder':
+            queries.append({'baseParentId': resource['document']['_id']})
+        else:
+            folderIds = parentIds = [resource['document']['_id']]
+            while parentIds:
+                parentIds = [folder['_id'] for folder in Folder().find(
+                    {'parentId': {'$in': parentIds}, 'parentCollection': 'folder'},
+                    fields=['_id'])]
+                folderIds = folderIds + parentIds
+            queries.append({'folderId': {'$in': folderIds}})
+    return {'$or': queries} if queries else None
+
+
+def backfill_item_ids(paths):
+    """
+    Find all items without large images within a set of folders,
+    collections, or users.
+
+    :param paths: a list of resource paths.
+    :returns: a sorted list of item ids.
+    """
+    from girder.models.item import Item
+
+    query = resource_items_query(paths)
+    if query is None:
+        return []
+    return sorted({item['_id'] for item in Item().find(
+        {'$and': [query, {'largeImage': {'$exists': False}}]}, fields=['_id'])})
+
+
+def backfill_large_images(paths, concurrency=None, checkpointInterval=30):
+    """
+    Create large images for all items that don't have them in a set of
+    folders, collections, or users.  Items are processed in _id order on a
+    pool of processes and progress is recorded so an interrupted backfill of
+    the same paths resumes where it stopped.
+
+    :param paths: a list of resource paths.
+    :param concurrency: the number of worker processes.  None to use the
+        number of available cores.
+    :param checkpointInterval: the minimum number of seconds between recording
+        progress.
+    :returns: a dictionary of statistics.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    if not concurrency:
+        try:
+            concurrency = len(os.sched_getaffinity(0))
+        except AttributeError:
+            concurrency = os.cpu_count() or 1
+    key = 'backfill:' + ','.join(sorted(paths))
+    state = provision_state().find_one({'_id': key}) or {}
+    itemIds = backfill_item_ids(paths)
+    if state.get('lastId') is not None:
+        itemIds = [itemId for itemId in itemIds if itemId > state['lastId']]
+        logger.info('Resuming backfill of %s after %s', ', '.join(paths), state['lastId'])
+    stats = {'total': len(itemIds), 'done': 0, 'failed': 0, 'formats': {}}
+    logger.info('Backfilling large images for %d items with %d processes',
+                len(itemIds), concurrency)
+    start = lastCheckpoint = time.time()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=concurrency, initializer=backfill_worker_init,
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        # map returns results in order, so everything up to the current item
+        # is complete when it is recorded.
+        for itemId, fmt, error in pool.map(backfill_item, itemIds):
+            stats['done'] += 1
+            formatStats = stats['formats'].setdefault(fmt, {'done': 0, 'failed': 0})
+            formatStats['done'] += 1
+            if error:
+                stats['failed'] += 1
+                formatStats['failed'] += 1
+                logger.warning('Failed to create large image for %s: %s', itemId, error)
+            if time.time() - lastCheckpoint >= checkpointInterval:
+                lastCheckpoint = time.time()
+                provision_state().update_one(
+                    {'_id': key}, {'$set': {'lastId': itemId}}, upsert=True)
+                logger.info('Backfilled %d of %d items (%3.1f items/s)',
+                            stats['done'], stats['total'],
+                            stats['done'] / (lastCheckpoint - start))
+    stats['duration'] = time.time() - start
+    provision_state().delete_one({'_id': key})
+    logger.warning(
+        'Backfilled %d items in %5.3f s (%3.1f items/s); %d failed',
+        stats['done'], stats['duration'],
+        stats['done'] / stats['duration'] if stats['duration'] else 0,
+        stats['failed'])
+    for fmt, formatStats in sorted(stats['formats'].items()):
+        logger.warning('  %s: %d items, %d failed', fmt, formatStats['done'],
+                       formatStats['failed'])
+    return stats
+
+
+class PrewarmBudget:
+    """
+    Track the number of bytes added to the tile cache while pre-warming.
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: the maximum number of bytes.  0 for no limit.
+        """
+        self.limit = limit
+        self.used = 0
+        self.tiles = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.used += size
+            self.tiles += 1
+
+    @property
+    def exhausted(self):
+        return bool(self.limit) and self.used >= self.limit
+
+
+def prewarm_item(item, levels, budget):
+    """
+    Generate the thumbnail and the lowest resolution levels of a large image
+    so that they are in the large_image caches.
+
+    :param item: an item document with a large image.
+    :param levels: the number of lowest resolution levels to generate.
+    :param budget: a PrewarmBudget.  Generation stops when this is exhausted.
+    """
+    from girder_large_image.models.image_item import ImageItem
+
+    if budget.exhausted:
+        return
+    try:
+        ImageItem().getThumbnail(item, checkAndCreate=True)
+        metadata = ImageItem().getMetadata(item)
+    except Exception:
+        logger.info('Could not pre-warm %s', item['name'])
+        return
+    maxLevel = metadata['levels'] - 1
+    for z in range(min(levels, metadata['levels'])):
+        scale = 2 ** (maxLevel - z)
+        for y in range(int(math.ceil(metadata['sizeY'] / scale / metadata['tileHeight']))):
+            for x in range(int(math.ceil(metadata['sizeX'] / scale / metadata['tileWidth']))):
+                if budget.exhausted:
+                    return
+                try:
+                    tile = ImageItem().getTile(item, x, y, z, mayRedirect=False)
+                except Exception:
+                    continue
+                budget.add(len(tile) if isinstance(tile, bytes) else 0)
+
+
+def prewarm_caches(paths, levels=2, concurrency=4, memory=512 * 1024 ** 2, limit=None):
+    """
+    Pre-warm the thumbnails and tile cache for large images in a set of
+    folders, collections, or users.  Items are processed most recently updated
+    first.  Girder doesn't record when items are viewed, so the item's
+    updated time (which changes with uploads, metadata, and other edits) is
+    used as the closest available proxy for recent access.
+
+    :param paths: a list of resource paths.
+    :param levels: the number of lowest resolution levels to generate for
+        each image.
+    :param concurrency: the number of images to process at once.
+    :param memory: stop after this many bytes of tiles have been generated.
+        0 for no limit.
+    :param limit: an optional maximum number of items to pre-warm.
+    :returns: the PrewarmBudget with the amount generated.
+    """
+    import concurrent.futures
+
+    from girder.models.item import Item
+
+    start = time.time()
+    budget = PrewarmBudget(memory)
+    query = resource_items_query(paths)
+    if query is None:
+        return budget
+    cursor = Item().find(
+        {'$and': [query, {'largeImage.fileId': {'$exists': True}}]},
+        sort=[('updated', -1)], limit=limit or 0)
+    count = 0
+    concurrency = max(1, int(concurrency or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = set()
+        for item in cursor:
+            if budget.exhausted:
+                break
+            futures.add(pool.submit(prewarm_item, item, levels, budget))
+            count += 1
+            # Keep the queue bounded so that the budget is checked before
+            # most items are submitted.
+            if len(futures) >= concurrency * 2:
+                _done, futures = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        concurrent.futures.wait(futures)
+    cursor.close()
+    logger.info('Pre-warmed %d tiles (%d bytes) for %d items in %5.3f s%s',
+                budget.tiles, budget.used, count, time.time() - start,
+                '; memory budget reached' if budget.exhausted else '')
+    return budget
+
+
+def import_manifest_key(assetstoreId, root, parentType, parentId, params):
+    """
+    Get the prefix of the import manifest records of a directory import.
+    Importing the same directory to a different destination or with
+    different file filters imports different files, so it has separate
+    manifest records.
+
+    :param assetstoreId: the id of the assetstore.
+    :param root: the absolute path of the imported directory.
+    :param parentType: the model of the destination.
+    :param parentId: the id of the destination.
+    :param params: a dictionary of the import parameters that affect which
+        files are imported.
+    :returns: a prefix for the relative paths of imported directories.
+    """
+    import hashlib
+    import json
+
+    destination = hashlib.sha256(json.dumps(
+        [parentType, str(parentId), params], sort_keys=True).encode()).hexdigest()[:16]
+    return '%s:%s:%s:' % (assetstoreId, destination, root)
+
+
+class DirectoryImporter:
+    """
+    Import a directory tree in place into a filesystem assetstore.  A manifest
+    of each directory's modification time and the size and modification time
+    of its files is kept in the database.  Directories whose modification
+    time is unchanged are not listed again; only their subdirectories are
+    checked.  Rewriting a file in place doesn't change its directory's
+    modification time, so such changes are only found when verify is set.
+    Directories are processed in parallel.
+    """
+
+    def __init__(self, spec, adminUser):
+        """
+        :param spec: a dictionary with path (the directory to import), folder
+            (the resource path of the destination folder, collection, or
+            user), and optionally assetstore (the name of the assetstore; the
+            current assetstore by default), include and exclude (regular
+            expressions of file names), concurrency, and verify (if True,
+            check the size and modification time of the files of unchanged
+            directories and list them again if any file changed).
+        :param adminUser: the user that owns imported resources.
+        """
+        import girder.utility.path as path_util
+        from girder.models.assetstore import Assetstore
+        from girder.utility.assetstore_utilities import getAssetstoreAdapter
+
+        self.root = os.path.abspath(spec['path'])
+        self.adminUser = adminUser
+        self.concurrency = max(1, int(spec.get('concurrency', 4)))
+        self.verify = bool(spec.get('verify', False))
+        self.params = {'fileIncludeRegex': spec.get('include'),
+                       'fileExcludeRegex': spec.get('exclude')}
+        assetstore = (Assetstore().findOne({'name': spec['assetstore']})
+                      if spec.get('assetstore') else Assetstore().getCurrent())
+        if assetstore is None:
+            raise Exception('No assetstore named %s' % spec['assetstore'])
+        self.adapter = getAssetstoreAdapter(assetstore)
+        resource = path_util.lookUpPath(spec['folder'].strip('/'), force=True)
+        self.parent = resource['document']
+        self.parentType = resource['model']
+        self.manifest = provision_state().database['dsa_import_manifest']
+        self.key = import_manifest_key(
+            assetstore['_id'], self.root, self.parentType, self.parent['_id'], self.params)
+        self.stats = {'directories': 0, 'listed': 0, 'imported': 0,
+                      'unchanged': 0, 'removed': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for key, value in kwargs.items():
+                self.stats[key] += value
+
+    def _importFile(self, name, path, stat, parent):
+        from girder import events
+        from girder.models.file import File
+        from girder.models.item import Item
+
+        item = Item().createItem(
+            name=name, creator=self.adminUser, folder=parent, reuseExisting=True)
+        events.trigger('filesystem_assetstore_imported', {
+            'id': item['_id'], 'type': 'item', 'importPath': path})
+        file = self.adapter.importFile(item, path, self.adminUser, name=name)
+        if file.get('size') != stat.st_size:
+            # reuseExisting doesn't update the size of a changed file
+            file['size'] = stat.st_size
+            File().save(file)
+            Item().recalculateSize(item)
+
+    def _filesUnchanged(self, path, files):
+        for name, value in files.items():
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                return False
+            if [stat.st_size, stat.st_mtime] != value:
+                return False
+        return True
+
+    def _directory(self, path, parent, parentType):
+        """
+        Import one directory.
+
+        :returns: a list of (path, folder document) for subdirectories.
+        """
+        from girder import events
+        from girder.models.folder import Folder
+
+        relpath = os.path.relpath(path, self.root)
+        record = self.manifest.find_one({'_id': self.key + relpath}) or {}
+        mtime = os.stat(path).st_mtime
+        self._count(directories=1)
+        oldFiles = {name: [size, fileMtime] for name, size, fileMtime in record.get('files', [])}
+        if record.get('mtime') == mtime and (
+                not self.verify or self._filesUnchanged(path, oldFiles)):
+            subdirs = record.get('dirs', [])
+            folders = {folder['_id']: folder for folder in Folder().find(
+                {'_id': {'$in': [folderId for _name, folderId in subdirs]}})}
+            if all(folderId in folders for _name, folderId in subdirs):
+                self._count(unchanged=len(oldFiles))
+                return [(os.path.join(path, name), folders[folderId])
+                        for name, folderId in subdirs]
+            # A folder was removed in girder, so list this directory again
+        self._count(listed=1)
+        files, dirs, results = {}, [], []
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir():
+                folder = Folder().createFolder(
+                    parent=parent, name=entry.name, parentType=parentType,
+                    creator=self.adminUser, reuseExisting=True)
+                events.trigger('filesystem_assetstore_imported', {
+                    'id': folder['_id'], 'type': 'folder', 'importPath': entry.path})
+                dirs.append([entry.name, folder['_id']])
+                results.append((entry.path, folder))
+                continue
+            if not entry.is_file() or not self.adapter.shouldImportFile(entry.path, self.params):
+                continue
+            stat = entry.stat()
+            files[entry.name] = [stat.st_size, stat.st_mtime]
+            if oldFiles.get(entry.name) == files[entry.name]:
+                self._count(unchanged=1)
+                continue
+            if parentType != 'folder':
+                logger.warning('Files cannot be imported directly underneath a '
+                               '%s: %s', parentType, entry.path)
+                continue
+            self._importFile(entry.name, entry.path, stat, parent)
+            self._count(imported=1)
+        self._count(removed=len(set(oldFiles) - set(files)))
+        # File names are stored as values rather than keys, since they may
+        # contain characters that aren't allowed in keys
+        self.manifest.replace_one({'_id': self.key + relpath}, {
+            'mtime': mtime, 'files': [[name] + value for name, value in files.items()],
+            'dirs': dirs}, upsert=True)
+        return results
+
+    def run(self):
+        """
+        Import the directory tree.
+
+        :returns: a dictionary of statistics.
+        """
+        import concurrent.futures
+
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {pool.submit(self._directory, self.root, self.parent, self.parentType)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for path, folder in future.result():
+                        pending.add(pool.submit(self._directory, path, folder, 'folder'))
+        self.stats['duration'] = time.time() - start
+        logger.info(
+            'Imported %s: %d files imported, %d unchanged, %d no longer present; '
+            '%d of %d directories listed in %5.3f s', self.root,
+            self.stats['imported'], self.stats['unchanged'], self.stats['removed'],
+            self.stats['listed'], self.stats['directories'], self.stats['duration'])
+        return self.stats
+
+
+def import_directories(imports, adminUser):
+    """
+    Import each directory listed in the imports option.
+
+    :param imports: a list of import specifications; see DirectoryImporter.
+    :param adminUser: the user that owns imported resources.
+    """
+    for spec in imports:
+        try:
+            DirectoryImporter(spec, adminUser).run()
+        except Exception:
+            logger.exception('Failed to import %s', spec.get('path'))
+
+
+class ResourcePathCache:
+    """
+    A cache of resource documents resolved from resource paths.  This lasts
+    for a single provisioning run; provision_resources invalidates paths when
+    it creates or modifies documents.
+    """
+
+    def __init__(self):
+        self._docs = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, resPath, resolve):
+        """
+        Get a resolved resource, resolving and caching it if needed.
+
+        :param resPath: the resource path.
+        :param resolve: a function that takes the resource path and returns
+            the resource document or None.
+        :returns: a copy of the resource document or None.
+        """
+        with self._lock:
+            if resPath in self._docs:
+                self.hits += 1
+                return copy.deepcopy(self._docs[resPath])
+            self.misses += 1
+        resource = resolve(resPath)
+        if resource is not None:
+            with self._lock:
+                self._docs[resPath] = resource
+        return copy.deepcopy(resource)
+
+    def invalidate(self, resPath):
+        """
+        Discard cached resources at or below a resource path.
+
+        :param resPath: the resource path.
+        """
+        resPath = resPath.strip('/').lower()
+        with self._lock:
+            for key in list(self._docs):
+                lkey = key.strip('/').lower()
+                if lkey == resPath or lkey.startswith(resPath + '/'):
+                    del self._docs[key]
+
+    def clear(self):
+        with self._lock:
+            self._docs = {}
+
+
+resource_path_cache = ResourcePathCache()
+
+
+def resolve_resource_path(resPath):
+    """
+    Look up a resource by path without caching.
+
+    :param resPath: a resource path or assetstore/<name>.
+    :returns: the resource document or None.
+    """
+    import girder.utility.path as path_util
+    from girder.models.assetstore import Assetstore
+
+    if resPath.startswith('assetstore/'):
+        return Assetstore().findOne({'name': resPath.split('/', 1)[1]})
+    return path_util.lookUpPath(resPath, force=True)['document']
+
+
+def value_from_resource(value, adminUser):
+    """
+    If a value is a string that startwith 'resource:', it is a path to an
+    existing resource.  Fetch it an return the string of the _id.  Resolved
+    paths are cached in resource_path_cache.
+
+    :param value: a value
+    :returns: the original value it is not a resource, or the string id of the
+        resource.
+    """
+    starts = {'resource:': 'doc', 'resourceid:': 'id', 'resourceobjid:': 'obj'}
+    if isinstance(value, dict):
+        value = {k: value_from_resource(v, adminUser) for k, v in value.items()}
+    for start, stype in starts.items():
+        if str(value).startswith(start):
+            resPath = value.split(':', 1)[1]
+            if resPath == 'admin':
+                resource = adminUser
+            else:
+                resource = resource_path_cache.get(resPath, resolve_resource_path)
+            logger.info(f'Finding {start} reference for {resPath} as '
+                        f'{resource["_id"] if resource else resource}')
+            if stype == 'doc':
+                value = resource
+            elif stype == 'id':
+                value = str(resource['_id'])
+            else:
+                value = resource['_id']
+            break
+    return value
+
+
+def invalidate_resource(modelName, doc):
+    """
+    Invalidate cached resource paths for a document that was created or
+    modified.  When a modification could change the document's path, call
+    this both before and after the change.
+
+    :param modelName: the name of the document's model.
+    :param doc: the document.
+    """
+    import girder.utility.path as path_util
+
+    try:
+        resource_path_cache.invalidate(path_util.getResourcePath(modelName, doc, force=True))
+    except Exception:
+        # We can't determine the path, so don't trust anything
+        resource_path_cache.clear()
+
+
+RESOURCE_PREFIXES = ('resource:', 'resourceid:', 'resourceobjid:')
+RESOURCE_OWNER_KEYS = {'folder': 'parent', 'item': 'folder', 'file': 'item'}
+
+
+def resource_references(value):
+    """
+    List the resource paths referenced by an unresolved value.
+
+    :param value: a value from a resource entry.
+    :returns: a list of lowercase resource paths.
+    """
+    if isinstance(value, dict):
+        return [ref for v in value.values() for ref in resource_references(v)]
+    for start in RESOURCE_PREFIXES:
+        if isinstance(value, str) and value.startswith(start):
+            return [value.split(':', 1)[1].strip('/').lower()]
+    return []
+
+
+def admin_resource_path(adminUser):
+    """
+    Get the resource path that "admin" in a resource reference refers to.
+
+    :param adminUser: the admin user document or None.
+    :returns: a lowercase resource path or None if there is no admin user.
+    """
+    return 'user/%s' % adminUser['login'].lower() if adminUser else None
+
+
+def resource_entry_path(entry, adminUser=None):
+    """
+    Determine the resource path an unresolved resource entry refers to, if
+    this can be known before resolving it.
+
+    :param entry: a resource entry.
+    :param adminUser: the admin user document, used for references to admin.
+    :returns: a lowercase resource path or None.
+    """
+    modelName = entry.get('model')
+    if modelName == 'collection' and entry.get('name'):
+        return 'collection/%s' % str(entry['name']).lower()
+    if modelName == 'user' and entry.get('login'):
+        return 'user/%s' % str(entry['login']).lower()
+    owner = resource_references(entry.get(RESOURCE_OWNER_KEYS.get(modelName)))
+    if len(owner) == 1 and owner[0] == 'admin':
+        owner = [admin_resource_path(adminUser)]
+    if len(owner) == 1 and owner[0] and entry.get('name'):
+        return '%s/%s' % (owner[0], str(entry['name']).lower())
+    return None
+
+
+def plan_resources(resources, adminUser=None):
+    """
+    Build a dependency graph of resource entries and group them into levels.
+    An entry depends on an earlier entry if it references the path that entry
+    creates or a path below it, or if both refer to the same path.  The path
+    an entry creates can't always be known before it is resolved; such an
+    entry depends on every earlier entry and every later entry depends on it,
+    so these keep the order of the resources list.  Entries within a level
+    are independent of each other.
+
+    :param resources: a list of unresolved resource entries.
+    :param adminUser: the admin user document, used for references to admin.
+    :returns: a list of levels, each of which is a list of indices into the
+        resources list.
+    """
+    adminPath = admin_resource_path(adminUser)
+    paths = [resource_entry_path(entry, adminUser) for entry in resources]
+    depth = []
+    for idx, entry in enumerate(resources):
+        refs = [adminPath if ref == 'admin' else ref
+                for value in entry.values() for ref in resource_references(value)]
+        deps = [other for other in range(idx) if paths[idx] is None or paths[other] is None or (
+            paths[other] == paths[idx] or any(
+                ref and (ref == paths[other] or ref.startswith(paths[other] + '/'))
+                for ref in refs))]
+        depth.append(1 + max((depth[other] for other in deps), default=-1))
+    levels = [[] for _ in range(max(depth, default=-1) + 1)]
+    for idx, level in enumerate(depth):
+        levels[level].append(idx)
+    return levels
+
+
+def resource_query(modelName, entry):
+    """
+    Get the query used to find an existing document for a resolved resource
+    entry.
+
+    :param modelName: the name of the resource model.
+    :param entry: the resolved resource entry.
+    :returns: a query dictionary.  This is empty if the entry cannot be
+        matched.
+    """
+    key = 'name' if modelName != 'user' else 'login'
+    query = {}
+    if key in entry:
+        query[key] = entry[key]
+    ownerKey = RESOURCE_OWNER_KEYS.get(modelName)
+    if ownerKey and ownerKey in entry and isinstance(
+            entry[ownerKey], dict) and '_id' in entry[ownerKey]:
+        query[ownerKey + 'Id'] = entry[ownerKey]['_id']
+    return query
+
+
+def find_resources(model, queries):
+    """
+    Find existing documents for a list of queries with a single database
+    query.
+
+    :param model: the model to query.
+    :param queries: a list of query dictionaries of simple equality tests.
+    :returns: a list the same length as queries with either the first
+        matching document or None.
+    """
+    nonempty = [query for query in queries if query]
+    docs = list(model.find({'$or': nonempty})) if nonempty else []
+    return [next((doc for doc in docs if all(
+        doc.get(k) == v for k, v in query.items())), None) if query else None
+        for query in queries]
+
+
+RESOURCE_OPTION_KEYS = (
+    'metadata', 'metadata_update', 'metadata_key', 'attrs', 'attrs_update')
+
+
+def resource_changes(model, entry, existing):
+    """
+    Determine the metadata and attrs that provisioning a resolved resource
+    entry would change.
+
+    :param model: the model of the resource.
+    :param entry: the resolved resource entry without the model key.
+    :param existing: the existing document or None.
+    :returns: a dictionary which may contain 'metadata', a dictionary of
+        metadata keys to set or to remove (if None), 'metadata_key', and
+        'attrs', a dictionary of attributes to set.  Unchanged values are
+        omitted.
+    """
+    metadata = entry.get('metadata')
+    metadata_key = entry.get('metadata_key', 'meta')
+    attrs = entry.get('attrs')
+    changes = {}
+    if isinstance(metadata, dict) and hasattr(model, 'setMetadata') and (
+            metadata_key not in metadata or entry.get('metadata_update', True)):
+        current = (existing or {}).get(metadata_key) or {}
+        meta = {k: v for k, v in metadata.items()
+                if (k in current if v is None else k not in current or current[k] != v)}
+        if meta:
+            changes['metadata'] = meta
+            changes['metadata_key'] = metadata_key
+    if attrs and (existing is None or entry.get('attrs_update', True)):
+        attrs = {k: v for k, v in attrs.items()
+                 if existing is None or k not in existing or existing[k] != v}
+        if attrs:
+            changes['attrs'] = attrs
+    return changes
+
+
+def apply_resource_changes(model, doc, changes, updated=None):
+    """
+    Apply metadata and attrs changes to a document in memory.
+
+    :param model: the model of the resource.
+    :param doc: the document to modify.
+    :param changes: a dictionary from resource_changes.
+    :param updated: if not None and there are metadata changes, set the
+        document's updated time to this.
+    :returns: the document.
+    """
+    if 'metadata' in changes:
+        meta = doc.setdefault(changes['metadata_key'], {})
+        for key, value in changes['metadata'].items():
+            if value is None:
+                meta.pop(key, None)
+            else:
+                meta[key] = value
+        model.validateKeys(meta)
+        if updated is not None:
+            doc['updated'] = updated
+    doc.update(changes.get('attrs', {}))
+    return doc
+
+
+def resource_update(changes, updated=None):
+    """
+    Build a targeted database update from metadata changes.  Attrs changes
+    are not included; they are saved through the model so they are
+    validated.
+
+    :param changes: a dictionary from resource_changes.
+    :param updated: if not None and there are metadata changes, set the
+        document's updated time to this, as model.setMetadata does.
+    :returns: a pymongo update document with $set and $unset as needed.
+    """
+    update = {}
+    for key, value in changes.get('metadata', {}).items():
+        path = '%s.%s' % (changes['metadata_key'], key)
+        if value is None:
+            update.setdefault('$unset', {})[path] = ''
+        else:
+            update.setdefault('$set', {})[path] = value
+    if update and updated is not None:
+        update.setdefault('$set', {})['updated'] = updated
+    return update
+
+
+def update_resources(model, modelName, updates, strict=True):
+    """
+    Apply metadata and attrs changes to existing documents of one model.
+    Metadata-only changes are written with targeted updates in a single bulk
+    write.  Documents with attrs changes are saved through the model so that
+    they are validated (for instance, names are normalized and checked for
+    uniqueness).  As with model.setMetadata, documents whose metadata
+    changes have their updated time set.
+
+    :param model: the model of the resources.
+    :param modelName: the name of the model.
+    :param updates: a list of (document, changes) tuples, where changes is a
+        non-empty dictionary from resource_changes.
+    :param strict: if False, documents that fail to update are logged and
+        counted rather than raising an exception.
+    :returns: the number of documents that failed to update.
+    """
+    import pymongo
+    import pymongo.errors
+
+    if not updates:
+        return 0
+    logger.info('Updating metadata or attrs of %d %ss', len(updates), modelName)
+    failed = 0
+    bulk = []
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    for doc, changes in updates:
+        try:
+            if 'metadata' in changes:
+                model.validateKeys({
+                    k: v for k, v in changes['metadata'].items() if v is not None})
+            if 'attrs' not in changes:
+                bulk.append((doc, changes))
+                continue
+            # attrs may rename or move the document, so invalidate both the
+            # old and the new path
+            invalidate_resource(modelName, doc)
+            model.save(apply_resource_changes(model, doc, changes, now))
+            invalidate_resource(modelName, doc)
+        except Exception as exc:
+            if strict:
+                raise
+            logger.warning('Failed to update %s %r: %s', modelName, doc.get('name'), exc)
+            failed += 1
+    if not bulk:
+        return failed
+    try:
+        model.collection.bulk_write([
+            pymongo.UpdateOne({'_id': doc['_id']}, resource_update(changes, now))
+            for doc, changes in bulk], ordered=False)
+        errors = {}
+    except pymongo.errors.BulkWriteError as exc:
+        if strict:
+            raise
+        errors = {err['index']: err.get('errmsg') for err in exc.details.get('writeErrors', [])}
+    for idx, (doc, changes) in enumerate(bulk):
+        if idx in errors:
+            logger.warning('Failed to update %s %r: %s', modelName, doc.get('name'), errors[idx])
+            failed += 1
+            continue
+        apply_resource_changes(model, doc, changes, now)
+        invalidate_resource(modelName, doc)
+    return failed
+
+
+def provision_resource(model, modelName, entry, existing):
+    """
+    Create a single resolved resource entry if it does not exist and apply
+    metadata and attrs.  Only metadata and attrs that differ from the
+    document are written.
+
+    :param model: the model of the resource.
+    :param modelName: the name of the model.
+    :param entry: the resolved resource entry without the model key.
+    :param existing: the existing document or None.
+    :returns: the resource document.
+    """
+    changes = resource_changes(model, entry, existing)
+    for key in RESOURCE_OPTION_KEYS:
+        entry.pop(key, None)
+    if existing:
+        result = existing
+        logger.debug('Has %s (%r)', modelName, entry)
+    else:
+        createFunc = getattr(model, 'create%s' % modelName.capitalize())
+        logger.info('Creating %s (%r)', modelName, entry)
+        result = createFunc(**entry)
+        invalidate_resource(modelName, result)
+    if changes:
+        update_resources(model, modelName, [(result, changes)])
+    return result
+
+
+def split_resource_updates(results, strict=True):
+    """
+    Separate resolved resource entries for existing documents and apply
+    their metadata and attrs changes with one bulk write per model.
+
+    :param results: a list of tuples from resolve_resource_level.
+    :param strict: if False, entries that fail to update are logged and
+        counted rather than raising an exception.
+    :returns: the results for resources that do not exist, the number of
+        existing resources that were updated, the number that were
+        unchanged, and the number that failed.
+    """
+    from girder.utility.model_importer import ModelImporter
+
+    remaining, updates, unchanged, failed = [], {}, 0, 0
+    for result in results:
+        modelName, entry, existing = result[1:4]
+        if entry is None or existing is None:
+            remaining.append(result)
+            continue
+        try:
+            changes = resource_changes(ModelImporter.model(modelName), entry, existing)
+        except Exception as exc:
+            if strict:
+                raise
+            logger.warning('Failed to update %s %r: %s', modelName, entry.get('name'), exc)
+            failed += 1
+            continue
+        if changes:
+            updates.setdefault(modelName, []).append((existing, changes))
+        else:
+            unchanged += 1
+    updated = 0
+    for modelName, modelUpdates in updates.items():
+        modelFailed = update_resources(
+            ModelImporter.model(modelName), modelName, modelUpdates, strict)
+        updated += len(modelUpdates) - modelFailed
+        failed += modelFailed
+    return remaining, updated, unchanged, failed
+
+
+def resolve_resource_level(resources, level, adminUser, strict=True):
+    """
+    Resolve the resource entries of one level of a resource plan and find
+    their existing documents with one query per model.
+
+    :param resources: the list of unresolved resource entries.
+    :param level: a list of indices into resources.
+    :param adminUser: the admin user to use for provisioning.
+    :param strict: if False, entries that reference resources that do not
+        exist are reported with an entry of None rather than raising an
+        exception.
+    :returns: a list of tuples of the resource index, the model name, the
+        resolved entry without the model key, and the existing document or
+        None.
+    """
+    from girder.utility.model_importer import ModelImporter
+
+    results = []
+    for idx in level:
+        entry = dict(resources[idx])
+        modelName = entry.pop('model')
+        try:
+            if adminUser is None and 'admin' in resource_references(entry):
+                raise ValueError('The admin user does not exist')
+            entry = {k: value_from_resource(v, adminUser) for k, v in entry.items()}
+        except Exception:
+            if strict:
+                raise
+            entry = None
+        results.append((idx, modelName, entry, None))
+    for modelName in {result[1] for result in results}:
+        positions = [pos for pos, result in enumerate(results)
+                     if result[1] == modelName and result[2] is not None]
+        found = find_resources(ModelImporter.model(modelName), [
+            resource_query(modelName, results[pos][2]) for pos in positions])
+        for pos, doc in zip(positions, found):
+            results[pos] = results[pos][:3] + (doc, )
+    return results
+
+
+def provision_resources(resources, adminUser, concurrency=4):
+    """
+    Given a dictionary of resources, add them to the system.  The resource is
+    only added if a resource of that name with the same parent object does not
+    exist.
+
+    Entries are grouped into levels based on the resources they reference.
+    For each level, existing resources are found with one query per model,
+    their changed metadata and attrs are written with one bulk update per
+    model, and missing resources are created concurrently.
+
+    :param resources: a list of resources to add.
+    :param adminUser: the admin user to use for provisioning.
+    :param concurrency: the maximum number of resources to create at once.
+    """
+    import concurrent.futures
+
+    from girder.utility.model_importer import ModelImporter
+
+    levels = plan_resources(resources, adminUser)
+    logger.info('Provisioning %d resources in %d levels', len(resources), len(levels))
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(concurrency or 1))) as pool:
+        for level in levels:
+            results = split_resource_updates(
+                resolve_resource_level(resources, level, adminUser))[0]
+            # New users are created together so their passwords can be hashed
+            # in parallel.
+            newUsers = [result[2] for result in results
+                        if result[1] == 'user' and result[3] is None]
+            if len(newUsers) > 1:
+                bulk_create_users(newUsers)
+                results = [result for result in results
+                           if result[1] != 'user' or result[3] is not None]
+            list(pool.map(lambda result: provision_resource(
+                ModelImporter.model(result[1]), result[1], result[2], result[3]),
+                results))
+
+
+def manifest_records(path, fmt=None):
+    """
+    Read resource entries from a manifest file one at a time.  JSON-lines
+    files have one entry per line.  CSV files have one entry per row; column
+    names with periods, such as metadata.caseId, are nested and empty values
+    are omitted.  YAML (or JSON) files may have multiple documents, each of
+    which is an entry or a list of entries.
+
+    :param path: the path of the manifest.
+    :param fmt: one of 'jsonl', 'csv', or 'yaml'.  If None, this is
+        determined from the file extension.
+    :yields: resource entries.
+    """
+    import csv
+    import json
+
+    if fmt is None:
+        ext = os.path.splitext(path)[1].lower()
+        fmt = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv'}.get(ext, 'yaml')
+    with open(path, newline='' if fmt == 'csv' else None) as fptr:
+        if fmt == 'jsonl':
+            for line in fptr:
+                if line.strip():
+                    yield json.loads(line)
+        elif fmt == 'csv':
+            for row in csv.DictReader(fptr):
+                entry = {}
+                for key, value in row.items():
+                    if key is None or value is None or value == '':
+                        continue
+                    parts = key.split('.')
+                    target = entry
+                    for part in parts[:-1]:
+                        target = target.setdefault(part, {})
+                    target[parts[-1]] = value
+                yield entry
+        else:
+            for doc in yaml.safe_load_all(fptr):
+                if isinstance(doc, list):
+                    yield from doc
+                elif doc is not None:
+                    yield doc
+
+
+BULK_RESOURCE_MODELS = {'folder', 'item', 'user'}
+
+_password_pool = None
+
+
+def hash_password(password):
+    """
+    Hash a password the way girder's User model does.  This runs in a
+    password hashing worker process.
+
+    :param password: the password.
+    :returns: the hash.
+    """
+    from passlib.context import CryptContext
+
+    return CryptContext(schemes=['bcrypt']).hash(password)
+
+
+def password_pool():
+    """
+    Get a process pool for hashing passwords sized to the available cores.
+
+    :returns: a concurrent.futures executor.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    global _password_pool
+
+    if _password_pool is None:
+        try:
+            cores = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cores = os.cpu_count() or 1
+        _password_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=cores, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(_password_pool.shutdown)
+    return _password_pool
+
+
+def bulk_create_users(entries, strict=True, batchSize=1000):
+    """
+    Create users with passwords hashed in parallel and bulk inserts.  Users
+    whose login already exists are not created.  Each user is validated and
+    the user model's save events are triggered as model.save would.
+
+    :param entries: a list of resolved user resource entries without the
+        model key.  These have the parameters of User().createUser.
+    :param strict: if False, invalid users are logged and skipped rather
+        than raising an exception.
+    :param batchSize: the maximum number of users to insert at once.
+    :returns: the number of users created and the number of invalid users
+        that were skipped.
+    """
+    import inspect
+
+    from girder import events
+    from girder.constants import SettingKey
+    from girder.models.setting import Setting
+    from girder.models.user import User
+    from girder.utility import config
+
+    start = time.time()
+    model = User()
+    signature = inspect.signature(model.createUser)
+    requireApproval = Setting().get(SettingKey.REGISTRATION_POLICY) == 'approve'
+    passwordRegex = config.getConfig()['users']['password_regex']
+    existing = {doc['login'] for doc in model.find(
+        {'login': {'$in': [str(entry.get('login', '')).lower().strip() for entry in entries]}},
+        fields=['login'])}
+    docs, passwords, logins, emails, skipped = [], [], set(), set(), 0
+    for entry in entries:
+        if str(entry.get('login', '')).lower().strip() in existing:
+            logger.debug('User %r already exists', entry.get('login'))
+            continue
+        try:
+            # Reject entries that createUser would reject
+            signature.bind(**{k: v for k, v in entry.items() if k not in RESOURCE_OPTION_KEYS})
+            doc = {
+                'login': entry['login'],
+                'email': entry['email'],
+                'firstName': entry['firstName'],
+                'lastName': entry['lastName'],
+                'created': datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+                'emailVerified': False,
+                'status': 'pending' if requireApproval and not entry.get('admin') else 'enabled',
+                'admin': bool(entry.get('admin', False)),
+                'size': 0,
+                'groups': [],
+                'groupInvites': [],
+                'salt': None,
+            }
+            model.setPublic(doc, entry.get('public', True), save=False)
+            password = entry['password']
+            if password is not None and not re.match(passwordRegex, password):
+                raise ValueError(config.getConfig()['users']['password_description'])
+            if not events.trigger('model.user.validate', doc).defaultPrevented:
+                doc = model.validate(doc)
+            if doc['login'] in logins or doc['email'] in emails:
+                raise ValueError('Duplicate login or email')
+        except Exception as exc:
+            if strict:
+                raise
+            logger.warning('Invalid user %r: %s', entry.get('login'), exc)
+            skipped += 1
+            continue
+        apply_resource_changes(model, doc, resource_changes(model, entry, None))
+        logins.add(doc['login'])
+        emails.add(doc['email'])
+        docs.append(doc)
+        passwords.append(password)
+    created, batchSize = 0, max(1, int(batchSize))
+    for offset in range(0, len(docs), batchSize):
+        batch = docs[offset:offset + batchSize]
+        batchPasswords = passwords[offset:offset + batchSize]
+        toHash = [idx for idx, password in enumerate(batchPasswords) if password is not None]
+        if toHash:
+            for idx, salt in zip(toHash, password_pool().map(
+                    hash_password, [batchPasswords[idx] for idx in toHash])):
+                batch[idx]['salt'] = salt
+        valid = [doc for doc in batch
+                 if not events.trigger('model.user.save', doc).defaultPrevented]
+        skipped += len(batch) - len(valid)
+        batch = valid
+        if not batch:
+            continue
+        model.collection.insert_many(batch, ordered=False)
+        for doc in batch:
+            # This creates the default Public and Private folders
+            events.trigger('model.user.save.created', doc)
+            events.trigger('model.user.save.after', doc)
+            invalidate_resource('user', doc)
+        created += len(batch)
+    duration = time.time() - start
+    logger.info('Created %d users in %5.3f s (%3.1f users/s); %d invalid users skipped',
+                created, duration, created / max(duration, 1e-6), skipped)
+    return created, skipped
+
+
+def bulk_resource_document(model, modelName, entry, adminUser):
+    """
+    Build a new folder or item document the way createFolder or createItem
+    would, including metadata and attrs, without saving it.
+
+    :param model: the model of the resource.
+    :param modelName: 'folder' or 'item'.
+    :param entry: the resolved resource entry without the model key.
+    :param adminUser: the creator if the entry doesn't specify one.
+    :returns: the document.
+    """
+    from bson.objectid import ObjectId
+    from girder.constants import AccessType
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    name = str(entry.get('name') or '').strip()
+    if not name:
+        raise ValueError('%s name must not be empty' % modelName.capitalize())
+    creator = entry.get('creator') or adminUser
+    doc = {
+        'name': name,
+        'description': str(entry.get('description') or '').strip(),
+        'creatorId': creator['_id'] if creator else None,
+        'created': now,
+        'updated': now,
+        'size': 0,
+        'meta': {},
+    }
+    if modelName == 'item':
+        folder = entry['folder']
+        doc.update({
+            'folderId': ObjectId(folder['_id']),
+            'baseParentType': folder['baseParentType'],
+            'baseParentId': folder['baseParentId'],
+        })
+    else:
+        parent = entry['parent']
+        parentType = entry.get('parentType', 'folder').lower()
+        if parentType not in ('folder', 'user', 'collection'):
+            raise ValueError('The parentType must be folder, collection, or user.')
+        doc.update({
+            'parentCollection': parentType,
+            'parentId': ObjectId(parent['_id']),
+            'baseParentType': parent['baseParentType'] if parentType == 'folder' else parentType,
+            'baseParentId': parent['baseParentId'] if parentType == 'folder' else parent['_id'],
+        })
+        if parentType in ('folder', 'collection'):
+            model.copyAccessPolicies(src=parent, dest=doc, save=False)
+        if creator is not None:
+            model.setUserAccess(doc, user=creator, level=AccessType.ADMIN, save=False)
+        if isinstance(entry.get('public'), bool):
+            model.setPublic(doc, entry['public'], save=False)
+    return apply_resource_changes(model, doc, resource_changes(model, entry, None))
+
+
+def bulk_validate_resources(model, docs):
+    """
+    Validate new documents and trigger their pre-save events the way
+    model.save would before they are inserted together.  Validation fills in
+    derived fields, such as lowerName.
+
+    :param model: the model of the documents.
+    :param docs: a list of unsaved documents.
+    :returns: a list of the documents to insert and the number of documents
+        that were invalid or whose save was prevented by an event handler.
+    """
+    from girder import events
+
+    valid, skipped = [], 0
+    for doc in docs:
+        try:
+            if not events.trigger('model.%s.validate' % model.name, doc).defaultPrevented:
+                doc = model.validate(doc)
+        except Exception as exc:
+            logger.warning('Invalid %s %r: %s', model.name, doc.get('name'), exc)
+            skipped += 1
+            continue
+        if events.trigger('model.%s.save' % model.name, doc).defaultPrevented:
+            skipped += 1
+            continue
+        valid.append(doc)
+    return valid, skipped
+
+
+def bulk_create_resources(modelName, entries, adminUser):
+    """
+    Create folders, items, or users with a single bulk insert.  Folders and
+    items whose name collides with a sibling item or folder are skipped.
+    Each document is validated and the model's save events are triggered as
+    model.save would.
+
+    :param modelName: 'folder', 'item', or 'user'.
+    :param entries: a list of resolved resource entries without the model
+        key.
+    :param adminUser: the creator if an entry doesn't specify one.
+    :returns: the number of documents created and the number skipped.
+    """
+    from girder import events
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+
+    if modelName == 'user':
+        return bulk_create_users(entries, strict=False)
+    model = Folder() if modelName == 'folder' else Item()
+    docs, seen, skipped = [], set(), 0
+    for entry in entries:
+        try:
+            doc = bulk_resource_document(model, modelName, entry, adminUser)
+        except Exception as exc:
+            logger.warning('Invalid %s %r: %s', modelName, entry.get('name'), exc)
+            skipped += 1
+            continue
+        key = (doc.get('folderId', doc.get('parentId')), doc['name'])
+        if key in seen:
+            logger.warning('Skipping duplicate %s %r in the same batch', modelName, doc['name'])
+            skipped += 1
+            continue
+        seen.add(key)
+        docs.append(doc)
+    # Items and folders in the same folder must have distinct names
+    if modelName == 'item':
+        conflicts = Folder().find({
+            'parentCollection': 'folder', 'parentId': {'$in': list({d['folderId'] for d in docs})},
+            'name': {'$in': [d['name'] for d in docs]}}, fields=['parentId', 'name'])
+        conflicts = {(doc['parentId'], doc['name']) for doc in conflicts}
+    else:
+        conflicts = Item().find({
+            'folderId': {'$in': [d['parentId'] for d in docs if d['parentCollection'] == 'folder']},
+            'name': {'$in': [d['name'] for d in docs]}}, fields=['folderId', 'name'])
+        conflicts = {(doc['folderId'], doc['name']) for doc in conflicts}
+    if conflicts:
+        before = len(docs)
+        docs = [doc for doc in docs if (doc.get('folderId', doc.get('parentId')), doc['name'])
+                not in conflicts]
+        logger.warning('Skipping %d %ss whose names are used by a sibling',
+                       before - len(docs), modelName)
+        skipped += before - len(docs)
+    docs, invalid = bulk_validate_resources(model, docs)
+    skipped += invalid
+    if docs:
+        model.collection.insert_many(docs, ordered=False)
+        for doc in docs:
+            events.trigger('model.%s.save.created' % modelName, doc)
+            events.trigger('model.%s.save.after' % modelName, doc)
+    return len(docs), skipped
+
+
+def load_manifest_batch(batch, adminUser, stats):
+    """
+    Provision one batch of resource entries from a manifest.  Existing
+    resources are found with one query per model and level, new folders and
+    items are created with bulk inserts, and other resources are created
+    individually.
+
+    :param batch: a list of unresolved resource entries.
+    :param adminUser: the admin user to use for provisioning.
+    :param stats: a dictionary of counts to update.
+    """
+    from girder.utility.model_importer import ModelImporter
+
+    for level in plan_resources(batch, adminUser):
+        bulk = {}
+        results, updated, unchanged, failed = split_resource_updates(
+            resolve_resource_level(batch, level, adminUser, strict=False), strict=False)
+        stats['updated'] += updated
+        stats['unchanged'] += unchanged
+        stats['failed'] += failed
+        for idx, modelName, entry, _existing in results:
+            if entry is None:
+                logger.warning('Cannot resolve references in %r', batch[idx])
+                stats['failed'] += 1
+                continue
+            if modelName in BULK_RESOURCE_MODELS:
+                bulk.setdefault(modelName, []).append(entry)
+                continue
+            try:
+                provision_resource(ModelImporter.model(modelName), modelName, entry, None)
+            except Exception as exc:
+                logger.warning('Failed to provision %s %r: %s', modelName, entry.get('name'), exc)
+                stats['failed'] += 1
+                continue
+            stats['created'] += 1
+        for modelName, entries in bulk.items():
+            created, skipped = bulk_create_resources(modelName, entries, adminUser)
+            stats['created'] += created
+            stats['failed'] += skipped
+
+
+def load_manifest(spec, adminUser):
+    """
+    Stream resource entries from a manifest file and provision them in
+    batches.
+
+    :param spec: a dictionary with path, and optionally format ('jsonl',
+        'csv', or 'yaml'), batch-size, and defaults (a dictionary of values,
+        such as model or parent, used when an entry doesn't specify them).
+    :param adminUser: the admin user to use for provisioning.
+    :returns: a dictionary of counts.
+    """
+    batchSize = max(1, int(spec.get('batch-size', 500)))
+    defaults = spec.get('defaults') or {}
+    stats = {'records': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    start = time.time()
+    batch = []
+    records = manifest_records(spec['path'], spec.get('format'))
+    while True:
+        record = next(records, None)
+        if record is not None:
+            batch.append(dict(defaults, **record))
+        if batch and (record is None or len(batch) >= batchSize):
+            load_manifest_batch(batch, adminUser, stats)
+            stats['records'] += len(batch)
+            batch = []
+            logger.info(
+                'Manifest %s: %d records, %d created, %d updated, %d unchanged, '
+                '%d failed (%3.1f records/s)', spec['path'], stats['records'],
+                stats['created'], stats['updated'], stats['unchanged'], stats['failed'],
+                stats['records'] / max(time.time() - start, 1e-6))
+        if record is None:
+            return stats
+
+
+def plan_resource_changes(resources, adminUser):
+    """
+    Determine which resources would be created or changed by provisioning
+    without modifying the database.
+
+    :param resources: a list of unresolved resource entries.
+    :param adminUser: the admin user or None if it would be created.
+    :returns: a list of change dictionaries.
+    """
+    from girder.utility.model_importer import ModelImporter
+
+    changes = []
+    for level in plan_resources(resources, adminUser):
+        for idx, modelName, entry, existing in resolve_resource_level(
+                resources, level, adminUser, strict=False):
+            change = {'type': 'resource', 'index': idx, 'model': modelName,
+                      'path': resource_entry_path(resources[idx], adminUser)}
+            if entry is None:
+                # This references a resource that doesn't exist yet, so it
+                # must be created after that resource.
+                changes.append(dict(change, action='create', pending=True))
+                continue
+            if existing is None:
+                change['action'] = 'create'
+                change.update(resource_changes(ModelImporter.model(modelName), entry, None))
+                changes.append(change)
+                continue
+            updates = resource_changes(ModelImporter.model(modelName), entry, existing)
+            change['_id'] = str(existing['_id'])
+            for key in ('metadata', 'attrs'):
+                if key in updates:
+                    changes.append(dict(change, type=key, action='update', values=updates[key]))
+    return changes
+
+
+def is_progress_line(line):
+    """
+    Check if a job log line is a docker pull progress report.
+
+    :param line: the log line.
+    :returns: True if this is a progress line.
+    """
+    return '%' in line and any(
+        word in line for word in ('Pulling', 'Downloading', 'Extracting'))
+
+
+def tail_job_log(job, thread, prefix, interval=1, progressInterval=5):
+    """
+    Log a local job's log as it is written until the job finishes.  Rather
+    than reloading the whole job, only log entries past those already seen
+    are fetched, and fetches happen when the job is updated in this process
+    (with a periodic fallback).  Docker progress lines are coalesced so at
+    most one is logged per progressInterval.
+
+    :param job: the job document.
+    :param thread: the thread running the job.
+    :param prefix: a prefix for logged lines.
+    :param interval: the maximum time in seconds between checks for new log
+        entries.
+    :param progressInterval: the minimum time in seconds between logged
+        progress lines.
+    :returns: the final job document without its log and the number of log
+        lines that were read.
+    """
+    from girder import events
+    from girder_jobs.models.job import Job
+
+    updated = threading.Event()
+    handlerName = 'provision_tail_%s' % job['_id']
+
+    def onUpdate(event):
+        info = event.info if isinstance(event.info, dict) else {}
+        if str((info.get('job') or {}).get('_id')) == str(job['_id']):
+            updated.set()
+
+    events.bind('jobs.job.update.after', handlerName, onUpdate)
+    logpos = 0
+    pending = None
+    lastProgress = 0
+    try:
+        while True:
+            # Once the job thread has ended, the next read gets everything
+            finished = not thread.is_alive()
+            if not finished:
+                updated.wait(interval)
+                updated.clear()
+            record = Job().collection.find_one(
+                {'_id': job['_id']}, {'status': True, 'log': {'$slice': [logpos, 10000]}})
+            lines = record.get('log') or []
+            for line in lines:
+                logpos += 1
+                line = line.rstrip()
+                if is_progress_line(line):
+                    if time.time() - lastProgress < progressInterval:
+                        pending = line
+                        continue
+                    lastProgress = time.time()
+                elif pending:
+                    logger.info('%s: %s', prefix, pending)
+                pending = None
+                logger.info('%s: %s', prefix, line)
+            if finished and len(lines) < 10000:
+                break
+    finally:
+        events.unbind('jobs.job.update.after', handlerName)
+    if pending:
+        logger.info('%s: %s', prefix, pending)
+    return Job().load(id=job['_id'], force=True, includeLog=False), logpos
+
+
+def load_slicer_image(image, adminUser, alwaysPull=False):
+    """
+    Pull and load a single cli docker image via its own job.
+
+    :param image: the docker image name.
+    :param adminUser: an admin user for permissions.
+    :param alwaysPull: true to ask to always pull the latest image.
+    :returns: the final job document.
+    """
+    from girder.models.setting import Setting
+    from girder_jobs.constants import JobStatus
+    from girder_jobs.models.job import Job
+    from slicer_cli_web.config import PluginSettings
+    from slicer_cli_web.docker_resource import DockerResource
+    from slicer_cli_web.image_job import jobPullAndLoad
+
+    start = time.time()
+    job = Job().createLocalJob(
+        module='slicer_cli_web.image_job',
+        function='jobPullAndLoad',
+        kwargs={
+            'nameList': [image],
+            'folder': Setting().get(PluginSettings.SLICER_CLI_WEB_TASK_FOLDER),
+            'pull': 'true' if alwaysPull else 'asneeded',
+        },
+        title='Pulling and caching docker image %s' % image,
+        type=DockerResource.jobType,
+        user=adminUser,
+        public=True,
+        asynchronous=True
+    )
+    job = Job().save(job)
+    t = threading.Thread(target=jobPullAndLoad, args=(job, ))
+    t.start()
+    job, lines = tail_job_log(job, t, image)
+    if not lines:
+        logger.warning('Job record: %r', job)
+    logger.info('%s: %s in %5.3f s', image,
+                'loaded' if job['status'] == JobStatus.SUCCESS else 'failed',
+                time.time() - start)
+    return job
+
+
+def get_slicer_images(imageList, adminUser, alwaysPull=False, concurrency=2):
+    """
+    Load a list of cli docker images into the system.  Each image is pulled
+    and loaded by a separate job, running up to concurrency jobs at once.
+
+    :param imageList: a list of docker images or a dictionary of docker images
+        where the values are the alwaysPull flag for each image.
+    :param adminUser: an admin user for permissions.
+    :param alwaysPull: true to ask to always pull the latest image.  Only used
+        if imageList is a list.
+    :param concurrency: the maximum number of images to pull at once.
+    """
+    import concurrent.futures
+
+    from girder_jobs.constants import JobStatus
+
+    if not isinstance(imageList, dict):
+        imageList = dict.fromkeys(imageList, alwaysPull)
+    images = {entry: pull for entry, pull in imageList.items() if entry and len(entry)}
+    if not len(images):
+        return
+    logger.info('Pulling and installing slicer_cli images: %r', list(images))
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(concurrency or 1))) as pool:
+        futures = {pool.submit(load_slicer_image, image, adminUser, pull): image
+                   for image, pull in images.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                if future.result()['status'] != JobStatus.SUCCESS:
+                    failed.append(futures[future])
+            except Exception:
+                logger.exception('Failed to load %s', futures[future])
+                failed.append(futures[future])
+    if failed:
+        raise Exception('Failed to pull and load images: %r' % failed)
+
+
+def vcs_commit(url):
+    """
+    Resolve the commit of a git requirement url.
+
+    :param url: a url of the form git+<repo>[@<ref>][#<fragment>].
+    :returns: the commit hash or None if it cannot be determined.
+    """
+    repo = url.split('#', 1)[0][len('git+'):]
+    ref = 'HEAD'
+    if '@' in repo.rsplit('/', 1)[-1]:
+        repo, ref = repo.rsplit('@', 1)
+    if re.fullmatch(r'[0-9a-f]{40}', ref):
+        return ref
+    try:
+        output = subprocess.check_output(
+            ['git', 'ls-remote', repo, ref], text=True, stderr=subprocess.DEVNULL,
+            timeout=60)
+    except Exception:
+        return None
+    return output.split()[0] if output.strip() else None
+
+
+def vcs_requirement(entry):
+    """
+    Check if a pip entry is a single git requirement.
+
+    :param entry: a pip install entry.
+    :returns: the git url or None.
+    """
+    url = entry.split(' @ ', 1)[-1].strip()
+    if url.startswith('git+') and ' ' not in url:
+        return url
+    return None
+
+
+class Wheelhouse:
+    """
+    A directory of wheels shared between containers.  Pip's cache is kept in
+    it, and git requirements are built into wheels once per commit.  Each
+    commit's wheel is kept in its own subdirectory, since wheels built from
+    different commits usually have the same file name.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'cache'), exist_ok=True)
+        self.indexPath = os.path.join(root, 'vcs_index.json')
+
+    @contextlib.contextmanager
+    def locked(self):
+        import fcntl
+
+        with open(os.path.join(self.root, '.lock'), 'w') as fptr:
+            fcntl.flock(fptr, fcntl.LOCK_EX)
+            yield
+
+    def _index(self):
+        import json
+
+        try:
+            with open(self.indexPath) as fptr:
+                return json.load(fptr)
+        except (OSError, ValueError):
+            return {}
+
+    def vcs_wheel(self, url, commit, build=False):
+        """
+        Get the wheel built from a git requirement at a specific commit.
+
+        :param url: the git requirement url.
+        :param commit: the resolved commit.
+        :param build: if True and there is no wheel, build one.
+        :returns: the path to the wheel or None.
+        """
+        import json
+
+        base, _, fragment = url.partition('#')
+        repo = base.rsplit('@', 1)[0] if '@' in base.rsplit('/', 1)[-1] else base
+        key = '%s@%s#%s' % (repo, commit, fragment)
+        with self.locked():
+            wheel = self._index().get(key)
+            if wheel and os.path.exists(os.path.join(self.root, wheel)):
+                return os.path.join(self.root, wheel)
+            if not build:
+                return None
+            builddir = tempfile.mkdtemp(dir=self.root)
+            try:
+                pinned = '%s@%s%s' % (repo, commit, '#' + fragment if fragment else '')
+                logger.info('Building wheel for %s', pinned)
+                subprocess.check_call(
+                    [sys.executable, '-m', 'pip', 'wheel', '-q', '--no-deps',
+                     '--wheel-dir', builddir, pinned], env=self.environ())
+                wheel = os.listdir(builddir)[0]
+                os.makedirs(os.path.join(self.root, 'vcs', commit), exist_ok=True)
+                wheel = os.path.join('vcs', commit, wheel)
+                os.replace(os.path.join(builddir, os.path.basename(wheel)),
+                           os.path.join(self.root, wheel))
+            finally:
+                shutil.rmtree(builddir, ignore_errors=True)
+            index = self._index()
+            index[key] = wheel
+            with open(self.indexPath + '.tmp', 'w') as fptr:
+                json.dump(index, fptr, indent=2)
+            os.replace(self.indexPath + '.tmp', self.indexPath)
+        return os.path.join(self.root, wheel)
+
+    def environ(self):
+        return dict(os.environ, PIP_CACHE_DIR=os.path.join(self.root, 'cache'),
+                    PIP_FIND_LINKS=self.root)
+
+
+def wheel_installed(wheel):
+    """
+    Check if a distribution was installed from a specific wheel file.  A
+    version check isn't enough for wheels built from git requirements, since
+    different commits usually have the same version.
+
+    :param wheel: the path to the wheel.
+    :returns: True if the installed distribution's direct_url.json refers to
+        the wheel.
+    """
+    import importlib.metadata
+    import json
+    import pathlib
+
+    name = os.path.basename(wheel).split('-')[0]
+    try:
+        info = json.loads(importlib.metadata.distribution(name).read_text(
+            'direct_url.json') or '{}')
+    except Exception:
+        return False
+    return info.get('url') == pathlib.Path(wheel).resolve().as_uri()
+
+
+def vcs_requirement_satisfied(entry, url, wheelhouse=None):
+    """
+    Check if a git requirement is installed at the commit it refers to.
+
+    :param entry: the pip install entry.
+    :param url: the git url of the entry.
+    :param wheelhouse: an optional Wheelhouse.
+    :returns: True if pip does not need to install this entry.
+    """
+    import importlib.metadata
+    import json
+
+    commit = vcs_commit(url)
+    if not commit:
+        return False
+    if wheelhouse is not None:
+        wheel = wheelhouse.vcs_wheel(url, commit)
+        return bool(wheel) and wheel_installed(wheel)
+    egg = re.search(r'[#&]egg=([^&]+)', url)
+    name = entry.split(' @ ', 1)[0] if ' @ ' in entry else egg and egg.group(1)
+    try:
+        info = json.loads(importlib.metadata.distribution(name).read_text(
+            'direct_url.json') or '{}')
+    except Exception:
+        return False
+    return info.get('vcs_info', {}).get('commit_id') == commit
+
+
+def requirement_satisfied(entry, wheelhouse=None):
+    """
+    Check if a pip entry is already installed at a satisfying version without
+    running pip.  Entries with options or non-git urls are never considered
+    satisfied.
+
+    :param entry: a pip install entry.
+    :param wheelhouse: an optional Wheelhouse.
+    :returns: True if pip does not need to install this entry.
+    """
+    import importlib.metadata
+
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        from pip._vendor.packaging.requirements import Requirement
+
+    if vcs_requirement(entry):
+        return vcs_requirement_satisfied(entry, vcs_requirement(entry), wheelhouse)
+    try:
+        reqs = [Requirement(token) for token in shlex.split(entry)]
+    except Exception:
+        return False
+    for req in reqs:
+        if req.url:
+            return False
+        if req.marker and not req.marker.evaluate():
+            continue
+        try:
+            version = importlib.metadata.version(req.name)
+        except importlib.metadata.PackageNotFoundError:
+            return False
+        if not req.specifier.contains(version, prereleases=True):
+            return False
+        if req.extras and not extras_satisfied(req):
+            return False
+    return True
+
+
+def extras_satisfied(req):
+    """
+    Check if the requirements added by a requirement's extras are installed.
+
+    :param req: a packaging Requirement of an installed distribution.
+    :returns: True if all of the extra requirements are satisfied.
+    """
+    import importlib.metadata
+
+    try:
+        from packaging.requirements import Requirement
+    except ImportError:
+        from pip._vendor.packaging.requirements import Requirement
+
+    for extraReq in map(Requirement, importlib.metadata.requires(req.name) or []):
+        if extraReq.marker and any(
+                extraReq.marker.evaluate({'extra': extra}) for extra in req.extras):
+            extraReq.marker = None
+            if not requirement_satisfied(str(extraReq)):
+                return False
+    return True
+
+
+def pip_install(packages, wheelhouse=None):
+    """
+    Pip install a list of packages via the shell pip install command.  This
+    first tries installing all of the packages in a single command; if it
+    fails, they are tried individually to betetr show where the failure occurs.
+
+    If every package is already installed at a satisfying version, pip is not
+    run.  If a wheelhouse directory is specified, pip uses it for its cache and
+    to find packages, and git requirements are installed from wheels built
+    once per commit.
+
+    :param packages: a list of strings to add to the end of the pip install
+        command.
+    :param wheelhouse: an optional directory shared between containers.
+    """
+    if not packages or not len(packages):
+        return
+    wheelhouse = Wheelhouse(wheelhouse) if wheelhouse else None
+    if all(requirement_satisfied(entry, wheelhouse) for entry in packages):
+        logger.info('Already installed: %s', ' '.join(packages))
+        return
+    env = None
+    wheels = []
+    if wheelhouse is not None:
+        env = wheelhouse.environ()
+        resolved = []
+        for entry in packages:
+            url = vcs_requirement(entry)
+            commit = vcs_commit(url) if url else None
+            if commit:
+                wheels.append(wheelhouse.vcs_wheel(url, commit, build=True))
+                entry = shlex.quote(wheels[-1])
+            resolved.append(entry)
+        packages = resolved
+    cmd = 'pip install -q ' + ' '.join(packages)
+    logger.info('Installing: %s', cmd)
+    try:
+        subprocess.check_call(cmd, shell=True, env=env)
+    except Exception:
+        logger.error(f'Failed to run {cmd}; trying pip install individually.')
+        for entry in packages:
+            cmd = 'pip install %s' % entry
+            logger.info('Installing: %s', cmd)
+            try:
+                subprocess.check_call(cmd, shell=True, env=env)
+            except Exception:
+                logger.error(f'Failed to run {cmd}')
+                raise
+    # pip keeps an installed distribution with the same version as a wheel
+    # built from a different commit, so reinstall those wheels without
+    # touching their dependencies.
+    wheels = [wheel for wheel in wheels if not wheel_installed(wheel)]
+    if wheels:
+        cmd = 'pip install -q --force-reinstall --no-deps ' + ' '.join(map(shlex.quote, wheels))
+        logger.info('Installing: %s', cmd)
+        subprocess.check_call(cmd, shell=True, env=env)
+
+
+def run_shell_commands(commands):
+    """
+    Run a list of shell commands in order, stopping on the first failure.
+
+    :param commands: a list of shell command strings.
+    """
+    for cmd in commands or []:
+        logger.info('Running: %s', cmd)
+        try:
+            subprocess.check_call(cmd, shell=True)
+        except Exception:
+            logger.error(f'Failed to run {cmd}')
+            raise
+
+
+def source_checkout_key(url):
+    """
+    Identify the state of the git checkout of an editable distribution from
+    its commit and any uncommitted changes.
+
+    :param url: the file url of the editable distribution.
+    :returns: a string or None if the source is not a git checkout.
+    """
+    import hashlib
+    import urllib.parse
+
+    path = urllib.parse.unquote(urllib.parse.urlparse(url).path)
+    try:
+        commit = subprocess.check_output(
+            ['git', '-C', path, 'rev-parse', 'HEAD'], text=True,
+            stderr=subprocess.DEVNULL).strip()
+        changes = subprocess.check_output(
+            ['git', '-C', path, 'status', '--porcelain'], stderr=subprocess.DEVNULL)
+        changes += subprocess.check_output(
+            ['git', '-C', path, 'diff', 'HEAD'], stderr=subprocess.DEVNULL)
+    except Exception:
+        return None
+    return '%s+%s' % (commit, hashlib.sha256(changes).hexdigest()) if changes else commit
+
+
+def client_build_cache_key(opts):
+    """
+    Compute a key for the built girder client from the build mode and the
+    installed girder plugin distributions and their versions.  Editable
+    distributions are identified by the state of their git checkouts.
+
+    :param opts: the argparse options.
+    :returns: a hex digest or None if the build cannot be cached because a
+        plugin is installed in editable mode from a source that isn't a git
+        checkout.
+    """
+    import hashlib
+    import importlib.metadata
+    import json
+
+    mode = 'dev' if str(getattr(opts, 'rebuild-client', None)).lower().startswith(
+        'dev') else 'production'
+    dists = []
+    for dist in importlib.metadata.distributions():
+        name = (dist.metadata['Name'] or '').lower()
+        if name != 'girder' and not any(
+                ep.group == 'girder.plugin' for ep in dist.entry_points):
+            continue
+        try:
+            direct = json.loads(dist.read_text('direct_url.json') or '{}')
+        except ValueError:
+            direct = {}
+        if direct.get('dir_info', {}).get('editable'):
+            source = source_checkout_key(direct.get('url', ''))
+            if source is None:
+                logger.info('Not caching the girder build; %s is editable', name)
+                return None
+            dists.append('%s@%s' % (name, source))
+            continue
+        dists.append('%s==%s' % (name, dist.version))
+    return hashlib.sha256(json.dumps([mode, sorted(dists)]).encode()).hexdigest()
+
+
+def client_build_path():
+    from girder.constants import STATIC_ROOT_DIR
+
+    return os.path.join(STATIC_ROOT_DIR, 'built')
+
+
+def restore_client_build(path):
+    """
+    Replace the built girder client with a cached copy.
+
+    :param path: the path of the cached build.
+    :returns: True if the build was restored.
+    """
+    if not os.path.isdir(path):
+        return False
+    built = client_build_path()
+    logger.info('Restoring girder client build from %s', path)
+    shutil.rmtree(built + '.restore', ignore_errors=True)
+    shutil.copytree(path, built + '.restore', symlinks=True)
+    shutil.rmtree(built, ignore_errors=True)
+    os.replace(built + '.restore', built)
+    os.utime(path)
+    return True
+
+
+def store_client_build(path, keep=4):
+    """
+    Store the built girder client in the build cache, keeping only the most
+    recently used builds.
+
+    :param path: the path of the cached build.
+    :param keep: the number of cached builds to keep.
+    """
+    built = client_build_path()
+    if not os.path.isdir(built):
+        return
+    logger.info('Storing girder client build in %s', path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.rmtree(path + '.partial', ignore_errors=True)
+    shutil.copytree(built, path + '.partial', symlinks=True)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(path + '.partial', path)
+    entries = sorted((entry for entry in os.scandir(os.path.dirname(path))
+                      if entry.is_dir() and not entry.name.endswith('.partial')),
+                     key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def rebuild_client(opts):
+    """
+    Rebuild the girder client.  If the no_wait option is set, this is done in
+    a background process whose pid is written to /tmp/girder_build.pid.
+
+    Builds are cached by the set of installed girder plugins and the build
+    mode.  If there is a cached build for the current set, it is restored
+    instead of rebuilding.
+
+    :param opts: the argparse options.
+    """
+    cacheDir = getattr(opts, 'client-build-cache', None) or os.environ.get(
+        'DSA_CLIENT_BUILD_CACHE') or os.path.join(sys.prefix, 'share', 'girder', 'build_cache')
+    key = client_build_cache_key(opts) if cacheDir.lower() not in {'false', 'none'} else None
+    cachePath = os.path.join(cacheDir, key) if key else None
+    # Files from a prior background build can survive a container restart
+    for path in ('/tmp/girder_build.pid', '/tmp/girder_build_done'):
+        if os.path.exists(path):
+            os.unlink(path)
+    if cachePath and restore_client_build(cachePath):
+        return
+    cmd = 'girder build'
+    if str(getattr(opts, 'rebuild-client', None)).lower().startswith('dev'):
+        cmd += ' --dev'
+    logger.info('Rebuilding girder client: %s', cmd)
+    cmd = ('NPM_CONFIG_FUND=false NPM_CONFIG_AUDIT=false '
+           'NPM_CONFIG_AUDIT_LEVEL=high NPM_CONFIG_LOGLEVEL=error '
+           'NPM_CONFIG_PROGRESS=false NPM_CONFIG_PREFER_OFFLINE=true ' + cmd)
+    try:
+        if not getattr(opts, 'no_wait', False):
+            subprocess.check_call(cmd, shell=True)
+            if cachePath:
+                store_client_build(cachePath)
+        else:
+            if cachePath:
+                cmd += ' && %s %s --store-client-build %s' % (
+                    shlex.quote(sys.executable), shlex.quote(os.path.abspath(__file__)),
+                    shlex.quote(cachePath))
+            proc = subprocess.Popen(cmd + ' ; touch /tmp/girder_build_done', shell=True)
+            logger.info('Rebuilding in background via pid %r', proc.pid)
+            open('/tmp/girder_build.pid', 'w').write(str(proc.pid))
+    except Exception:
+        logger.error(f'Failed to run {cmd}')
+        raise
+
+
+def is_build_process(pid):
+    """
+    Check if a process is a running girder client build.  A pid from a stale
+    pidfile may have been reused by an unrelated process.
+
+    :param pid: the process id.
+    :returns: True if the process is running girder build.
+    """
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as fptr:
+            cmdline = fptr.read().replace(b'\0', b' ')
+    except OSError:
+        return False
+    return b'girder build' in cmdline
+
+
+def wait_for_background_build(pidfile='/tmp/girder_build.pid',
+                              donefile='/tmp/girder_build_done'):
+    """
+    Wait for a girder build started by a separate preprovisioning process and
+    record its duration in the timing report.
+
+    :param pidfile: the path of the file with the build process id.
+    :param donefile: the path of the file created when the build finishes.
+    """
+    try:
+        with open(pidfile) as fptr:
+            pid = int(fptr.read().strip())
+    except (OSError, ValueError):
+        return
+    started = os.path.getmtime(pidfile)
+    done = os.path.exists(donefile) and os.path.getmtime(donefile) >= started
+    if not done and not is_build_process(pid):
+        logger.info('Girder build (pid %d) is not running', pid)
+        return
+    logger.info('Waiting for girder build (pid %d) to finish', pid)
+    while is_build_process(pid) and not os.path.exists(donefile):
+        time.sleep(0.1)
+    end = os.path.getmtime(donefile) if os.path.exists(donefile) else time.time()
+    timer.add_span('preprovision:build', started, end)
+
+
+def run_steps(steps):
+    """
+    Run provisioning steps concurrently as their dependencies complete.  Each
+    step is timed.  If a step fails, no further steps are started and the
+    exception is raised once running steps finish.
+
+    :param steps: a list of (name, dependencies, function) tuples.
+        Dependencies that are not the name of a step are ignored.
+    """
+    import concurrent.futures
+
+    names = {name for name, _deps, _func in steps}
+    pending = {name: (set(deps) & names, func) for name, deps, func in steps}
+    done = set()
+
+    def runStep(name, func):
+        with timer.span(name):
+            func()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(steps))) as pool:
+        running = {}
+        while pending or running:
+            for name, (deps, func) in list(pending.items()):
+                if deps <= done:
+                    logger.debug('Starting provisioning step %s', name)
+                    running[pool.submit(runStep, name, func)] = name
+                    del pending[name]
+            if not running:
+                raise Exception('Provisioning steps have unmet dependencies: %r' % list(pending))
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                done.add(name)
+
+
+def preprovision_steps(opts):
+    """
+    List the preprovisioning steps and their dependencies.  Shell commands
+    run after pip installs, and the client is rebuilt after both.
+
+    :param opts: the argparse options.
+    :returns: a list of steps for run_steps.
+    """
+    steps = [
+        ('preprovision:pip', [], lambda: pip_install(
+            getattr(opts, 'pip', None), getattr(opts, 'pip-wheelhouse', None) or
+            os.environ.get('DSA_PIP_WHEELHOUSE'))),
+        ('preprovision:shell', ['preprovision:pip'],
+         lambda: run_shell_commands(getattr(opts, 'shell', None))),
+    ]
+    if getattr(opts, 'rebuild-client', None):
+        steps.append(('preprovision:build', ['preprovision:pip', 'preprovision:shell'],
+                      lambda: rebuild_client(opts)))
+    return steps
+
+
+@contextlib.contextmanager
+def exclusive_lock(path):
+    """
+    Try to take an exclusive lock on a file without waiting.  The lock is
+    released when the context exits or the process ends.
+
+    :param path: the path of the lock file.
+    :yields: True if the lock was taken, False if another process holds it.
+    """
+    import fcntl
+
+    with open(path, 'a') as fptr:
+        try:
+            fcntl.flock(fptr, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+class DeleteLockReaper:
+    """
+    Remove old delete locks from filesystem assetstore roots.  Directories
+    are scanned in parallel and filesystem operations are rate limited.  Only
+    one reaper runs at a time; it holds an exclusive lock on lockPath.
+    """
+
+    lockPath = '/tmp/dsa_delete_lock_reaper.lock'
+
+    def __init__(self, roots, maxAge=3 * 3600, rate=1000, concurrency=4):
+        """
+        :param roots: a list of assetstore root directories.
+        :param maxAge: delete locks older than this many seconds are removed.
+        :param rate: the maximum number of directory scans and file removals
+            per second.  0 for no limit.
+        :param concurrency: the number of directories to scan at once.
+        """
+        self.roots = roots
+        self.maxAge = maxAge
+        self.rate = rate
+        self.concurrency = max(1, int(concurrency or 1))
+        self._lock = threading.Lock()
+        self._nextOp = 0
+
+    def _throttle(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._nextOp = max(self._nextOp + 1.0 / self.rate, now)
+            delay = self._nextOp - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def _scan(self, path, pending, cutoff, stats):
+        self._throttle()
+        counts = {'directories': 1, 'locks': 0, 'removed': 0}
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.put(entry.path)
+                elif entry.name.endswith('.deleteLock') and entry.is_file(follow_symlinks=False):
+                    counts['locks'] += 1
+                    # If the lock is freshened between this check and the
+                    # removal, the lock is still removed.  As with the prior
+                    # find-based removal, this is deemed an acceptable risk.
+                    if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                        self._throttle()
+                        os.unlink(entry.path)
+                        counts['removed'] += 1
+        with self._lock:
+            for key, value in counts.items():
+                stats[key] += value
+
+    def reap(self):
+        """
+        Scan all roots once and remove old delete locks.
+
+        :returns: a dictionary of statistics.
+        """
+        import queue
+
+        start = time.time()
+        cutoff = start - self.maxAge
+        stats = {'directories': 0, 'locks': 0, 'removed': 0, 'errors': 0}
+        pending = queue.Queue()
+        for root in self.roots:
+            pending.put(root)
+
+        def worker():
+            while True:
+                path = pending.get()
+                if path is None:
+                    return
+                try:
+                    self._scan(path, pending, cutoff, stats)
+                except OSError:
+                    with self._lock:
+                        stats['errors'] += 1
+                finally:
+                    pending.task_done()
+
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        pending.join()
+        for thread in threads:
+            pending.put(None)
+        stats['duration'] = time.time() - start
+        logger.info(
+            'Removed %d of %d delete locks in %d directories of %s in %5.3f s '
+            '(%d errors)', stats['removed'], stats['locks'], stats['directories'],
+            ', '.join(self.roots), stats['duration'], stats['errors'])
+        return stats
+
+    def run(self, interval):
+        """
+        Reap delete locks periodically.
+
+        :param interval: the number of seconds between scans.  If 0, only scan
+            once.
+        """
+        with exclusive_lock(self.lockPath) as locked:
+            if not locked:
+                logger.info('Another process is already removing old delete locks')
+                return
+            while True:
+                self.reap()
+                if not interval:
+                    return
+                time.sleep(interval)
+
+
+def clean_delete_locks(interval=3600, rate=1000):
+    """
+    Start a background process that periodically removes delete locks that
+    are more than 3 hours old from filesystem assetstores, unless one is
+    already running.
+
+    :param interval: the number of seconds between scans.  If 0, the
+        assetstores are only scanned once.
+    :param rate: the maximum number of filesystem operations per second.
+    """
+    from girder.constants import AssetstoreType
+    from girder.models.assetstore import Assetstore
+
+    roots = [assetstore['root'] for assetstore in Assetstore().find()
+             if assetstore['type'] == AssetstoreType.FILESYSTEM]
+    if not roots:
+        return
+    with exclusive_lock(DeleteLockReaper.lockPath) as locked:
+        if not locked:
+            logger.info('Old delete locks are already being removed in the background')
+            return
+    cmd = [sys.executable, os.path.abspath(__file__), '-v',
+           '--delete-lock-interval', str(int(interval or 0)),
+           '--delete-lock-rate', str(int(rate or 0))]
+    for root in roots:
+        cmd.extend(['--reap-delete-locks', root])
+    logger.info(f'Removing old delete locks in the background: {cmd}')
+    try:
+        subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=None, stderr=None,
+            start_new_session=True, close_fds=True)
+    except Exception:
+        logger.info(f'Failed trying to remove old delete locks: {cmd}')
+
+
+def current_settings(keys):
+    """
+    Get the current values of a list of settings with a single query.  As
+    with Setting().get, environment overrides take precedence and unset
+    settings report their default values.
+
+    :param keys: a list of setting keys.
+    :returns: a dictionary of setting keys to a tuple of the current value,
+        the default value, and the stored setting document or None.
+    """
+    import json
+
+    from girder.models.setting import Setting
+
+    docs = {doc['key']: doc for doc in Setting().find({'key': {'$in': list(keys)}})}
+    results = {}
+    for key in keys:
+        default = Setting().getDefault(key)
+        envKey = f'GIRDER_SETTING_{key.replace(".", "_").upper()}'
+        if envKey in os.environ:
+            value = os.environ[envKey]
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        else:
+            value = docs[key]['value'] if key in docs else default
+        results[key] = (value, default, docs.get(key))
+    return results
+
+
+def plan_settings(settings, force, adminUser, strict=True):
+    """
+    Determine which settings need to change.  A setting is changed if it is
+    forced, unset, or its default value, unless the desired value is
+    "__SKIP__" or already matches.  Changes are validated, but not written.
+
+    :param settings: a dictionary of setting keys and desired values.
+    :param force: True to force all settings or a list of keys to force.
+    :param adminUser: the admin user used to resolve resource values.
+    :param strict: if False, settings whose values reference resources that
+        do not exist are reported as changing to their unresolved values
+        rather than raising an exception.
+    :returns: a dictionary of the validated setting documents that would
+        change, a list of skipped keys, a list of unchanged keys, and a
+        dictionary of the current values.
+    """
+    from girder import events
+    from girder.models.setting import Setting
+
+    current = current_settings(settings.keys())
+    changed, skipped, unchanged = {}, [], []
+    for key, value in settings.items():
+        curValue, default, doc = current[key]
+        if value == '__SKIP__' or not (
+                force is True or key in force or curValue is None or curValue == default):
+            skipped.append(key)
+            continue
+        try:
+            value = value_from_resource(value, adminUser)
+        except Exception:
+            if strict:
+                raise
+            changed[key] = {'key': key, 'value': value}
+            continue
+        if doc is not None and doc['value'] == value:
+            unchanged.append(key)
+            continue
+        setting = dict(doc or {'key': key}, value=value)
+        event = events.trigger('model.setting.validate', setting)
+        if not event.defaultPrevented:
+            setting = Setting().validate(setting)
+        changed[key] = setting
+    return changed, skipped, unchanged, {key: current[key][0] for key in current}
+
+
+def reconcile_settings(settings, force, adminUser):
+    """
+    Set settings that need to change as determined by plan_settings.  All
+    changes are validated before any are written, then they are written with
+    a single bulk operation.
+
+    :param settings: a dictionary of setting keys and desired values.
+    :param force: True to force all settings or a list of keys to force.
+    :param adminUser: the admin user used to resolve resource values.
+    :returns: a dictionary of the changed settings.
+    """
+    import pymongo
+    from girder import events
+    from girder.models.setting import Setting
+
+    changed, skipped, unchanged, _current = plan_settings(settings, force, adminUser)
+    for key, setting in changed.items():
+        logger.info('Setting %s to %r', key, setting['value'])
+    if changed:
+        Setting().collection.bulk_write([
+            pymongo.UpdateOne({'key': key}, {'$set': {'value': setting['value']}}, upsert=True)
+            for key, setting in changed.items()], ordered=False)
+        for key, setting in changed.items():
+            Setting()._get.invalidate(Setting(), key)
+            events.trigger('model.setting.save.after', setting)
+    logger.info('Settings: %d changed %r, %d skipped, %d unchanged',
+                len(changed), sorted(changed), len(skipped), len(unchanged))
+    logger.debug('Skipped settings: %r; unchanged settings: %r', skipped, unchanged)
+    return {key: setting['value'] for key, setting in changed.items()}
+
+
+def provision_fingerprint(opts):
+    """
+    Compute a fingerprint of the fully merged provisioning options, the
+    settings environment overrides, the mongo server version, and this script.
+
+    :param opts: the merged argparse options.
+    :returns: a hex digest.
+    """
+    import hashlib
+    import json
+
+    from girder.models import getDbConnection
+
+    ignore = {'portion', 'verbose', 'dry-run', 'full', 'no_wait', 'prewarm',
+              'cache-sizing', 'plan', 'apply'}
+    data = {
+        'opts': {k: v for k, v in vars(opts).items() if k not in ignore},
+        'environ': {k: v for k, v in os.environ.items() if k.startswith('GIRDER_SETTING_')},
+    }
+    # Manifests are read from files, so include when they changed
+    for spec in getattr(opts, 'manifests', None) or []:
+        try:
+            stat = os.stat(spec['path'])
+            data.setdefault('manifests', []).append([spec['path'], stat.st_size, stat.st_mtime])
+        except (OSError, KeyError, TypeError):
+            pass
+    try:
+        data['mongo'] = getDbConnection().server_info()['version']
+    except Exception:
+        pass
+    hasher = hashlib.sha256(json.dumps(data, sort_keys=True, default=lambda v: sorted(
+        v, key=str) if isinstance(v, (set, frozenset)) else repr(v)).encode())
+    try:
+        with open(__file__, 'rb') as fptr:
+            hasher.update(fptr.read())
+    except OSError:
+        pass
+    return hasher.hexdigest()
+
+
+def provision_state():
+    """
+    Get the database collection used to record provisioning state.
+
+    :returns: a pymongo collection.
+    """
+    from girder.models.setting import Setting
+
+    return Setting().database['dsa_provision']
+
+
+def provision_unchanged(fingerprint):
+    """
+    Check if the last successful main provisioning used the same inputs and
+    the basic invariants it established still hold.
+
+    :param fingerprint: the fingerprint of the current options.
+    :returns: True if main provisioning can be skipped.
+    """
+    from girder.models.assetstore import Assetstore
+    from girder.models.user import User
+
+    try:
+        record = provision_state().find_one({'_id': 'main'})
+    except Exception:
+        logger.warning('Could not read provisioning state.')
+        return False
+    if not record or record.get('fingerprint') != fingerprint:
+        return False
+    if User().findOne({'admin': True}) is None or Assetstore().findOne() is None:
+        logger.info('Provisioning inputs are unchanged, but the database is not.')
+        return False
+    return True
+
+
+def record_provision_fingerprint(fingerprint):
+    """
+    Record the fingerprint of a successful main provisioning.
+
+    :param fingerprint: the fingerprint of the current options.
+    """
+    try:
+        provision_state().update_one({'_id': 'main'}, {'$set': {
+            'fingerprint': fingerprint,
+            'updated': datetime.datetime.now(datetime.timezone.utc),
+        }}, upsert=True)
+    except Exception:
+        logger.warning('Could not record provisioning state.')
+
+
+def admin_params(opts):
+    """
+    Get the parameters used to create the admin user if there isn't one.
+
+    :param opts: the argparse options.
+    :returns: a dictionary of parameters for User().createUser.
+    """
+    return dict({
+        'login': 'admin',
+        'password': 'password',
+        'firstName': 'Admin',
+        'lastName': 'Admin',
+        'email': 'admin@nowhere.nil',
+        'public': True,
+    }, **(opts.admin if opts.admin else {}))
+
+
+def assetstore_params(opts):
+    """
+    Get the parameters used to create assetstores if there aren't any.
+
+    :param opts: the argparse options.
+    :returns: a list of dictionaries, each of which may have a 'method' key
+        with the name of the Assetstore model creation method.
+    """
+    assetstoreParams = opts.assetstore or {'name': 'Assetstore', 'root': '/assetstore'}
+    if not isinstance(assetstoreParams, list):
+        assetstoreParams = [assetstoreParams]
+    return copy.deepcopy(assetstoreParams)
+
+
+def plan_provision(opts):
+    """
+    Determine the admin user, assetstores, indexes, resources, metadata,
+    attrs, and settings that main provisioning would create or change without
+    modifying the database.
+
+    :param opts: the argparse options.
+    :returns: a plan dictionary with the fingerprint of the options and a
+        list of changes.
+    """
+    from girder.models.assetstore import Assetstore
+    from girder.models.user import User
+
+    changes = []
+    adminUser = User().findOne({'admin': True})
+    if adminUser is None:
+        changes.append({'type': 'admin', 'action': 'create',
+                        'login': admin_params(opts)['login']})
+    if Assetstore().findOne() is None:
+        changes.extend({'type': 'assetstore', 'action': 'create', 'name': params.get('name')}
+                       for params in assetstore_params(opts))
+    if getattr(opts, 'indexes', None):
+        changes.extend({'type': 'index', 'action': 'create', 'collection': collName,
+                        'keys': keys, 'options': options}
+                       for collName, keys, options in plan_indexes(opts.indexes))
+    if opts.resources:
+        with timer.span('plan_resources'):
+            changes.extend(plan_resource_changes(opts.resources, adminUser))
+    with timer.span('plan_settings'):
+        changed, _skipped, _unchanged, current = plan_settings(
+            dict({}, **(opts.settings or {})), getattr(opts, 'force', None) or [],
+            adminUser, strict=False)
+    changes.extend({'type': 'setting', 'action': 'update', 'key': key,
+                    'old': current.get(key), 'new': setting['value']}
+                   for key, setting in changed.items())
+    return {
+        'fingerprint': provision_fingerprint(opts),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'changes': changes,
+    }
+
+
+def apply_provision(opts, plan):
+    """
+    Apply only the changes in a plan from plan_provision.  The plan must have
+    been made with the same provisioning options.  Sample data, manifests,
+    imports, and the other provisioning steps are not run, so the
+    provisioning fingerprint is not recorded and the next full provisioning
+    run isn't skipped.
+
+    :param opts: the argparse options.
+    :param plan: a plan dictionary.
+    :returns: True if the plan was applied.
+    """
+    from girder.models.assetstore import Assetstore
+    from girder.models.user import User
+
+    if plan.get('fingerprint') != provision_fingerprint(opts):
+        logger.error('The provisioning options have changed since the plan '
+                     'was made; make a new plan.')
+        return False
+    changes = plan.get('changes', [])
+    types = {change['type'] for change in changes}
+    logger.info('Applying %d planned changes', len(changes))
+    if 'admin' in types and User().findOne({'admin': True}) is None:
+        User().createUser(admin=True, **admin_params(opts))
+    adminUser = User().findOne({'admin': True})
+    if 'assetstore' in types and Assetstore().findOne() is None:
+        for params in assetstore_params(opts):
+            method = params.pop('method', 'createFilesystemAssetstore')
+            getattr(Assetstore(), method)(**params)
+    if 'index' in types:
+        with timer.span('indexes'):
+            reconcile_indexes(opts.indexes, getattr(opts, 'index-wait', 60))
+    indices = sorted({change['index'] for change in changes
+                      if change['type'] in {'resource', 'metadata', 'attrs'}})
+    if indices:
+        with timer.span('provision_resources'):
+            provision_resources(
+                [opts.resources[idx] for idx in indices], adminUser,
+                getattr(opts, 'resource-concurrency', None) or 4)
+    keys = [change['key'] for change in changes if change['type'] == 'setting']
+    if keys:
+        with timer.span('settings'):
+            reconcile_settings({key: opts.settings[key] for key in keys}, keys, adminUser)
+    return True
+
+
+def plan_main(opts):
+    """
+    Configure the server and either report or apply a provisioning plan.
+
+    :param opts: the argparse options.
+    :returns: True if successful.
+    """
+    import json
+
+    from girder import _attachFileLogHandlers
+    from girder.utility.server import configureServer
+
+    with timer.span('configureServer'):
+        _attachFileLogHandlers()
+        configureServer()
+    if getattr(opts, 'apply', None):
+        with open(getattr(opts, 'apply')) as fptr:
+            plan = json.load(fptr)
+        return apply_provision(opts, plan)
+    plan = json.loads(json.dumps(plan_provision(opts), default=str))
+    counts = {}
+    for change in plan['changes']:
+        counts[change['type']] = counts.get(change['type'], 0) + 1
+    print(yaml.safe_dump(plan, sort_keys=False))
+    logger.warning('Planned %d changes: %r', len(plan['changes']), counts)
+    if opts.plan:
+        with open(opts.plan, 'w') as fptr:
+            json.dump(plan, fptr, indent=2)
+    return True
+
+
+def provision(opts, fast=False):
+    """
+    Provision the instance.
+
+    :param opts: the argparse options.
+    :param fast: if True, the provisioning inputs are unchanged since the last
+        run, so only clean delete locks and load slicer_cli images.
+    """
+    from girder.models.assetstore import Assetstore
+    from girder.models.user import User
+
+    # If there is are no admin users, create an admin user
+    if not fast and User().findOne({'admin': True}) is None:
+        User().createUser(admin=True, **admin_params(opts))
+    adminUser = User().findOne({'admin': True})
+
+    # Make sure we have an assetstore
+    if not fast and Assetstore().findOne() is None:
+        for params in assetstore_params(opts):
+            method = params.pop('method', 'createFilesystemAssetstore')
+            getattr(Assetstore(), method)(**params)
+
+    # Clean up old deleteLocks
+    if getattr(opts, 'clean-delete-locks', None):
+        with timer.span('clean_delete_locks'):
+            clean_delete_locks(getattr(opts, 'delete-lock-interval', 3600),
+                               getattr(opts, 'delete-lock-rate', 1000))
+
+    run_steps(provision_steps(opts, adminUser, fast))
+
+
+def provision_steps(opts, adminUser, fast=False):
+    """
+    List the database provisioning steps and their dependencies.  Sample
+    data is downloaded while resources and settings are provisioned, and
+    slicer_cli images are pulled and loaded as soon as the task folder
+    resources and settings exist, concurrently with manifests and imports.
+
+    :param opts: the argparse options.
+    :param adminUser: the admin user.
+    :param fast: if True, the provisioning inputs are unchanged since the last
+        run, so only imports and slicer_cli images are checked.
+    :returns: a list of steps for run_steps.
+    """
+    steps = []
+    if not fast:
+        samplePath = 'collection/%s' % str(getattr(opts, 'sample-collection', 'Samples')).lower()
+        if getattr(opts, 'samples', None):
+            # Make sure we have a demo collection and download some demo files
+            steps.append(('get_sample_data', [], lambda: get_sample_data(
+                adminUser,
+                getattr(opts, 'sample-collection', 'Samples'),
+                getattr(opts, 'sample-folder', 'Images'),
+                getattr(opts, 'sample-concurrency', None) or 4,
+                get_download_cache(opts))))
+        if opts.resources:
+            # Resources only wait for sample data if they refer to it
+            usesSamples = any(
+                ref == samplePath or ref.startswith(samplePath + '/')
+                for entry in opts.resources for value in entry.values()
+                for ref in resource_references(value))
+            steps.append(('provision_resources', ['get_sample_data'] if usesSamples else [],
+                          lambda: provision_resources(
+                              opts.resources, adminUser,
+                              getattr(opts, 'resource-concurrency', None) or 4)))
+
+        def settings():
+            reconcile_settings(
+                dict({}, **(opts.settings or {})), getattr(opts, 'force', None) or [],
+                adminUser)
+            logger.info('Resource path cache: %d hits, %d misses',
+                        resource_path_cache.hits, resource_path_cache.misses)
+
+        steps.append(('settings', ['provision_resources'], settings))
+        if getattr(opts, 'manifests', None):
+            steps.append(('manifests', ['get_sample_data', 'provision_resources'], lambda: [
+                load_manifest(spec, adminUser) for spec in opts.manifests]))
+    # Imports are incremental, so they are checked even if the provisioning
+    # inputs are unchanged.
+    if getattr(opts, 'imports', None):
+        steps.append(('imports', ['get_sample_data', 'provision_resources', 'manifests'],
+                      lambda: import_directories(opts.imports, adminUser)))
+    # Images that are always pulled take precedence over those only pulled
+    # when absent; both are scheduled together.
+    images = {}
+    for image in getattr(opts, 'slicer-cli-image-pull', None) or []:
+        images.setdefault(image, True)
+    for image in getattr(opts, 'slicer-cli-image', None) or []:
+        images.setdefault(image, False)
+    if images:
+        def slicerImages():
+            try:
+                get_slicer_images(
+                    images, adminUser,
+                    concurrency=getattr(opts, 'slicer-cli-concurrency', None) or 2)
+            except Exception:
+                logger.info('Cannot fetch slicer-cli-images.')
+
+        # The images are loaded into the task folder, which is a resource and
+        # a setting
+        steps.append(('get_slicer_images', ['provision_resources', 'settings'], slicerImages))
+    return steps
+
+
+def container_limits():
+    """
+    Detect the memory and cpu limits of this container from cgroups,
+    falling back to the host's resources.
+
+    :returns: a dictionary with memory (the bytes available to this
+        container), hostMemory (the total memory of the host), and cpus (the
+        number of cpus available to this container, possibly fractional).
+    """
+    hostMemory = None
+    try:
+        with open('/proc/meminfo') as fptr:
+            hostMemory = int(fptr.readline().split()[1]) * 1024
+    except Exception:
+        hostMemory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    memory = hostMemory
+    for path in ('/sys/fs/cgroup/memory.max',
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as fptr:
+                value = fptr.read().strip()
+        except OSError:
+            continue
+        # Unlimited cgroups report 'max' or a huge number
+        if value.isdigit() and int(value) < min(hostMemory, 10 ** 12):
+            memory = int(value)
+        break
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as fptr:
+            quota = fptr.read().split()
+    except OSError:
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as qptr, \
+                    open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as pptr:
+                quota = [qptr.read().strip(), pptr.read().strip()]
+        except OSError:
+            pass
+    if quota and len(quota) == 2 and quota[0].isdigit() and int(quota[1]) > 0:
+        cpus = min(cpus, max(1, int(quota[0]) / int(quota[1])))
+    return {'memory': memory, 'hostMemory': hostMemory, 'cpus': cpus}
+
+
+def cache_sizes(limits, proportion=0.125, maxBytes=None, serviceLimits=None):
+    """
+    Compute large_image cache settings that are consistent with the memory
+    available to this container.  large_image sizes its python caches as a
+    portion of the host's memory, so portions are scaled by the ratio of host
+    to container memory.
+
+    If the limits of the cache server's container (memcached or redis) are
+    given, its budget is also computed.  A cache server with its own memory
+    limit uses most of it; one without a limit uses the same portion of the
+    host's memory as the tile cache.
+
+    :param limits: the dictionary from container_limits.
+    :param proportion: the portion of memory to use for the tile cache.
+    :param maxBytes: the maximum size of the tile cache and of an unlimited
+        cache server or None for no maximum.
+    :param serviceLimits: an optional dictionary from service_limits for the
+        cache server.
+    :returns: a dictionary with the tile cache budget in bytes, a dictionary
+        of large_image config values, and, if serviceLimits were given, the
+        cache server budget in bytes as cache_server.
+    """
+    memory, hostMemory = limits['memory'], limits['hostMemory']
+    budget = int(memory * proportion)
+    if maxBytes:
+        budget = min(budget, int(maxBytes))
+    budget = max(1, budget)
+    sizes = {
+        'budget': budget,
+        'large_image': {
+            'cache_python_memory_portion': max(2, int(math.ceil(hostMemory / budget))),
+            'cache_tilesource_memory_portion': max(
+                2, int(math.ceil(16 * hostMemory / memory))),
+            'cache_tilesource_maximum': max(
+                16, min(512, int(memory // (128 * 1024 ** 2)))),
+        },
+    }
+    if serviceLimits:
+        if serviceLimits['memory'] < serviceLimits['hostMemory']:
+            # Leave room for the server's own connection and item overhead
+            server = int(serviceLimits['memory'] * 0.8)
+        else:
+            server = int(serviceLimits['hostMemory'] * proportion)
+            if maxBytes:
+                server = min(server, int(maxBytes))
+        sizes['cache_server'] = max(64 * 1024 ** 2, server)
+    return sizes
+
+
+def service_limits(host):
+    """
+    Find the memory limit of the docker container running a service, such
+    as the cache server, from the docker daemon.
+
+    :param host: the service's host name, such as the docker compose service
+        name.
+    :returns: a dictionary with memory (the container's limit or the docker
+        host's memory if it is unlimited) and hostMemory, or None if the
+        container can't be found.
+    """
+    try:
+        import docker
+
+        client = docker.from_env()
+        hostMemory = client.info()['MemTotal']
+        for container in client.containers.list():
+            if host in {container.name, container.labels.get('com.docker.compose.service'),
+                        container.attrs.get('Config', {}).get('Hostname')}:
+                memory = container.attrs.get('HostConfig', {}).get('Memory') or hostMemory
+                return {'memory': min(memory, hostMemory), 'hostMemory': hostMemory}
+    except Exception as exc:
+        logger.info('Could not determine the limits of %s: %s', host, exc)
+    return None
+
+
+def cache_server_hosts(urls, port):
+    """
+    Split a comma-separated list of cache server urls.
+
+    :param urls: a list of host[:port] values, optionally with a scheme.
+    :param port: the default port.
+    :returns: a list of (host, port) tuples.
+    """
+    hosts = []
+    for url in str(urls).split(','):
+        url = url.strip().split('://', 1)[-1].split('/', 1)[0].rsplit('@', 1)[-1]
+        host, _, hostPort = url.partition(':')
+        if host:
+            hosts.append((host, int(hostPort or port)))
+    return hosts
+
+
+def set_cache_server_limit(backend, urls, budget):
+    """
+    Set the memory limit of running memcached or redis servers.
+
+    :param backend: 'memcached' or 'redis'.
+    :param urls: a comma-separated list of host[:port] values.
+    :param budget: the memory limit in bytes.
+    """
+    import socket
+
+    if backend == 'redis':
+        command, port = b'CONFIG SET maxmemory %d\r\n' % budget, 6379
+    else:
+        command, port = b'cache_memlimit %d\r\n' % max(1, budget // 1024 ** 2), 11211
+    for host, hostPort in cache_server_hosts(urls, port):
+        try:
+            with socket.create_connection((host, hostPort), timeout=5) as sock:
+                sock.sendall(command)
+                response = sock.recv(256).strip()
+        except Exception as exc:
+            logger.info('Could not set %s limit on %s: %s', backend, host, exc)
+            continue
+        logger.info('Set %s limit on %s to %d MB: %s', backend, host,
+                    budget // 1024 ** 2, response.decode(errors='replace'))
+
+
+def update_user_girder_config(section, values):
+    """
+    Set values in the user's girder config file.  Girder reads this file
+    after /etc/girder.cfg, so these values take precedence.
+
+    :param section: the config section.
+    :param values: a dictionary of keys and python values.  Keys with a value
+        of None are removed.
+    :returns: True if the file was changed.
+    """
+    path = os.path.join(os.path.expanduser('~'), '.girder', 'girder.cfg')
+    conf = configparser.ConfigParser()
+    conf.read([path])
+    if not conf.has_section(section):
+        conf.add_section(section)
+    changed = False
+    for key, value in values.items():
+        if value is None:
+            changed = conf.remove_option(section, key) or changed
+        elif conf.get(section, key, fallback=None) != repr(value):
+            conf.set(section, key, repr(value))
+            changed = True
+    if changed:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fptr:
+            conf.write(fptr)
+    return changed
+
+
+def size_caches(opts):
+    """
+    Size the large_image caches based on the container's limits.  The
+    computed large_image values are written to the user's girder config file,
+    which takes precedence over /etc/girder.cfg, except for values that are
+    explicitly set in /etc/girder.cfg.  The memcached or redis memory limit
+    is computed from the limits of the cache server's own container.  Values
+    in the cache-sizing option take precedence over computed values.
+
+    :param opts: the argparse options.
+    """
+    sizing = getattr(opts, 'cache-sizing', None)
+    if sizing is False:
+        update_user_girder_config('large_image', dict.fromkeys((
+            'cache_python_memory_portion', 'cache_tilesource_memory_portion',
+            'cache_tilesource_maximum')))
+        return
+
+    from girder.utility import config
+
+    sizing = sizing if isinstance(sizing, dict) else {}
+    largeImageConfig = config.getConfig().get('large_image', {})
+    backend = largeImageConfig.get('cache_backend', 'memcached')
+    urls = largeImageConfig.get('cache_%s_url' % backend)
+    override = sizing.get(backend)
+    serviceLimits = None
+    if backend in {'memcached', 'redis'} and urls and override is None:
+        serviceLimits = service_limits(cache_server_hosts(urls, 0)[0][0])
+    limits = container_limits()
+    sizes = cache_sizes(limits, sizing.get('proportion', 0.125), sizing.get('max-bytes'),
+                        serviceLimits)
+    values = sizes['large_image']
+    values.update(sizing.get('large_image') or {})
+    explicit = configparser.ConfigParser()
+    explicit.read(['/etc/girder.cfg'])
+    if explicit.has_section('large_image'):
+        values = {k: v for k, v in values.items()
+                  if not explicit.has_option('large_image', k)}
+    logger.info('Detected %d MB memory and %g cpus; large_image cache '
+                'settings: %r', limits['memory'] // 1024 ** 2, limits['cpus'], values)
+    update_user_girder_config('large_image', values)
+    if override is not None and not isinstance(override, bool):
+        serverBudget = int(override)
+    elif override is not False:
+        serverBudget = sizes.get('cache_server')
+    else:
+        serverBudget = None
+    if backend in {'memcached', 'redis'} and urls and serverBudget:
+        set_cache_server_limit(backend, urls, serverBudget)
+
+
+def available_compressors():
+    """
+    List the mongo wire compressors that pymongo can use in this
+    environment, most preferred first.
+
+    :returns: a list of compressor names.
+    """
+    import importlib.util
+
+    compressors = []
+    for name, module in (('zstd', 'zstandard'), ('snappy', 'snappy'), ('zlib', 'zlib')):
+        if importlib.util.find_spec(module) is not None:
+            compressors.append(name)
+    return compressors
+
+
+def tuned_database_uri(uri, settings, maxConns):
+    """
+    Add connection pool, compression, and read preference options to a mongo
+    URI.
+
+    :param uri: the current database URI.
+    :param settings: the database option dictionary.  processes is the
+        number of processes that share the database server's connections,
+        connection-portion is the portion of the server's connections they
+        may use, compressors is a list of wire compressors or 'auto',
+        readPreference is passed through, and options is a dictionary of
+        additional URI options.
+    :param maxConns: the maximum number of connections the server accepts.
+    :returns: the tuned URI.
+    """
+    import urllib.parse
+
+    processes = max(1, int(settings.get('processes', 4)))
+    maxPoolSize = max(10, int(maxConns * settings.get('connection-portion', 0.8) / processes))
+    params = {
+        'maxPoolSize': maxPoolSize,
+        'minPoolSize': min(maxPoolSize, max(0, int(settings.get('min-pool-size', 2)))),
+    }
+    compressors = settings.get('compressors', 'auto')
+    if compressors == 'auto':
+        compressors = available_compressors()
+    if compressors:
+        params['compressors'] = ','.join(compressors)
+    if settings.get('readPreference'):
+        params['readPreference'] = settings['readPreference']
+    params.update(settings.get('options') or {})
+    parts = urllib.parse.urlsplit(uri)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    query.update({k: str(v).lower() if isinstance(v, bool) else str(v)
+                  for k, v in params.items()})
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query, safe=',')))
+
+
+def server_max_connections(db):
+    """
+    Get the maximum number of connections the database server accepts.
+
+    :param db: a pymongo database.
+    :returns: the number of connections.
+    """
+    connections = db.client.admin.command('serverStatus')['connections']
+    return connections['current'] + connections['available']
+
+
+def base_database_uri():
+    """
+    Get the database URI without tuning from the GIRDER_MONGO_URI
+    environment variable or /etc/girder.cfg.
+
+    :returns: the URI or None.
+    """
+    import ast
+
+    if os.environ.get('GIRDER_MONGO_URI'):
+        return os.environ['GIRDER_MONGO_URI']
+    conf = configparser.ConfigParser()
+    conf.read(['/etc/girder.cfg'])
+    if conf.has_option('database', 'uri'):
+        return ast.literal_eval(conf.get('database', 'uri'))
+    return None
+
+
+def tune_database(opts):
+    """
+    Write a database URI tuned by the database option to the user's girder
+    config file.
+
+    :param opts: the argparse options.
+    :returns: the original and tuned URIs, or None if not tuned.
+    """
+    from girder.models.setting import Setting
+    from girder.utility import config
+
+    settings = getattr(opts, 'database', None)
+    if not settings:
+        update_user_girder_config('database', {'uri': None})
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    uri = base_database_uri() or config.getConfig()['database']['uri']
+    try:
+        maxConns = server_max_connections(Setting().database)
+    except Exception:
+        logger.warning('Could not determine the maximum database connections.')
+        return None
+    tuned = tuned_database_uri(uri, settings, maxConns)
+    logger.info('Database accepts %d connections; using %s', maxConns, tuned)
+    if 'GIRDER_MONGO_URI' in os.environ:
+        logger.warning('GIRDER_MONGO_URI is set and takes precedence over the '
+                       'tuned database URI.')
+    update_user_girder_config('database', {'uri': tuned})
+    return uri, tuned
+
+
+def benchmark_database(uri, count=200):
+    """
+    Measure the latency of typical girder queries using a database URI.
+
+    :param uri: the database URI.
+    :param count: the number of times to run each query.
+    :returns: a dictionary of query names to a dictionary of the median and
+        95th percentile latency in milliseconds.
+    """
+    import pymongo
+
+    client = pymongo.MongoClient(uri)
+    db = client.get_default_database()
+    folder = db.folder.find_one({}, projection=['_id']) or {}
+    queries = {
+        'setting': lambda: db.setting.find_one({'key': 'core.brand_name'}),
+        'folder_items': lambda: list(db.item.find(
+            {'folderId': folder.get('_id')}, limit=50)),
+        'child_folders': lambda: list(db.folder.find(
+            {'parentId': folder.get('_id')}, limit=50)),
+        'count_items': lambda: db.item.count_documents({'folderId': folder.get('_id')}),
+    }
+    results = {}
+    try:
+        for name, query in queries.items():
+            query()
+            times = []
+            for _ in range(count):
+                start = time.perf_counter()
+                query()
+                times.append((time.perf_counter() - start) * 1000)
+            times.sort()
+            results[name] = {'p50': times[len(times) // 2],
+                             'p95': times[min(len(times) - 1, int(len(times) * 0.95))]}
+    finally:
+        client.close()
+    return results
+
+
+def database_benchmark_main(opts):
+    """
+    Configure the server and report query latency with the current and the
+    tuned database URIs.
+
+    :param opts: the argparse options.
+    """
+    from girder import _attachFileLogHandlers
+    from girder.utility.server import configureServer
+
+    with timer.span('configureServer'):
+        _attachFileLogHandlers()
+        configureServer()
+    uris = tune_database(opts)
+    if uris is None:
+        logger.warning('Specify the database option to compare tuned settings.')
+        return
+    for label, uri in zip(('before', 'after'), uris):
+        with timer.span('benchmark-' + label):
+            results = benchmark_database(uri)
+        for name, result in results.items():
+            print('%-6s %-14s p50 %7.3f ms  p95 %7.3f ms' % (
+                label, name, result['p50'], result['p95']))
+
+
+# Index directions that are strings rather than 1 or -1
+INDEX_DIRECTIONS = {'2d', '2dsphere', 'geoHaystack', 'hashed', 'text'}
+
+
+def index_spec(entry):
+    """
+    Normalize an entry from the indexes option.
+
+    :param entry: a field name, a single [field, direction] pair, a list of
+        field names or [field, direction] pairs, or a dictionary with 'keys'
+        in one of those forms and optional create_index options such as
+        'name', 'unique', or 'sparse'.
+    :returns: a list of (field, direction) tuples and a dictionary of
+        options.
+    """
+    options = {}
+    keys = entry
+    if isinstance(entry, dict):
+        keys = entry['keys']
+        options = {k: v for k, v in entry.items() if k != 'keys'}
+    if isinstance(keys, str):
+        keys = [keys]
+    if (isinstance(keys, (list, tuple)) and len(keys) == 2 and isinstance(keys[0], str) and (
+            (isinstance(keys[1], int) and not isinstance(keys[1], bool)) or
+            keys[1] in INDEX_DIRECTIONS)):
+        keys = [keys]
+    if isinstance(keys, dict):
+        keys = list(keys.items())
+    return [(key, 1) if isinstance(key, str) else tuple(key) for key in keys], options
+
+
+def plan_indexes(indexes):
+    """
+    Determine which indexes from the indexes option do not exist.  An index
+    exists if any index on the collection has the same keys.
+
+    :param indexes: a dictionary of collection names to lists of index
+        entries.
+    :returns: a list of (collection name, keys, options) tuples of missing
+        indexes.
+    """
+    from girder.models.setting import Setting
+
+    db = Setting().database
+    missing = []
+    for collName, entries in (indexes or {}).items():
+        existing = [[tuple(key) for key in info['key']]
+                    for info in db[collName].index_information().values()]
+        for entry in entries or []:
+            keys, options = index_spec(entry)
+            if keys not in existing:
+                missing.append((collName, keys, options))
+    return missing
+
+
+def index_build_progress(db):
+    """
+    Get the progress of index builds that are in progress.
+
+    :param db: the pymongo database.
+    :returns: a list of strings describing each build.
+    """
+    try:
+        ops = db.client.admin.aggregate([
+            {'$currentOp': {'allUsers': True}},
+            {'$match': {'command.createIndexes': {'$exists': True}}}])
+        return ['%s: %s' % (op['command']['createIndexes'], op.get('msg') or (
+            '%d/%d' % (op['progress']['done'], op['progress']['total'])
+            if op.get('progress') else 'building')) for op in ops]
+    except Exception:
+        return []
+
+
+def build_indexes(missing, wait=60):
+    """
+    Create indexes, reporting progress.  Each index is created on a separate
+    thread.  If the builds take longer than the wait time, they continue on
+    the database server after provisioning finishes.
+
+    :param missing: a list of (collection name, keys, options) tuples.
+    :param wait: the maximum number of seconds to wait for the builds.
+    """
+    from girder.models.setting import Setting
+
+    db = Setting().database
+
+    def build(collName, keys, options):
+        start = time.time()
+        try:
+            name = db[collName].create_index(keys, background=True, **options)
+        except Exception as exc:
+            logger.warning('Failed to create index %r on %s: %s', keys, collName, exc)
+            return
+        logger.info('Created index %s on %s in %5.3f s', name, collName, time.time() - start)
+
+    threads = []
+    for collName, keys, options in missing:
+        logger.info('Creating index %r on %s', keys, collName)
+        thread = threading.Thread(target=build, args=(collName, keys, options), daemon=True)
+        thread.start()
+        threads.append(thread)
+    start = time.time()
+    while True:
+        alive = [thread for thread in threads if thread.is_alive()]
+        if not alive:
+            return
+        remaining = wait - (time.time() - start)
+        if remaining <= 0:
+            logger.info('%d index builds will continue in the background', len(alive))
+            return
+        alive[0].join(min(10, remaining))
+        if alive[0].is_alive():
+            logger.info('Index builds in progress: %s', '; '.join(
+                index_build_progress(db)) or 'unknown')
+
+
+def report_index_usage(collNames):
+    """
+    Log indexes that have not been used since the database server started
+    and indexes that are redundant because their keys are a prefix of
+    another index's keys.
+
+    :param collNames: a list of collection names to check.
+    """
+    from girder.models.setting import Setting
+
+    db = Setting().database
+    for collName in collNames:
+        try:
+            stats = list(db[collName].aggregate([{'$indexStats': {}}]))
+            info = db[collName].index_information()
+        except Exception:
+            logger.info('Could not get index statistics for %s', collName)
+            continue
+        unused = ['%s (since %s)' % (stat['name'], stat['accesses']['since'])
+                  for stat in stats
+                  if stat['name'] != '_id_' and not stat['accesses']['ops']]
+        keys = {name: [tuple(key) for key in index['key']] for name, index in info.items()}
+        redundant = [
+            '%s (prefix of %s)' % (name, other)
+            for name, key in keys.items() for other, otherKey in keys.items()
+            if name != other and name != '_id_' and not info[name].get('unique') and
+            not info[name].get('sparse') and not info[name].get('partialFilterExpression') and
+            len(key) < len(otherKey) and otherKey[:len(key)] == key]
+        if unused:
+            logger.warning('Unused indexes on %s: %s', collName, ', '.join(unused))
+        if redundant:
+            logger.warning('Redundant indexes on %s: %s', collName, ', '.join(redundant))
+
+
+def reconcile_indexes(indexes, wait=60):
+    """
+    Create missing indexes from the indexes option and report index usage
+    for the listed collections.
+
+    :param indexes: a dictionary of collection names to lists of index
+        entries.
+    :param wait: the maximum number of seconds to wait for index builds.
+    """
+    try:
+        missing = plan_indexes(indexes)
+    except Exception:
+        logger.warning('Could not list existing indexes.')
+        return
+    if missing:
+        build_indexes(missing, wait)
+    report_index_usage(list(indexes))
+
+
+def mongo_compat():
+    """
+    Set the mongo feature compatibility version to the current server version.
+    """
+    from girder.models import getDbConnection
+
+    try:
+        db = getDbConnection()
+    except Exception:
+        logger.warning('Could not connect to mongo.')
+    try:
+        # In mongo shell, this is functionally
+        #   db.adminCommand({setFeatureCompatibilityVersion:
+        #     db.version().split('.').slice(0, 2).join('.')})
+        db.admin.command({'setFeatureCompatibilityVersion': '.'.join(
+            db.server_info()['version'].split('.')[:2]), 'confirm': True})
+    except Exception:
+        try:
+            db.admin.command({'setFeatureCompatibilityVersion': '.'.join(
+                db.server_info()['version'].split('.')[:2])})
+        except Exception:
+            logger.warning('Could not set mongo feature compatibility version.')
+
+
+MIGRATIONS = []
+
+
+def migration(migrationId):
+    """
+    Register a data migration.  Each migration is run once per database; its
+    completion is recorded in the provisioning state collection.  The
+    decorated function is called with the migration's state record and a
+    function to record a checkpoint so that an interrupted migration can
+    resume.
+
+    :param migrationId: a unique, stable id for the migration.
+    """
+    def decorator(func):
+        MIGRATIONS.append((migrationId, func))
+        return func
+    return decorator
+
+
+def migrate_in_batches(collection, query, update, state, checkpoint, batchSize=1000):
+    """
+    Update documents matching a query in batches ordered by _id, recording
+    the last _id processed after each batch.
+
+    :param collection: the pymongo collection to update.
+    :param query: a query of documents to update.
+    :param update: the update to apply to each matching document.
+    :param state: the migration's state record.  If it has a lastId, only
+        documents after that id are updated.
+    :param checkpoint: a function that records a dictionary of values in the
+        migration's state record.
+    :param batchSize: the maximum number of documents to update at once.
+    :returns: the number of documents that were modified.
+    """
+    lastId = state.get('lastId')
+    modified = state.get('modified', 0)
+    total = collection.estimated_document_count()
+    while True:
+        batchQuery = dict(query)
+        if lastId is not None:
+            batchQuery['_id'] = {'$gt': lastId}
+        ids = [doc['_id'] for doc in collection.find(
+            batchQuery, projection=['_id'], sort=[('_id', 1)], limit=batchSize)]
+        if not ids:
+            return modified
+        result = collection.update_many(dict(query, _id={'$in': ids}), update)
+        modified += result.modified_count
+        lastId = ids[-1]
+        checkpoint({'lastId': lastId, 'modified': modified})
+        logger.info('Migrated %d %s documents (through %s of about %d)',
+                    modified, collection.name, lastId, total)
+
+
+@migration('large-image-svs-source-name')
+def migrate_svs_source_name(state, checkpoint):
+    """Upgrade old version 2 large image source names."""
+    from girder.models.item import Item
+
+    return migrate_in_batches(
+        Item().collection, {'largeImage.sourceName': 'svs'},
+        {'$set': {'largeImage.sourceName': 'openslide'}}, state, checkpoint)
+
+
+def run_migrations():
+    """
+    Run any registered data migrations that have not been completed on this
+    database.  Migrations always run, even when provisioning is skipped
+    because its inputs are unchanged or mongo-compat is False; each is
+    recorded when it completes, so later starts only read their state.
+    """
     try:
-        import girder_client
-        import requests
-        import urllib3
-    except ImportError:
-        logger.error('girder_client is unavailable.  Cannot get sample data.')
+        collection = provision_state()
+        applied = {record['_id']: record for record in collection.find(
+            {'_id': {'$in': ['migration:' + key for key, _ in MIGRATIONS]}})}
+    except Exception:
+        logger.warning('Could not read data migration state.')
         return
-    from girder.models.item import Item
-    from girder.models.upload import Upload
-    from girder_large_image.models.image_item import ImageItem
+    for migrationId, func in MIGRATIONS:
+        key = 'migration:' + migrationId
+        state = applied.get(key, {})
+        if state.get('completed'):
+            continue
 
-    folder = get_collection_folder(adminUser, collName, folderName)
-    remote = girder_client.GirderClient(apiUrl='https://data.kitware.com/api/v1')
-    session = requests.Session()
-    retries = urllib3.util.retry.Retry(
-        total=10, backoff_factor=0.1, status_forcelist=[104, 500, 502, 503, 504])
-    session.mount('http://', requests.adapters.HTTPAdapter(max_retries=retries))
-    session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retries))
-    remote._session = session
+        def checkpoint(values, key=key):
+            collection.update_one({'_id': key}, {'$set': values}, upsert=True)
 
-    remoteFolder = remote.resourceLookup('/collection/HistomicsTK/Deployment test images')
-    sampleItems = []
-    for remoteItem in remote.listItem(remoteFolder['_id']):
-        item = Item().findOne({'folderId': folder['_id'], 'name': remoteItem['name']})
-        if item and len(list(Item().childFiles(item, limit=1))):
-            sampleItems.append(item)
+        logger.info('Running data migration %s%s', migrationId,
+                    ' (resuming)' if state else '')
+        start = time.time()
+        try:
+            with timer.span('migration:' + migrationId):
+                result = func(state, checkpoint)
+        except Exception:
+            logger.exception('Data migration %s failed; it will be resumed on '
+                             'the next start', migrationId)
             continue
-        if not item:
-            item = Item().createItem(remoteItem['name'], creator=adminUser, folder=folder)
-        for remoteFile in remote.listFile(remoteItem['_id']):
-            with tempfile.NamedTemporaryFile() as tf:
-                fileName = tf.name
-                tf.close()
-                logger.info('Downloading %s', remoteFile['name'])
-                remote.downloadFile(remoteFile['_id'], fileName)
-                Upload().uploadFromFile(
-                    open(fileName, 'rb'), os.path.getsize(fileName),
-                    name=remoteItem['name'], parentType='item',
-                    parent=item, user=adminUser)
-        sampleItems.append(item)
-    for item in sampleItems:
-        if 'largeImage' not in item:
-            logger.info('Making large_item %s', item['name'])
-            try:
-                ImageItem().createImageItem(item, createJob=False)
-            except Exception:
-                pass
-            logger.info('done')
-    return folder
+        checkpoint({
+            'completed': datetime.datetime.now(datetime.timezone.utc),
+            'result': result,
+        })
+        logger.info('Completed data migration %s in %5.3f s', migrationId,
+                    time.time() - start)
 
 
-def value_from_resource(value, adminUser):
+def main_provision(opts):
     """
-    If a value is a string that startwith 'resource:', it is a path to an
-    existing resource.  Fetch it an return the string of the _id.
+    Configure the server and provision the database.
 
-    :param value: a value
-    :returns: the original value it is not a resource, or the string id of the
-        resource.
+    :param opts: the argparse options.
     """
-    import girder.utility.path as path_util
-    from girder.models.assetstore import Assetstore
+    # This loads plugins, allowing setting validation.  We want the import
+    # to be after the preprovision step.
+    from girder import _attachFileLogHandlers
+    from girder.utility.server import configureServer
 
-    starts = {'resource:': 'doc', 'resourceid:': 'id', 'resourceobjid:': 'obj'}
-    if isinstance(value, dict):
-        value = {k: value_from_resource(v, adminUser) for k, v in value.items()}
-    for start, stype in starts.items():
-        if str(value).startswith(start):
-            resPath = value.split(':', 1)[1]
-            if resPath == 'admin':
-                resource = adminUser
-            elif resPath.startswith('assetstore/'):
-                resource = Assetstore().findOne({'name': value.split('/', 1)[1]})
-            else:
-                resource = path_util.lookUpPath(resPath, force=True)['document']
-            logger.info(f'Finding {start} reference for {resPath} as '
-                        f'{resource["_id"] if resource else resource}')
-            if stype == 'doc':
-                value = resource
-            elif stype == 'id':
-                value = str(resource['_id'])
-            else:
-                value = resource['_id']
-            break
-    return value
+    timer.count_mongo_commands()
+    with timer.span('configureServer'):
+        _attachFileLogHandlers()
+        configureServer()
+    with timer.span('cache-sizing'):
+        size_caches(opts)
+    with timer.span('database-tuning'):
+        tune_database(opts)
+    fingerprint = provision_fingerprint(opts)
+    fast = not getattr(opts, 'full', False) and provision_unchanged(fingerprint)
+    if fast:
+        logger.info('Provisioning inputs are unchanged; skipping database '
+                    'provisioning (use --full to force it).')
+    if not fast and getattr(opts, 'mongo-compat', None) is not False:
+        with timer.span('mongo-compat'):
+            mongo_compat()
+    # Migrations are not gated by fast or mongo-compat; completed ones are
+    # skipped after a single query
+    with timer.span('migrations'):
+        run_migrations()
+    if getattr(opts, 'indexes', None):
+        with timer.span('indexes'):
+            reconcile_indexes(opts.indexes, getattr(opts, 'index-wait', 60))
+    provision(opts, fast)
+    if not fast:
+        record_provision_fingerprint(fingerprint)
+    start_prewarm(opts)
 
 
-def provision_resources(resources, adminUser):
+def backfill_provision(opts):
     """
-    Given a dictionary of resources, add them to the system.  The resource is
-    only added if a resource of that name with the same parent object does not
-    exist.
+    Configure the server and create large images for items in the folders
+    listed in the backfill option.
 
-    :param resources: a list of resources to add.
-    :param adminUser: the admin user to use for provisioning.
+    :param opts: the argparse options.
     """
-    from girder.utility.model_importer import ModelImporter
+    from girder import _attachFileLogHandlers
+    from girder.utility.server import configureServer
 
-    for entry in resources:
-        entry = {k: value_from_resource(v, adminUser) for k, v in entry.items()}
-        modelName = entry.pop('model')
-        metadata = entry.pop('metadata', None)
-        metadata_update = entry.pop('metadata_update', True)
-        metadata_key = entry.pop('metadata_key', 'meta')
-        attrs = entry.pop('attrs', None)
-        attrs_update = entry.pop('attrs_update', True)
-        model = ModelImporter.model(modelName)
-        key = 'name' if model != 'user' else 'login'
-        query = {}
-        if key in entry:
-            query[key] = entry[key]
-        owners = {'folder': 'parent', 'item': 'folder', 'file': 'item'}
-        ownerKey = owners.get(modelName)
-        if ownerKey and ownerKey in entry and isinstance(
-                entry[ownerKey], dict) and '_id' in entry[ownerKey]:
-            query[ownerKey + 'Id'] = entry[ownerKey]['_id']
-        if query and model.findOne(query):
-            result = model.findOne(query)
-            logger.debug('Has %s (%r)', modelName, entry)
-        else:
-            createFunc = getattr(model, 'create%s' % modelName.capitalize())
-            logger.info('Creating %s (%r)', modelName, entry)
-            result = createFunc(**entry)
-            attrs_update = True
-        if isinstance(metadata, dict) and hasattr(model, 'setMetadata'):
-            if metadata_key not in metadata or metadata_update:
-                if metadata_key not in result:
-                    result[metadata_key] = {}
-                result[metadata_key].update(metadata.items())
-                for key in metadata:
-                    if metadata[key] is None:
-                        del result[metadata_key][key]
-                model.validateKeys(result[metadata_key])
-                result = model.save(result)
-        if attrs and attrs_update:
-            result.update(attrs)
-            result = model.save(result)
-
-
-def get_slicer_images(imageList, adminUser, alwaysPull=False):
-    """
-    Load a list of cli docker images into the system.
-
-    :param imageList: a list of docker images.
-    :param adminUser: an admin user for permissions.
-    :param alwaysPull: true to ask to always pull the latest image.
+    with timer.span('configureServer'):
+        _attachFileLogHandlers()
+        configureServer()
+    with timer.span('backfill'):
+        backfill_large_images(getattr(opts, 'backfill'),
+                              getattr(opts, 'backfill-concurrency', None))
+
+
+def prewarm_provision(opts):
     """
-    import threading
+    Configure the server and pre-warm the large image caches based on the
+    prewarm option.
 
-    from girder.models.setting import Setting
-    from girder_jobs.constants import JobStatus
-    from girder_jobs.models.job import Job
-    from slicer_cli_web.config import PluginSettings
-    from slicer_cli_web.docker_resource import DockerResource
-    from slicer_cli_web.image_job import jobPullAndLoad
+    :param opts: the argparse options.
+    """
+    from girder import _attachFileLogHandlers
+    from girder.utility.server import configureServer
 
-    imageList = [entry for entry in imageList if entry and len(entry)]
-    if not len(imageList):
-        return
-    logger.info('Pulling and installing slicer_cli images: %r', imageList)
-    job = Job().createLocalJob(
-        module='slicer_cli_web.image_job',
-        function='jobPullAndLoad',
-        kwargs={
-            'nameList': imageList,
-            'folder': Setting().get(PluginSettings.SLICER_CLI_WEB_TASK_FOLDER),
-            'pull': 'true' if alwaysPull else 'asneeded',
-        },
-        title='Pulling and caching docker images',
-        type=DockerResource.jobType,
-        user=adminUser,
-        public=True,
-        asynchronous=True
-    )
-    job = Job().save(job)
-    t = threading.Thread(target=jobPullAndLoad, args=(job, ))
-    t.start()
-    logpos = 0
-    logger.info('Result:\n')
-    while job['status'] not in {JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED}:
-        time.sleep(0.1)
-        job = Job().load(id=job['_id'], user=adminUser, includeLog=True)
-        if 'log' in job:
-            while logpos < len(job['log']):
-                logger.info(job['log'][logpos].rstrip())
-                logpos += 1
-    t.join()
-    if 'log' not in job:
-        logger.warning('Job record: %r', job)
-    if job['status'] != JobStatus.SUCCESS:
-        raise Exception('Failed to pull and load images')
+    with timer.span('configureServer'):
+        _attachFileLogHandlers()
+        configureServer()
+    run_prewarm(opts.prewarm)
 
 
-def pip_install(packages):
+def run_prewarm(prewarm):
     """
-    Pip install a list of packages via the shell pip install command.  This
-    first tries installing all of the packages in a single command; if it
-    fails, they are tried individually to betetr show where the failure occurs.
+    Pre-warm the large image caches.
 
-    :param packages: a list of strings to add to the end of the pip install
-        command.
+    :param prewarm: the dictionary of the prewarm option.
     """
-    if not packages or not len(packages):
+    with timer.span('prewarm'):
+        prewarm_caches(
+            prewarm['folders'], prewarm.get('levels', 2),
+            prewarm.get('concurrency', 4),
+            prewarm.get('memory', 512 * 1024 ** 2), prewarm.get('limit'))
+
+
+def start_prewarm(opts):
+    """
+    If the prewarm option lists folders, pre-warm the large image caches,
+    either in a background process or before returning.
+
+    :param opts: the argparse options.
+    """
+    prewarm = getattr(opts, 'prewarm', None)
+    if not prewarm or not prewarm.get('folders'):
         return
-    cmd = 'pip install -q ' + ' '.join(packages)
-    logger.info('Installing: %s', cmd)
+    if not prewarm.get('background', True):
+        run_prewarm(prewarm)
+        return
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--prewarm-only']
+    logger.info(f'Pre-warming large image caches in the background: {cmd}')
     try:
-        subprocess.check_call(cmd, shell=True)
+        subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=None, stderr=None,
+            start_new_session=True, close_fds=True)
     except Exception:
-        logger.error(f'Failed to run {cmd}; trying pip install individually.')
-        for entry in packages:
-            cmd = 'pip install %s' % entry
-            logger.info('Installing: %s', cmd)
-            try:
-                subprocess.check_call(cmd, shell=True)
-            except Exception:
-                logger.error(f'Failed to run {cmd}')
-                raise
+        logger.info(f'Failed to start pre-warming large image caches: {cmd}')
 
 
-def preprovision(opts):
+def preprovision_worker(opts):
     """
-    Preprovision the instance.  This includes installing python modules with
-    pip and rebuilding the girder client if desired.
-
-    :param opts: the argparse options.
+    Preprovision the worker.
     """
-    pip_install(getattr(opts, 'pip', None))
-    if getattr(opts, 'shell', None) and len(opts.shell):
-        for entry in opts.shell:
-            cmd = entry
-            logger.info('Running: %s', cmd)
-            try:
-                subprocess.check_call(cmd, shell=True)
-            except Exception:
-                logger.error(f'Failed to run {cmd}')
-                raise
-    if getattr(opts, 'rebuild-client', None):
-        cmd = 'girder build'
-        if str(getattr(opts, 'rebuild-client', None)).lower().startswith('dev'):
-            cmd += ' --dev'
-        logger.info('Rebuilding girder client: %s', cmd)
-        cmd = ('NPM_CONFIG_FUND=false NPM_CONFIG_AUDIT=false '
-               'NPM_CONFIG_AUDIT_LEVEL=high NPM_CONFIG_LOGLEVEL=error '
-               'NPM_CONFIG_PROGRESS=false NPM_CONFIG_PREFER_OFFLINE=true ' + cmd)
-        try:
-            if not getattr(opts, 'no_wait', False):
-                subprocess.check_call(cmd, shell=True)
-            else:
-                proc = subprocess.Popen(cmd + ' ; touch /tmp/girder_build_done', shell=True)
-                logger.info('Rebuilding in background via pid %r', proc.pid)
-                open('/tmp/girder_build.pid', 'w').write(str(proc.pid))
-        except Exception:
-            logger.error(f'Failed to run {cmd}')
-            raise
+    settings = dict({}, **(opts.worker or {}))
+    pip_install(settings.get('pip'), settings.get('pip-wheelhouse') or getattr(
+        opts, 'pip-wheelhouse', None) or os.environ.get('DSA_PIP_WHEELHOUSE'))
+    run_shell_commands(settings.get('shell'))
 
 
-def clean_delete_locks():
-    from girder.constants import AssetstoreType
-    from girder.models.assetstore import Assetstore
+def job_memory_estimate(historyPath, default=2 * 1024 ** 3, samples=100):
+    """
+    Estimate the peak memory used by a job from the recorded peaks of recent
+    jobs.
 
-    for assetstore in Assetstore().find():
-        if assetstore['type'] != AssetstoreType.FILESYSTEM:
-            continue
-        rootpath = assetstore['root']
-        cmd = ['find', rootpath, '-type', 'f', '-name', '*.deleteLock', '-not',
-               '-newermt', (
-                   datetime.datetime.now().astimezone() -
-                   datetime.timedelta(hours=3)).strftime('%Y-%m-%dT%H:%M:%S'),
-               '-delete']
-        logger.info(f'Removing old delete locks in the background: {cmd}')
-        try:
-            # Running this in the background adds a slight chance of a race
-            # condition, which, in turn, adds a slight chance that there could
-            # be an issue.  Specifically, if find locates an old deleteLock,
-            # that deleteLock could be freshened before the delete command has
-            # a chance to run.  This is deemed an acceptable risk
-            subprocess.Popen(
-                cmd, stdin=subprocess.DEVNULL, stdout=None, stderr=None,
-                start_new_session=True, close_fds=True)
-        except Exception:
-            logger.info(f'Failed trying to remove old delete locks: {cmd}')
+    :param historyPath: a file with one peak memory value in bytes per line.
+    :param default: the estimate if there are too few recorded jobs.
+    :param samples: the number of most recent jobs to consider.
+    :returns: the 90th percentile of recent peaks in bytes.
+    """
+    try:
+        with open(historyPath) as fptr:
+            peaks = sorted(int(line) for line in fptr.read().split()[-samples:])
+    except (OSError, ValueError):
+        peaks = []
+    if len(peaks) < 5:
+        return default
+    return peaks[min(len(peaks) - 1, int(len(peaks) * 0.9))]
 
 
-def provision(opts):  # noqa
+def worker_concurrency(limits, jobMemory, reserve=1024 ** 3, maximum=None):
     """
-    Provision the instance.
+    Compute a worker concurrency that doesn't oversubscribe the cpus or
+    memory available to this container.
 
-    :param opts: the argparse options.
+    :param limits: the dictionary from container_limits.
+    :param jobMemory: the expected peak memory of a job in bytes.
+    :param reserve: memory in bytes reserved for the worker itself.
+    :param maximum: an optional upper bound on the concurrency.
+    :returns: the concurrency.
     """
-    from girder.models.assetstore import Assetstore
-    from girder.models.setting import Setting
-    from girder.models.user import User
+    byCpu = max(1, int(limits['cpus']))
+    byMemory = max(1, int((limits['memory'] - reserve) // max(1, jobMemory)))
+    concurrency = min(byCpu, byMemory)
+    if maximum:
+        concurrency = min(concurrency, int(maximum))
+    return concurrency
 
-    # If there is are no admin users, create an admin user
-    if User().findOne({'admin': True}) is None:
-        adminParams = dict({
-            'login': 'admin',
-            'password': 'password',
-            'firstName': 'Admin',
-            'lastName': 'Admin',
-            'email': 'admin@nowhere.nil',
-            'public': True,
-        }, **(opts.admin if opts.admin else {}))
-        User().createUser(admin=True, **adminParams)
-    adminUser = User().findOne({'admin': True})
 
-    # Make sure we have an assetstore
-    assetstoreParams = opts.assetstore or {'name': 'Assetstore', 'root': '/assetstore'}
-    if not isinstance(assetstoreParams, list):
-        assetstoreParams = [assetstoreParams]
-    if Assetstore().findOne() is None:
-        for params in assetstoreParams:
-            method = params.pop('method', 'createFilesystemAssetstore')
-            getattr(Assetstore(), method)(**params)
+def image_repository(image):
+    """
+    Get the repository of a docker image name without its tag or digest.
 
-    # Clean up old deleteLocks
-    if getattr(opts, 'clean-delete-locks', None):
-        clean_delete_locks()
-
-    # Make sure we have a demo collection and download some demo files
-    if getattr(opts, 'samples', None):
-        get_sample_data(
-            adminUser,
-            getattr(opts, 'sample-collection', 'Samples'),
-            getattr(opts, 'sample-folder', 'Images'))
-    if opts.resources:
-        provision_resources(opts.resources, adminUser)
-    settings = dict({}, **(opts.settings or {}))
-    force = getattr(opts, 'force', None) or []
-    for key, value in settings.items():
-        if (value != '__SKIP__' and (
-                force is True or key in force or
-                Setting().get(key) is None or
-                Setting().get(key) == Setting().getDefault(key))):
-            value = value_from_resource(value, adminUser)
-            logger.info('Setting %s to %r', key, value)
-            Setting().set(key, value)
-    images = []
-    if getattr(opts, 'slicer-cli-image-pull', None):
-        images = list(dict.fromkeys(getattr(opts, 'slicer-cli-image-pull', None)))
-        try:
-            get_slicer_images(getattr(opts, 'slicer-cli-image-pull', None),
-                              adminUser, alwaysPull=True)
-        except Exception:
-            logger.info('Cannot fetch slicer-cli-images.')
-    if getattr(opts, 'slicer-cli-image', None):
-        images = [image for image in dict.fromkeys(getattr(opts, 'slicer-cli-image', None))
-                  if image not in images]
-        try:
-            get_slicer_images(images, adminUser)
-        except Exception:
-            logger.info('Cannot fetch slicer-cli-images.')
+    :param image: a docker image name, such as dsarchive/histomicstk:latest.
+    :returns: the repository, such as dsarchive/histomicstk.
+    """
+    image = image.split('@', 1)[0]
+    if ':' in image.rsplit('/', 1)[-1]:
+        image = image.rsplit(':', 1)[0]
+    return image
 
 
-def preprovision_worker(opts):
+class JobMemoryMonitor:
     """
-    Preprovision the worker.
+    Record the peak memory of job containers started by this worker.  Job
+    containers are those with a girder_worker or slicer_cli_web label or that
+    run one of a list of images.  Containers managed by docker compose are
+    ignored.  Only one monitor runs at a time; it holds an exclusive lock on
+    lockPath.
     """
-    settings = dict({}, **(opts.worker or {}))
-    pip_install(settings.get('pip'))
-    if settings.get('shell') and len(settings['shell']):
-        for entry in settings['shell']:
-            cmd = entry
-            logger.info('Running: %s', cmd)
+
+    lockPath = '/tmp/dsa_job_memory_monitor.lock'
+
+    def __init__(self, historyPath, images=None, keep=200):
+        """
+        :param historyPath: a file to append peak memory values to.
+        :param images: a list of the images of job containers.  Tags are
+            ignored.
+        :param keep: the number of most recent values to keep.
+        """
+        self.historyPath = historyPath
+        self.images = {image_repository(image) for image in images or []}
+        self.keep = keep
+        self.peaks = {}
+
+    def isJob(self, container):
+        labels = container.labels or {}
+        if 'com.docker.compose.project' in labels:
+            return False
+        if any(key.startswith(('girder_worker', 'slicer_cli_web')) for key in labels):
+            return True
+        image = container.attrs.get('Config', {}).get('Image') or ''
+        return image_repository(image) in self.images
+
+    def sample(self, client):
+        running = set()
+        for container in client.containers.list():
+            if not self.isJob(container):
+                continue
+            running.add(container.id)
             try:
-                subprocess.check_call(cmd, shell=True)
+                stats = container.stats(stream=False)['memory_stats']
             except Exception:
-                logger.error(f'Failed to run {cmd}')
-                raise
+                continue
+            usage = max(stats.get('max_usage', 0), stats.get('usage', 0))
+            self.peaks[container.id] = max(self.peaks.get(container.id, 0), usage)
+        finished = [self.peaks.pop(cid) for cid in list(self.peaks) if cid not in running]
+        finished = [peak for peak in finished if peak]
+        if finished:
+            self.record(finished)
+
+    def record(self, peaks):
+        try:
+            with open(self.historyPath) as fptr:
+                lines = fptr.read().split()
+        except OSError:
+            lines = []
+        lines = (lines + [str(peak) for peak in peaks])[-self.keep:]
+        with open(self.historyPath + '.partial', 'w') as fptr:
+            fptr.write('\n'.join(lines) + '\n')
+        os.replace(self.historyPath + '.partial', self.historyPath)
+        logger.info('Recorded job peak memory: %r', peaks)
+
+    def run(self, interval=30):
+        with exclusive_lock(self.lockPath) as locked:
+            if not locked:
+                logger.info('Another process is already recording job memory')
+                return
+            import docker
+
+            client = docker.from_env()
+            while True:
+                try:
+                    self.sample(client)
+                except Exception:
+                    logger.exception('Failed to sample job memory')
+                time.sleep(interval)
+
+
+def tune_worker_concurrency(settings, images=None):
+    """
+    If the worker concurrency is 'auto', compute it from the container's
+    limits and the history of job peak memory, and write the girder_worker
+    arguments to the file start_worker.sh reads.  Also start recording job
+    peak memory in the background, unless it is already being recorded.
+
+    :param settings: the worker settings.
+    :param images: a list of the images of job containers.  The job-images
+        setting takes precedence.
+    """
+    concurrency = settings.get('concurrency') or os.environ.get('DSA_WORKER_CONCURRENCY')
+    argsPath = settings.get('concurrency-file') or '/tmp/dsa_worker_concurrency'
+    if str(concurrency).strip().lower() != 'auto':
+        if os.path.exists(argsPath):
+            os.unlink(argsPath)
+        return
+    historyPath = settings.get('job-memory-history') or '/tmp/dsa_worker_job_memory'
+    limits = container_limits()
+    jobMemory = job_memory_estimate(
+        historyPath, settings.get('job-memory') or 2 * 1024 ** 3)
+    concurrency = worker_concurrency(
+        limits, jobMemory, settings.get('reserve-memory', 1024 ** 3),
+        settings.get('max-concurrency'))
+    if settings.get('autoscale'):
+        args = '--autoscale=%d,%d' % (
+            concurrency, min(concurrency, int(settings.get('autoscale-min', 1))))
+    else:
+        args = '--concurrency=%d' % concurrency
+    logger.info('Worker has %d MB memory and %g cpus; expected job memory is '
+                '%d MB; using %s', limits['memory'] // 1024 ** 2, limits['cpus'],
+                jobMemory // 1024 ** 2, args)
+    with open(argsPath, 'w') as fptr:
+        fptr.write(args + '\n')
+    if not settings.get('job-memory-monitor', True):
+        return
+    with exclusive_lock(JobMemoryMonitor.lockPath) as locked:
+        if not locked:
+            logger.info('Job memory is already being recorded in the background')
+            return
+    cmd = [sys.executable, os.path.abspath(__file__), '-v',
+           '--job-memory-monitor', historyPath]
+    for image in settings.get('job-images') or images or []:
+        cmd.extend(['--job-memory-image', image])
+    try:
+        subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=None, stderr=None,
+            start_new_session=True, close_fds=True)
+    except Exception:
+        logger.info(f'Failed to start recording job memory: {cmd}')
 
 
 def provision_worker(opts):
@@ -426,6 +4195,8 @@ def provision_worker(opts):
             mainkey = key.split('worker-', 1)[1]
             if settings.get(mainkey) is None:
                 settings[mainkey] = getattr(opts, key)
+    tune_worker_concurrency(settings, (getattr(opts, 'slicer-cli-image', None) or []) + (
+        getattr(opts, 'slicer-cli-image-pull', None) or []))
     if not settings.get('rabbitmq-host'):
         return
     conf = configparser.ConfigParser()
@@ -489,7 +4260,8 @@ def merge_yaml_opts(opts, parser):
     defaults = parser.parse_args(args=[])
     if getattr(opts, 'use-defaults', None) is not False:
         defaults = merge_default_opts(defaults)
-    yamlopts = yaml.safe_load(open(yamlfile).read())
+    with open(yamlfile) as fptr:
+        yamlopts = yaml.safe_load(fptr)
     for key, value in yamlopts.items():
         key = key.replace('_', '-')
         if getattr(opts, key, None) is None or getattr(
@@ -599,12 +4371,45 @@ if __name__ == '__main__':  # noqa
         '--no-clean-delete-locks', action='store_false',
         dest='clean-delete-locks',
         help='Do not remove assetstore delete locks on start')
+    parser.add_argument(
+        '--delete-lock-interval', dest='delete-lock-interval', type=int,
+        default=3600, help='The number of seconds between scans for old '
+        'assetstore delete locks.  0 to only scan on start.')
+    parser.add_argument(
+        '--delete-lock-rate', dest='delete-lock-rate', type=int, default=1000,
+        help='The maximum number of filesystem operations per second when '
+        'removing old delete locks.  0 for no limit.')
+    parser.add_argument(
+        '--reap-delete-locks', dest='reap-delete-locks', action='append',
+        help='Remove old delete locks from this directory (may be specified '
+        'multiple times), repeating every delete-lock-interval seconds, '
+        'without other provisioning.')
     parser.add_argument(
         '--sample-collection', dest='sample-collection', default='Samples',
         help='Sample data collection name')
     parser.add_argument(
         '--sample-folder', dest='sample-folder', default='Images',
         help='Sample data folder name')
+    parser.add_argument(
+        '--sample-concurrency', dest='sample-concurrency', type=int, default=4,
+        help='The maximum number of sample items to download and ingest at '
+        'once.')
+    parser.add_argument(
+        '--download-cache', dest='download-cache',
+        help='A directory used to cache downloaded sample data by sha512.  '
+        'This defaults to the DSA_DOWNLOAD_CACHE environment variable.  If '
+        'neither is set, downloads are not cached.')
+    parser.add_argument(
+        '--download-cache-size', dest='download-cache-size', type=int,
+        help='The maximum size of the download cache in bytes.  Least '
+        'recently used files are removed when this is exceeded.')
+    parser.add_argument(
+        '--download-mirror', dest='download-mirror',
+        help='A local directory of sample files named by sha512 or file name '
+        'that is checked before downloading.')
+    parser.add_argument(
+        '--offline', action='store_true', default=None,
+        help='Only get sample data from the download cache or mirror.')
     parser.add_argument(
         '--admin', action=YamlAction,
         help='A yaml dictionary of parameters used to create a default admin '
@@ -640,6 +4445,10 @@ if __name__ == '__main__':  # noqa
         '"resource:<path>" is converted to the resource document with that '
         'resource path.  "resource:admin" uses the default admin, '
         '"resourceid:<path>" is the string id for the resource path.')
+    parser.add_argument(
+        '--resource-concurrency', dest='resource-concurrency', type=int,
+        default=4, help='The maximum number of independent resources to '
+        'create at once.')
     parser.add_argument(
         '--yaml',
         help='Specify parameters for this script in a yaml file.  If no value '
@@ -662,15 +4471,34 @@ if __name__ == '__main__':  # noqa
         'directly, so additional options are needed, these can be added (such '
         'as --find-links).  The actual values need to be escaped '
         'appropriately for a bash shell.')
+    parser.add_argument(
+        '--pip-wheelhouse', dest='pip-wheelhouse',
+        help='A directory shared between the girder and worker containers '
+        'used for the pip cache and for wheels built from git requirements.  '
+        'This defaults to the DSA_PIP_WHEELHOUSE environment variable.')
     parser.add_argument(
         '--rebuild-client', dest='rebuild-client', action='store_true',
         default=False, help='Rebuild the girder client.')
+    parser.add_argument(
+        '--client-build-cache', dest='client-build-cache',
+        help='A directory used to cache girder client builds by the set of '
+        'installed girder plugins and the build mode.  This defaults to the '
+        'DSA_CLIENT_BUILD_CACHE environment variable or a directory in the '
+        'python environment.  Set to "false" to disable the cache.')
+    parser.add_argument(
+        '--store-client-build', dest='store-client-build',
+        help='Store the current girder client build in the specified build '
+        'cache path and exit.  This is used after background builds.')
     parser.add_argument(
         '--slicer-cli-image', dest='slicer-cli-image', action='append',
         help='Install slicer_cli images, only pulling if not present.')
     parser.add_argument(
         '--slicer-cli-image-pull', dest='slicer-cli-image-pull', action='append',
         help='Install slicer_cli images, always pulling the latest.')
+    parser.add_argument(
+        '--slicer-cli-concurrency', dest='slicer-cli-concurrency', type=int,
+        default=2, help='The maximum number of slicer_cli images to pull and '
+        'load at once.')
 
     parser.add_argument(
         '--rabbitmq-user', default='guest', dest='worker-rabbitmq-user',
@@ -685,6 +4513,14 @@ if __name__ == '__main__':  # noqa
         '--config', dest='worker-config',
         default='/opt/girder_worker/girder_worker/worker.local.cfg',
         help='Worker: Path to the worker config file.')
+    parser.add_argument(
+        '--job-memory-monitor', dest='job-memory-monitor',
+        help='Instead of provisioning, record the peak memory of job '
+        'containers in this file.')
+    parser.add_argument(
+        '--job-memory-image', dest='job-memory-image', action='append',
+        help='With --job-memory-monitor, a docker image of job containers.  '
+        'This may be specified multiple times.')
     parser.add_argument(
         '--worker', action=YamlAction,
         help='A yaml dictionary of worker settings.')
@@ -703,15 +4539,86 @@ if __name__ == '__main__':  # noqa
     parser.add_argument(
         '--main', dest='portion', action='store_const', const='main',
         help='Only do main provisioning.')
+    parser.add_argument(
+        '--wait-build', dest='portion', action='store_const', const='wait-build',
+        help='Only wait for a background girder client build to finish and '
+        'record its duration.')
+    parser.add_argument(
+        '--prewarm-only', dest='portion', action='store_const',
+        const='prewarm',
+        help='Only pre-warm the large image caches as specified by the '
+        'prewarm option.')
+    parser.add_argument(
+        '--database', action=YamlAction,
+        help='A yaml dictionary of database connection pool, compression, and '
+        'read preference options used to tune the database URI.')
+    parser.add_argument(
+        '--benchmark-database', dest='benchmark-database', action='store_true',
+        help='Instead of provisioning, report query latency with the current '
+        'and the tuned database URIs.')
+    parser.add_argument(
+        '--manifests', action=YamlAction,
+        help='A yaml list of manifest files of resources to provision in '
+        'batches.')
+    parser.add_argument(
+        '--imports', action=YamlAction,
+        help='A yaml list of directories to import in place into girder '
+        'folders.  Only changed directories are rescanned on later starts.')
+    parser.add_argument(
+        '--indexes', action=YamlAction,
+        help='A yaml dictionary of collection names to lists of indexes to '
+        'create if they do not exist.')
+    parser.add_argument(
+        '--index-wait', dest='index-wait', type=int, default=60,
+        help='The maximum number of seconds to wait for index builds.  Builds '
+        'that take longer continue in the background.')
+    parser.add_argument(
+        '--cache-sizing', dest='cache-sizing', action=YamlAction,
+        help='A yaml dictionary of options for sizing the large_image caches '
+        'and the memcached or redis server based on container memory, or '
+        'false to not size them.')
+    parser.add_argument(
+        '--prewarm', action=YamlAction,
+        help='A yaml dictionary of large image cache pre-warming options.')
     parser.add_argument(
         '--no-wait', action='store_true',
         help='If a girder build is performed during preprovisioning, do not '
         'wait for it to complete.')
+    parser.add_argument(
+        '--backfill', action='append',
+        help='Instead of provisioning, create large images for all items '
+        'that do not have them in this folder, collection, or user resource '
+        'path.  This may be specified multiple times.  An interrupted '
+        'backfill of the same paths resumes where it stopped.')
+    parser.add_argument(
+        '--backfill-concurrency', dest='backfill-concurrency', type=int,
+        help='The number of processes used to backfill large images.  The '
+        'default is the number of available cores.')
+    parser.add_argument(
+        '--full', action='store_true',
+        help='Always perform full main provisioning.  Otherwise, if the '
+        'merged provisioning options are unchanged since the last successful '
+        'run, only cheap checks are done.')
+    parser.add_argument(
+        '--timing-report', dest='timing-report', default='/logs',
+        help='A directory where json and Prometheus text format reports of '
+        'the duration of each provisioning phase are written.  Set to an '
+        'empty string to disable the reports.')
     parser.add_argument(
         '--verbose', '-v', action='count', default=0, help='Increase verbosity')
     parser.add_argument(
         '--dry-run', '-n', dest='dry-run', action='store_true',
         help='Report merged options but do not actually apply them')
+    parser.add_argument(
+        '--plan', nargs='?', const='',
+        help='Report the admin user, assetstores, resources, metadata, attrs, '
+        'and settings that main provisioning would create or change without '
+        'changing the database.  If a file is specified, the plan is also '
+        'saved to it for use with --apply.')
+    parser.add_argument(
+        '--apply',
+        help='Apply only the changes in a plan file saved by --plan.  The '
+        'provisioning options must be the same as when the plan was made.')
     opts = parser.parse_args(args=sys.argv[1:])
     logger.addHandler(logging.StreamHandler(sys.stderr))
     logger.setLevel(max(1, logging.WARNING - 10 * opts.verbose))
@@ -722,6 +4629,15 @@ if __name__ == '__main__':  # noqa
     except Exception:
         pass
     logger.debug('Parsed arguments: %r', opts)
+    if getattr(opts, 'job-memory-monitor', None):
+        JobMemoryMonitor(getattr(opts, 'job-memory-monitor'),
+                         getattr(opts, 'job-memory-image', None)).run()
+        sys.exit(0)
+    if getattr(opts, 'reap-delete-locks', None):
+        DeleteLockReaper(
+            getattr(opts, 'reap-delete-locks'), rate=getattr(opts, 'delete-lock-rate'),
+        ).run(getattr(opts, 'delete-lock-interval'))
+        sys.exit(0)
     if getattr(opts, 'use-defaults', None) is not False:
         opts = merge_default_opts(opts)
     opts = merge_yaml_opts(opts, parser)
@@ -730,6 +4646,22 @@ if __name__ == '__main__':  # noqa
     if getattr(opts, 'dry-run'):
         print(yaml.dump({k: v for k, v in vars(opts).items() if v is not None}))
         sys.exit(0)
+    if getattr(opts, 'store-client-build', None):
+        store_client_build(getattr(opts, 'store-client-build'))
+        sys.exit(0)
+    atexit.register(timer.write_report, getattr(opts, 'timing-report', None),
+                    getattr(opts, 'portion', None) or 'all')
+    if getattr(opts, 'plan', None) is not None or getattr(opts, 'apply', None):
+        sys.exit(0 if plan_main(opts) else 1)
+    if getattr(opts, 'benchmark-database', None):
+        database_benchmark_main(opts)
+        sys.exit(0)
+    if getattr(opts, 'backfill', None):
+        backfill_provision(opts)
+        sys.exit(0)
+    if getattr(opts, 'portion', None) == 'prewarm':
+        prewarm_provision(opts)
+        sys.exit(0)
     # Worker provisioning
     if getattr(opts, 'portion', None) == 'worker-pre':
         preprovision_worker(opts)
@@ -737,43 +4669,14 @@ if __name__ == '__main__':  # noqa
     if getattr(opts, 'portion', None) == 'worker-main':
         provision_worker(opts)
         sys.exit(0)
+    steps = []
     if getattr(opts, 'portion', None) in {'pre', None}:
         # Run provisioning that has to happen before configuring the server.
-        preprovision(opts)
-        if getattr(opts, 'portion', None) == 'pre':
-            sys.exit(0)
+        steps.extend(preprovision_steps(opts))
     if getattr(opts, 'portion', None) in {'main', None}:
-        # This loads plugins, allowing setting validation.  We want the import
-        # to be after the preprovision step.
-        from girder import _attachFileLogHandlers
-        from girder.utility.server import configureServer
-
-        _attachFileLogHandlers()
-        configureServer()
-        if getattr(opts, 'mongo-compat', None) is not False:
-            from girder.models import getDbConnection
-
-            try:
-                db = getDbConnection()
-            except Exception:
-                logger.warning('Could not connect to mongo.')
-            try:
-                # In mongo shell, this is functionally
-                #   db.adminCommand({setFeatureCompatibilityVersion:
-                #     db.version().split('.').slice(0, 2).join('.')})
-                db.admin.command({'setFeatureCompatibilityVersion': '.'.join(
-                    db.server_info()['version'].split('.')[:2]), 'confirm': True})
-            except Exception:
-                try:
-                    db.admin.command({'setFeatureCompatibilityVersion': '.'.join(
-                        db.server_info()['version'].split('.')[:2])})
-                except Exception:
-                    logger.warning('Could not set mongo feature compatibility version.')
-            try:
-                # Also attempt to upgrade old version 2 image sources
-                db.girder.item.update_many(
-                    {'largeImage.sourceName': 'svs'},
-                    {'$set': {'largeImage.sourceName': 'openslide'}})
-            except Exception:
-                logger.warning('Could not update old source names.')
-        provision(opts)
+        # Main provisioning needs installed plugins, but not the client build.
+        steps.append(('main', ['preprovision:pip', 'preprovision:shell'],
+                      lambda: main_provision(opts)))
+    if getattr(opts, 'portion', None) == 'wait-build':
+        steps.append(('wait-build', [], wait_for_background_build))
+    run_steps(steps)
@@ -34,6 +34,9 @@ iptables -t nat -A OUTPUT -o lo -p tcp -m tcp --dport 27017 -j DNAT --to-destina
 iptables -t nat -A OUTPUT -o lo -p tcp -m tcp --dport 11211 -j DNAT --to-destination `dig +short memcached`:11211
 iptables -t nat -A POSTROUTING -o eth0 -m addrtype --src-type LOCAL --dst-type UNICAST -j MASQUERADE
 echo 'PATH="/opt/digital_slide_archive/devops/dsa/utils:/opt/venv/bin:/.pyenv/bin:/.pyenv/shims:$PATH"' >> /home/$(id -nu ${DSA_USER%%:*})/.bashrc
+# Pre-provisioning and provisioning share a run id so their timing reports
+# are combined into a single timeline in /logs/provision_timeline.json.
+export DSA_PROVISION_RUN=$(date +%s%N)
 echo ==== Pre-Provisioning ===
 PATH="/opt/venv/bin:/.pyenv/bin:/.pyenv/shims:$PATH" \
 python /opt/digital_slide_archive/devops/dsa/provision.py -v --pre --no-wait
@@ -42,20 +45,22 @@ python /opt/digital_slide_archive/devops/dsa/provision.py -v --pre --no-wait
 # devops/dsa/utils are available.  Then:
 # - Provision the Girder instance.  This sets values in the database, such as
 #   creating an admin user if there isn't one.  See the provision.py script for
-#   the details.
+#   the details.  This runs concurrently with any background girder build.
 # - If possible, set up a girder mount.  This allows file-like access of girder
 #   resources.  It requires the host to have fuse installed and the docker
 #   container to be run with enough permissions to use fuse.
+# - Wait for any background girder build to finish and add it to the
+#   provisioning timeline.
 # - Start the main girder process.
 su $(id -nu ${DSA_USER%%:*}) -c "
   PATH=\"/opt/digital_slide_archive/devops/dsa/utils:/opt/venv/bin:/.pyenv/bin:/.pyenv/shims:$PATH\";
   echo ==== Provisioning === &&
-  python /opt/digital_slide_archive/devops/dsa/provision.py -v --main &&
+  DSA_PROVISION_RUN=$DSA_PROVISION_RUN python /opt/digital_slide_archive/devops/dsa/provision.py -v --main &&
   echo ==== Creating FUSE mount === &&
   (girder mount ${DSA_GIRDER_MOUNT_OPTIONS%%:-} /fuse || true) &&
   if [[ -f /tmp/girder_build.pid ]]; then
   echo ==== Wait for girder build to finish === &&
-  while [[ -e /proc/$(cat /tmp/girder_build.pid) && ! -f /tmp/girder_build_done ]]; do sleep 0.1; done &&
+  DSA_PROVISION_RUN=$DSA_PROVISION_RUN python /opt/digital_slide_archive/devops/dsa/provision.py -v --wait-build &&
   true; fi &&
   echo ==== Starting Girder === &&
   girder serve
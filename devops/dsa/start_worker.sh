@@ -33,10 +33,18 @@ python3 /opt/digital_slide_archive/devops/dsa/provision.py --worker-pre
 echo ==== Provisioning === &&
 python3 /opt/digital_slide_archive/devops/dsa/provision.py --worker-main
 echo ==== Starting Worker === &&
+# If DSA_WORKER_CONCURRENCY is auto, provisioning writes the concurrency
+# arguments based on the container's cpu and memory limits.
+WORKER_CONCURRENCY="--concurrency=${DSA_WORKER_CONCURRENCY:-2}"
+if [[ -f /tmp/dsa_worker_concurrency ]]; then
+  WORKER_CONCURRENCY=$(cat /tmp/dsa_worker_concurrency)
+elif [[ "${DSA_WORKER_CONCURRENCY}" == "auto" ]]; then
+  WORKER_CONCURRENCY="--concurrency=2"
+fi
 # Run subsequent commands as the DSA_USER.  This sets some paths based on what
 # is expected in the Docker so that the current python environment and the
 # devops/dsa/utils are available.  Then it runs girder_worker
 su $(id -nu ${DSA_USER%%:*}) -c "
   PATH=\"/opt/digital_slide_archive/devops/dsa/utils:/opt/venv/bin:/.pyenv/bin:/.pyenv/shims:$PATH\";
-  DOCKER_CLIENT_TIMEOUT=86400 TMPDIR=${TMPDIR:-/tmp} GW_DIRECT_PATHS=true python -m girder_worker --concurrency=${DSA_WORKER_CONCURRENCY:-2} -Ofair --prefetch-multiplier=1
+  DOCKER_CLIENT_TIMEOUT=86400 TMPDIR=${TMPDIR:-/tmp} GW_DIRECT_PATHS=true python -m girder_worker ${WORKER_CONCURRENCY} -Ofair --prefetch-multiplier=1
 "
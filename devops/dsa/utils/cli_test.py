@@ -8,6 +8,7 @@ import tempfile
 import time
 
 import girder_client
+from download_cache import DEFAULT_CACHE_DIR, DownloadCache, cached_remote_listing
 
 
 def get_girder_client(opts):
@@ -56,8 +57,13 @@ def get_test_data(client, opts):  # noqa
     if not folder:
         folder = client.createFolder(collection['_id'], folderName, parentType='collection')
     remote = girder_client.GirderClient(apiUrl='https://data.kitware.com/api/v1')
-    remoteFolder = remote.resourceLookup('/collection/HistomicsTK/Deployment test images')
-    for item in remote.listItem(remoteFolder['_id']):
+    cache = None
+    if opts.get('cache') or opts.get('offline') or opts.get('mirror'):
+        cache = DownloadCache(
+            opts.get('cache'), opts.get('cache_size'), opts.get('offline'), opts.get('mirror'))
+    remoteItems = cached_remote_listing(
+        cache, remote, '/collection/HistomicsTK/Deployment test images')
+    for item in remoteItems:
         localPath = '/collection/%s/%s/%s' % (collName, folderName, item['name'])
         try:
             localItem = client.resourceLookup(localPath)
@@ -68,20 +74,26 @@ def get_test_data(client, opts):  # noqa
                 continue
             client.delete('item/%s' % localItem['_id'])
         localItem = client.createItem(folder['_id'], item['name'])
-        for remoteFile in remote.listFile(item['_id']):
+        for remoteFile in item['files']:
             with tempfile.NamedTemporaryFile() as tf:
                 fileName = tf.name
                 tf.close()
                 sys.stdout.write('Downloading %s' % remoteFile['name'])
                 sys.stdout.flush()
-                remote.downloadFile(remoteFile['_id'], fileName)
+                if cache is not None:
+                    fileName = cache.fetch(remoteFile, lambda dest: remote.downloadFile(
+                        remoteFile['_id'], dest))
+                else:
+                    remote.downloadFile(remoteFile['_id'], fileName)
                 sys.stdout.write(' .')
                 sys.stdout.flush()
                 client.uploadFileToItem(
                     localItem['_id'], fileName, filename=remoteFile['name'],
-                    mimeType=remoteFile['mimeType'])
+                    mimeType=remoteFile.get('mimeType'))
                 sys.stdout.write('.\n')
                 sys.stdout.flush()
+    if cache is not None:
+        sys.stdout.write(cache.summary() + '\n')
     for item in list(client.listItem(folder['_id'])):
         if '.anot' in item['name']:
             sys.stdout.write('Deleting %s\n' % item['name'])
@@ -307,6 +319,22 @@ if __name__ == '__main__':
         '--only-data', '--data', action='store_const', dest='test',
         const='data',
         help='Download test data, but do not run CLI.')
+    parser.add_argument(
+        '--cache', nargs='?', const=DEFAULT_CACHE_DIR,
+        help='Cache downloaded test data in a local directory keyed by the '
+        'sha512 of each file.  If no directory is specified, this defaults to '
+        'the DSA_DOWNLOAD_CACHE environment variable or ~/.cache/dsa/downloads.')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=int,
+        help='The maximum size of the download cache in bytes.  Least recently '
+        'used files are removed when this is exceeded.')
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Only use test data from the download cache or mirror directory.')
+    parser.add_argument(
+        '--mirror',
+        help='A local directory of test files named by sha512 or file name '
+        'to use before downloading.')
     parser.add_argument('--verbose', '-v', action='count', default=0)
 
     args = parser.parse_args()
@@ -0,0 +1,250 @@
+"""
+A content-addressed on-disk cache for files downloaded from a remote Girder
+server.  This is shared by provision.py and cli_test.py so that rebuilding a
+deployment reads sample and test data from local disk rather than fetching it
+again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'DSA_DOWNLOAD_CACHE', os.path.expanduser('~/.cache/dsa/downloads'))
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+
+
+class DownloadCacheMiss(Exception):
+    """A file is not available from the cache or mirror in offline mode."""
+
+
+class DownloadCache:
+    def __init__(self, root=None, maxSize=None, offline=False, mirror=None):
+        """
+        A cache of remote files keyed by their sha512 hash.  Files without a
+        known hash are keyed by remote id and size and are verified only by
+        size.
+
+        :param root: the cache directory.  This is created if needed.
+        :param maxSize: the maximum total size of cached files in bytes.
+            Least recently used files are evicted when this is exceeded.
+        :param offline: if True, never contact the remote server; files must
+            be in the cache or the mirror directory.
+        :param mirror: an optional directory of files, named either by their
+            sha512 hash or by their file name, that is checked before
+            downloading.
+        """
+        self.root = os.path.abspath(os.path.expanduser(root or DEFAULT_CACHE_DIR))
+        self.maxSize = int(maxSize) if maxSize else DEFAULT_MAX_SIZE
+        self.offline = bool(offline)
+        self.mirror = os.path.expanduser(mirror) if mirror else None
+        self.hits = 0
+        self.misses = 0
+        # Files fetched by this cache are not evicted while it is in use,
+        # since callers (possibly in other threads) read them after fetch
+        # returns.
+        self._fetched = set()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, 'files'), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'listings'), exist_ok=True)
+
+    @staticmethod
+    def key(fileInfo):
+        """
+        Get the cache key of a remote file.
+
+        :param fileInfo: a Girder file document.
+        :returns: the key.
+        """
+        if fileInfo.get('sha512'):
+            return fileInfo['sha512'].lower()
+        return 'id-%s-%d' % (fileInfo['_id'], fileInfo.get('size', -1))
+
+    def path(self, key):
+        return os.path.join(self.root, 'files', key[:2], key)
+
+    @staticmethod
+    def _sha512(path):
+        hasher = hashlib.sha512()
+        with open(path, 'rb') as fptr:
+            for chunk in iter(lambda: fptr.read(1024 ** 2), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def verify(self, path, fileInfo):
+        """
+        Check that a local file matches the remote file's size and hash.
+
+        :param path: the local path.
+        :param fileInfo: a Girder file document.
+        :returns: True if the file matches.
+        """
+        if not os.path.isfile(path):
+            return False
+        if fileInfo.get('size') is not None and os.path.getsize(path) != fileInfo['size']:
+            return False
+        if fileInfo.get('sha512') and self._sha512(path) != fileInfo['sha512'].lower():
+            return False
+        return True
+
+    def _mirrorPath(self, fileInfo):
+        if not self.mirror:
+            return None
+        for name in (fileInfo.get('sha512'), fileInfo.get('name')):
+            if name and self.verify(os.path.join(self.mirror, name), fileInfo):
+                return os.path.join(self.mirror, name)
+        return None
+
+    def _store(self, key, fileInfo, fill):
+        dest = self.path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.partial')
+        os.close(fd)
+        try:
+            fill(tempPath)
+            if not self.verify(tempPath, fileInfo):
+                raise OSError('Integrity check failed for %s' % fileInfo.get('name'))
+            os.replace(tempPath, dest)
+        finally:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+        return dest
+
+    def fetch(self, fileInfo, download):
+        """
+        Get a local path for a remote file, downloading it if needed.
+
+        :param fileInfo: a Girder file document with at least _id, name, and
+            size.  If it has sha512, the file is verified against it.
+        :param download: a function that takes a local path and downloads the
+            remote file to it.
+        :returns: the path of the cached file.  This should be treated as
+            read-only.  It is not evicted by this cache.
+        """
+        key = self.key(fileInfo)
+        path = self.path(key)
+        with self._lock:
+            self._fetched.add(path)
+        if os.path.exists(path):
+            if self.verify(path, fileInfo):
+                with self._lock:
+                    self.hits += 1
+                os.utime(path)
+                return path
+            logger.warning('Discarding corrupt cache entry %s', path)
+            os.unlink(path)
+        with self._lock:
+            self.misses += 1
+        mirrorPath = self._mirrorPath(fileInfo)
+        if mirrorPath:
+            logger.info('Copying %s from mirror', fileInfo.get('name'))
+            path = self._store(key, fileInfo, lambda dest: shutil.copyfile(mirrorPath, dest))
+        elif self.offline:
+            raise DownloadCacheMiss('%s (%s) is not cached' % (fileInfo.get('name'), key))
+        else:
+            path = self._store(key, fileInfo, download)
+        self.evict(keep=path)
+        return path
+
+    def listing(self, name, fetch):
+        """
+        Get a json-serializable listing (such as the items and files in a
+        remote folder), caching it so it is available in offline mode.
+
+        :param name: a unique name for the listing, such as a resource path.
+        :param fetch: a function that returns the listing from the remote
+            server.
+        :returns: the listing.
+        """
+        path = os.path.join(
+            self.root, 'listings', hashlib.sha256(name.encode()).hexdigest() + '.json')
+        if self.offline:
+            if not os.path.exists(path):
+                raise DownloadCacheMiss('No cached listing of %s' % name)
+            with open(path) as fptr:
+                return json.load(fptr)
+        listing = fetch()
+        with open(path + '.partial', 'w') as fptr:
+            json.dump(listing, fptr)
+        os.replace(path + '.partial', path)
+        return listing
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used files until the cache is within its
+        maximum size.  Files fetched by this cache are never evicted.
+
+        :param keep: an optional additional path that is never evicted.
+        :returns: the number of files removed.
+        """
+        with self._lock:
+            keep = self._fetched | {keep}
+            return self._evict(keep)
+
+    def _evict(self, keep):
+        entries = []
+        for dirpath, _dirnames, filenames in os.walk(os.path.join(self.root, 'files')):
+            for filename in filenames:
+                if filename.endswith('.partial'):
+                    continue
+                stat = os.stat(os.path.join(dirpath, filename))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for _mtime, size, path in sorted(entries):
+            if total <= self.maxSize:
+                break
+            if path in keep:
+                continue
+            logger.info('Evicting %s from download cache', path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def summary(self):
+        return 'Download cache %s: %d hits, %d misses' % (self.root, self.hits, self.misses)
+
+
+def cached_remote_listing(cache, remote, folderPath):
+    """
+    List the items and files of a remote folder, using a cached listing in
+    offline mode.
+
+    :param cache: a DownloadCache or None.
+    :param remote: a girder client for the remote server.
+    :param folderPath: the resource path of the remote folder.
+    :returns: a list of item documents, each with a 'files' list of file
+        documents.
+    """
+    def fetch():
+        remoteFolder = remote.resourceLookup(folderPath)
+        items = list(remote.listItem(remoteFolder['_id']))
+        for item in items:
+            item['files'] = list(remote.listFile(item['_id']))
+        return items
+
+    if cache is None:
+        return fetch()
+    try:
+        return cache.listing(folderPath, fetch)
+    except DownloadCacheMiss:
+        if not cache.mirror or not os.path.isdir(cache.mirror):
+            raise
+    # Offline with no cached listing; treat each mirrored file as an item
+    items = []
+    for entry in sorted(os.scandir(cache.mirror), key=lambda entry: entry.name):
+        if entry.is_file():
+            fileInfo = {'_id': entry.name, 'name': entry.name, 'size': entry.stat().st_size}
+            items.append({'_id': entry.name, 'name': entry.name, 'files': [fileInfo]})
+    return items
@@ -0,0 +1,6 @@
+import os
+import sys
+
+dsaPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'devops', 'dsa')
+sys.path.insert(0, os.path.join(dsaPath, 'utils'))
+sys.path.insert(0, dsaPath)
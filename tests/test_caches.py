@@ -0,0 +1,58 @@
+import configparser
+import os
+import types
+
+import provision
+
+
+def test_cache_sizes():
+    gb = 1024 ** 3
+    sizes = provision.cache_sizes({'memory': 8 * gb, 'hostMemory': 64 * gb})
+    assert sizes['budget'] == gb
+    assert sizes['large_image'] == {
+        'cache_python_memory_portion': 64,
+        'cache_tilesource_memory_portion': 128,
+        'cache_tilesource_maximum': 64,
+    }
+    assert 'cache_server' not in sizes
+    sizes = provision.cache_sizes({'memory': 64 * gb, 'hostMemory': 64 * gb}, maxBytes=4 * gb)
+    assert sizes['budget'] == 4 * gb
+
+
+def test_cache_sizes_zero_budget():
+    sizes = provision.cache_sizes({'memory': 1, 'hostMemory': 1})
+    assert sizes['budget'] == 1
+    sizes = provision.cache_sizes({'memory': 8 * 1024 ** 3, 'hostMemory': 8 * 1024 ** 3}, 0)
+    assert sizes['budget'] == 1
+
+
+def test_cache_sizes_server():
+    gb = 1024 ** 3
+    limits = {'memory': 8 * gb, 'hostMemory': 64 * gb}
+    sizes = provision.cache_sizes(limits, serviceLimits={'memory': 5 * gb, 'hostMemory': 64 * gb})
+    assert sizes['cache_server'] == 4 * gb
+    sizes = provision.cache_sizes(limits, serviceLimits={'memory': 64 * gb, 'hostMemory': 64 * gb})
+    assert sizes['cache_server'] == 8 * gb
+    sizes = provision.cache_sizes(
+        limits, maxBytes=2 * gb, serviceLimits={'memory': 64 * gb, 'hostMemory': 64 * gb})
+    assert sizes['cache_server'] == 2 * gb
+    sizes = provision.cache_sizes(
+        limits, serviceLimits={'memory': 1024 ** 2, 'hostMemory': 64 * gb})
+    assert sizes['cache_server'] == 64 * 1024 ** 2
+
+
+def test_cache_server_hosts():
+    assert provision.cache_server_hosts('memcached', 11211) == [('memcached', 11211)]
+    assert provision.cache_server_hosts('a:1, b', 11211) == [('a', 1), ('b', 11211)]
+    assert provision.cache_server_hosts('redis://user@redis:6380/0', 6379) == [('redis', 6380)]
+
+
+def test_size_caches_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    os.makedirs(tmp_path / '.girder')
+    (tmp_path / '.girder' / 'girder.cfg').write_text(
+        '[large_image]\ncache_python_memory_portion = 8\ncache_backend = "memcached"\n')
+    provision.size_caches(types.SimpleNamespace(**{'cache-sizing': False}))
+    conf = configparser.ConfigParser()
+    conf.read([str(tmp_path / '.girder' / 'girder.cfg')])
+    assert dict(conf.items('large_image')) == {'cache_backend': '"memcached"'}
@@ -0,0 +1,24 @@
+import os
+
+import provision
+
+
+def test_wait_for_stale_build(tmp_path, monkeypatch):
+    pidfile = tmp_path / 'girder_build.pid'
+    # This process is running but isn't a girder build
+    pidfile.write_text(str(os.getpid()))
+    spans = []
+    monkeypatch.setattr(provision.timer, 'add_span', lambda *args: spans.append(args))
+    provision.wait_for_background_build(str(pidfile), str(tmp_path / 'girder_build_done'))
+    assert spans == []
+    assert not provision.is_build_process(os.getpid())
+
+
+def test_wait_for_finished_build(tmp_path, monkeypatch):
+    pidfile = tmp_path / 'girder_build.pid'
+    pidfile.write_text('999999999')
+    (tmp_path / 'girder_build_done').write_text('')
+    spans = []
+    monkeypatch.setattr(provision.timer, 'add_span', lambda *args: spans.append(args))
+    provision.wait_for_background_build(str(pidfile), str(tmp_path / 'girder_build_done'))
+    assert [span[0] for span in spans] == ['preprovision:build']
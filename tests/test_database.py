@@ -0,0 +1,24 @@
+import provision
+
+
+def test_tuned_database_uri():
+    uri = provision.tuned_database_uri(
+        'mongodb://mongodb:27017/girder?socketTimeoutMS=1000', {
+            'processes': 4,
+            'compressors': ['zstd', 'zlib'],
+            'readPreference': 'nearest',
+            'options': {'retryWrites': True},
+        }, 1000)
+    assert uri.startswith('mongodb://mongodb:27017/girder?')
+    query = dict(part.split('=', 1) for part in uri.split('?', 1)[1].split('&'))
+    assert query == {
+        'socketTimeoutMS': '1000',
+        'maxPoolSize': '200',
+        'minPoolSize': '2',
+        'compressors': 'zstd,zlib',
+        'readPreference': 'nearest',
+        'retryWrites': 'true',
+    }
+    uri = provision.tuned_database_uri('mongodb://mongodb:27017/girder', {
+        'processes': 100, 'compressors': []}, 100)
+    assert uri == 'mongodb://mongodb:27017/girder?maxPoolSize=10&minPoolSize=2'
@@ -0,0 +1,55 @@
+import os
+import types
+
+import download_cache
+import provision
+from download_cache import DownloadCache
+
+
+def fileInfo(name, size):
+    return {'_id': name, 'name': name, 'size': size}
+
+
+def writer(size):
+    def download(path):
+        with open(path, 'wb') as fptr:
+            fptr.write(b'x' * size)
+    return download
+
+
+def test_evict_keeps_fetched_files(tmp_path):
+    cache = DownloadCache(str(tmp_path / 'cache'), maxSize=150)
+    first = cache.fetch(fileInfo('a', 100), writer(100))
+    second = cache.fetch(fileInfo('b', 100), writer(100))
+    # Both files are in use by this cache, so neither is evicted even though
+    # the cache is over its maximum size.
+    assert os.path.exists(first)
+    assert os.path.exists(second)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    other = DownloadCache(str(tmp_path / 'cache'), maxSize=150)
+    third = other.fetch(fileInfo('c', 100), writer(100))
+    assert os.path.exists(third)
+    assert not os.path.exists(first) or not os.path.exists(second)
+
+
+def test_mirror(tmp_path):
+    mirror = tmp_path / 'mirror'
+    mirror.mkdir()
+    (mirror / 'a').write_bytes(b'y' * 10)
+    cache = DownloadCache(str(tmp_path / 'cache'), offline=True, mirror=str(mirror))
+    path = cache.fetch(fileInfo('a', 10), None)
+    with open(path, 'rb') as fptr:
+        assert fptr.read() == b'y' * 10
+    assert cache.fetch(fileInfo('a', 10), None) == path
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_get_download_cache_mirror_only(tmp_path, monkeypatch):
+    monkeypatch.delenv('DSA_DOWNLOAD_CACHE', raising=False)
+    monkeypatch.setattr(download_cache, 'DEFAULT_CACHE_DIR', str(tmp_path / 'cache'))
+    opts = types.SimpleNamespace(**{'download-mirror': str(tmp_path)})
+    cache = provision.get_download_cache(opts)
+    assert cache is not None
+    assert cache.mirror == str(tmp_path)
+    assert provision.get_download_cache(types.SimpleNamespace()) is None
@@ -0,0 +1,15 @@
+import provision
+
+
+def test_import_manifest_key():
+    params = {'fileIncludeRegex': r'\.svs$', 'fileExcludeRegex': None}
+    key = provision.import_manifest_key('a1', '/data', 'folder', 'f1', params)
+    assert key.startswith('a1:')
+    assert key.endswith(':/data:')
+    assert key == provision.import_manifest_key('a1', '/data', 'folder', 'f1', dict(params))
+    assert key != provision.import_manifest_key('a1', '/data', 'folder', 'f2', params)
+    assert key != provision.import_manifest_key('a1', '/data', 'collection', 'f1', params)
+    assert key != provision.import_manifest_key(
+        'a1', '/data', 'folder', 'f1', dict(params, fileIncludeRegex=r'\.tif$'))
+    assert key != provision.import_manifest_key(
+        'a1', '/data', 'folder', 'f1', dict(params, fileExcludeRegex='tmp'))
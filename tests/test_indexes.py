@@ -0,0 +1,17 @@
+import pytest
+
+import provision
+
+
+@pytest.mark.parametrize(('entry', 'keys', 'options'), [
+    ('name', [('name', 1)], {}),
+    (['folderId', 'name'], [('folderId', 1), ('name', 1)], {}),
+    (['created', -1], [('created', -1)], {}),
+    (['body', 'text'], [('body', 'text')], {}),
+    ([['folderId', 1], ['meta.stain', -1]], [('folderId', 1), ('meta.stain', -1)], {}),
+    ({'keys': ['created', -1], 'name': 'recent'}, [('created', -1)], {'name': 'recent'}),
+    ({'keys': {'itemId': 1, '_active': 1}, 'sparse': True},
+     [('itemId', 1), ('_active', 1)], {'sparse': True}),
+])
+def test_index_spec(entry, keys, options):
+    assert provision.index_spec(entry) == (keys, options)
@@ -0,0 +1,27 @@
+import provision
+
+
+def test_requirement_satisfied():
+    assert provision.requirement_satisfied('pytest')
+    assert provision.requirement_satisfied('pytest>=1 pyyaml')
+    assert provision.requirement_satisfied(
+        'pytest \'no-such-distribution-for-dsa; python_version < "3"\'')
+    assert not provision.requirement_satisfied('pytest<1')
+    assert not provision.requirement_satisfied('pytest pyyaml<1')
+    assert not provision.requirement_satisfied('no-such-distribution-for-dsa')
+    assert not provision.requirement_satisfied('pytest @ https://example.com/pytest.whl')
+    assert not provision.requirement_satisfied('-e .')
+
+
+def test_vcs_requirement():
+    url = 'git+https://github.com/DigitalSlideArchive/HistomicsUI@master#egg=histomicsui'
+    assert provision.vcs_requirement(url) == url
+    assert provision.vcs_requirement('histomicsui @ ' + url) == url
+    assert provision.vcs_requirement('histomicsui>=1') is None
+    assert provision.vcs_commit('git+https://example.com/repo@' + 'a' * 40) == 'a' * 40
+
+
+def test_wheel_installed(tmp_path):
+    assert not provision.wheel_installed(str(tmp_path / 'pytest-1.0-py3-none-any.whl'))
+    assert not provision.wheel_installed(
+        str(tmp_path / 'no_such_distribution-1.0-py3-none-any.whl'))
@@ -0,0 +1,105 @@
+import datetime
+
+import provision
+
+
+def test_plan_resources():
+    resources = [
+        {'model': 'collection', 'name': 'Tasks'},
+        {'model': 'folder', 'parent': 'resource:collection/Tasks', 'name': 'Slicer'},
+        {'model': 'item', 'folder': 'resource:collection/Tasks/Slicer', 'name': 'Task'},
+        {'model': 'collection', 'name': 'Other', 'creator': 'resource:admin'},
+        {'model': 'collection', 'name': 'tasks', 'public': True},
+    ]
+    assert provision.plan_resources(resources) == [[0, 3], [1, 4], [2]]
+    assert provision.plan_resources([]) == []
+
+
+def test_plan_resources_admin():
+    adminUser = {'_id': 'id', 'login': 'Admin'}
+    resources = [
+        {'model': 'collection', 'name': 'Tasks'},
+        {'model': 'folder', 'parent': 'resource:admin', 'parentType': 'user', 'name': 'Data'},
+        {'model': 'folder', 'parent': 'resource:collection/Tasks', 'name': 'Slicer'},
+        {'model': 'item', 'folder': 'resource:user/admin/Data', 'name': 'Notes'},
+    ]
+    assert provision.plan_resources(resources, adminUser) == [[0, 1], [2, 3]]
+    assert provision.resource_entry_path(resources[1], adminUser) == 'user/admin/data'
+
+
+def test_plan_resources_unknown_paths():
+    resources = [
+        {'model': 'collection', 'name': 'Tasks'},
+        {'model': 'collection', 'name': 'Other'},
+        {'model': 'folder', 'parent': 'resourceid:collection/Tasks', 'name': 'Data'},
+        {'model': 'folder', 'parent': {'_id': 'abc'}, 'name': 'Elsewhere'},
+        {'model': 'collection', 'name': 'Last'},
+    ]
+    # Without an admin user, references to admin have no known path either
+    resources.append({'model': 'folder', 'parent': 'resource:admin', 'name': 'Data'})
+    assert provision.plan_resources(resources) == [[0, 1], [2], [3], [4], [5]]
+
+
+def test_manifest_records(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('{"model": "item", "name": "a"}\n\n{"model": "item", "name": "b"}\n')
+    assert [entry['name'] for entry in provision.manifest_records(str(path))] == ['a', 'b']
+
+    path = tmp_path / 'manifest.csv'
+    path.write_text('model,name,metadata.caseId,metadata.stain\nitem,a,1,\nitem,b,2,HE\n')
+    assert list(provision.manifest_records(str(path))) == [
+        {'model': 'item', 'name': 'a', 'metadata': {'caseId': '1'}},
+        {'model': 'item', 'name': 'b', 'metadata': {'caseId': '2', 'stain': 'HE'}},
+    ]
+
+    path = tmp_path / 'manifest.txt'
+    path.write_text('- name: a\n- name: b\n---\nname: c\n')
+    assert [entry['name'] for entry in provision.manifest_records(str(path), 'yaml')] == [
+        'a', 'b', 'c']
+
+
+def test_load_manifest(tmp_path, monkeypatch):
+    batches = []
+
+    def load_manifest_batch(batch, adminUser, stats):
+        batches.append(batch)
+        stats['created'] += len(batch) - 1
+        stats['failed'] += 1
+
+    monkeypatch.setattr(provision, 'load_manifest_batch', load_manifest_batch)
+    path = tmp_path / 'manifest.csv'
+    path.write_text('name,model\n' + ''.join('item%d,\n' % idx for idx in range(4)) +
+                    'folder,folder\n')
+    stats = provision.load_manifest({
+        'path': str(path), 'batch-size': 2,
+        'defaults': {'model': 'item', 'folder': 'resource:collection/Data'},
+    }, None)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0] == {
+        'model': 'item', 'folder': 'resource:collection/Data', 'name': 'item0'}
+    assert batches[2][0]['model'] == 'folder'
+    assert stats == {'records': 5, 'created': 2, 'updated': 0, 'unchanged': 0, 'failed': 3}
+
+    batches[:] = []
+    path.write_text('')
+    assert provision.load_manifest({'path': str(path)}, None)['records'] == 0
+    assert batches == []
+
+
+def test_resource_update():
+    changes = {
+        'metadata': {'caseId': 3, 'stain': None},
+        'metadata_key': 'meta',
+        'attrs': {'description': 'not written'},
+    }
+    assert provision.resource_update(changes) == {
+        '$set': {'meta.caseId': 3},
+        '$unset': {'meta.stain': ''},
+    }
+    now = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    assert provision.resource_update(changes, now) == {
+        '$set': {'meta.caseId': 3, 'updated': now},
+        '$unset': {'meta.stain': ''},
+    }
+    assert provision.resource_update({}) == {}
+    assert provision.resource_update({}, now) == {}
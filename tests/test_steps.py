@@ -0,0 +1,49 @@
+import threading
+import types
+
+import provision
+
+
+def test_run_steps_concurrently():
+    started = threading.Barrier(2, timeout=5)
+    order = []
+
+    def step(name, wait=False):
+        def func():
+            if wait:
+                # Both independent steps must be running at once to pass
+                started.wait()
+            order.append(name)
+        return func
+
+    provision.run_steps([
+        ('last', ['a', 'b'], step('last')),
+        ('a', [], step('a', True)),
+        ('b', ['unknown'], step('b', True)),
+    ])
+    assert sorted(order[:2]) == ['a', 'b']
+    assert order[2] == 'last'
+
+
+def test_provision_steps():
+    opts = types.SimpleNamespace(**{
+        'samples': True,
+        'resources': [{'model': 'collection', 'name': 'Tasks'}],
+        'settings': {},
+        'manifests': [{'path': 'manifest.csv'}],
+        'imports': [{'path': '/mnt/slides'}],
+        'slicer-cli-image': ['dsarchive/histomicstk:latest'],
+    })
+    steps = {name: deps for name, deps, _func in provision.provision_steps(opts, None)}
+    assert steps['provision_resources'] == []
+    assert 'get_sample_data' not in steps['get_slicer_images']
+    assert 'manifests' not in steps['get_slicer_images']
+    assert 'provision_resources' in steps['imports']
+
+    opts.resources.append({'model': 'folder', 'parent': 'resource:collection/Samples',
+                           'name': 'Extra'})
+    steps = {name: deps for name, deps, _func in provision.provision_steps(opts, None)}
+    assert steps['provision_resources'] == ['get_sample_data']
+
+    steps = [name for name, _deps, _func in provision.provision_steps(opts, None, True)]
+    assert steps == ['imports', 'get_slicer_images']
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip('girder')
+pytest.importorskip('pytest_girder')
+
+import provision  # noqa: E402
+
+
+def userEntry(login, **kwargs):
+    entry = {'login': login, 'email': '%s@example.com' % login, 'firstName': 'First',
+             'lastName': 'Last', 'password': 'password'}
+    entry.update(kwargs)
+    return entry
+
+
+def test_bulk_create_users(db):
+    from girder import events
+    from girder.models.folder import Folder
+    from girder.models.user import User
+
+    provision.resource_path_cache.get('user/user1', lambda resPath: {'_id': 'stale'})
+    validated = []
+    with events.bound('model.user.validate', 'test', lambda event: validated.append(
+            event.info['login'])), events.bound('model.user.save', 'test', lambda event: (
+            event.preventDefault() if event.info['login'] == 'user3' else None)):
+        created, skipped = provision.bulk_create_users(
+            [userEntry('user%d' % idx) for idx in range(4)], batchSize=3)
+    assert (created, skipped) == (3, 1)
+    assert validated == ['user0', 'user1', 'user2', 'user3']
+    user = User().findOne({'login': 'user1'})
+    assert User().authenticate('user1', 'password')['_id'] == user['_id']
+    assert User().findOne({'login': 'user3'}) is None
+    assert {folder['name'] for folder in Folder().childFolders(user, 'user', user=user)} == {
+        'Public', 'Private'}
+    assert provision.resource_path_cache.get(
+        'user/user1', provision.resolve_resource_path)['_id'] == user['_id']
+
+
+def test_bulk_create_users_invalid(db):
+    from girder.models.user import User
+
+    with pytest.raises(TypeError):
+        provision.bulk_create_users([userEntry('user0', groups=['a'])])
+    with pytest.raises(TypeError):
+        provision.bulk_create_users([{'login': 'user0', 'email': 'user0@example.com'}])
+    assert provision.bulk_create_users([
+        userEntry('user0', groups=['a']), userEntry('user1', attrs={'department': 'a'}),
+    ], strict=False) == (1, 1)
+    assert User().findOne({'login': 'user0'}) is None
+    assert User().findOne({'login': 'user1'})['department'] == 'a'
@@ -0,0 +1,22 @@
+import provision
+
+
+def test_job_memory_monitor_single_instance(tmp_path, monkeypatch):
+    monkeypatch.setattr(provision.JobMemoryMonitor, 'lockPath', str(tmp_path / 'monitor.lock'))
+    started = []
+    monkeypatch.setattr(provision.subprocess, 'Popen', lambda cmd, **kwargs: started.append(cmd))
+    settings = {
+        'concurrency': 'auto',
+        'concurrency-file': str(tmp_path / 'concurrency'),
+        'job-memory-history': str(tmp_path / 'history'),
+    }
+    provision.tune_worker_concurrency(settings)
+    assert len(started) == 1
+    assert (tmp_path / 'concurrency').read_text().startswith('--concurrency=')
+
+    with provision.exclusive_lock(provision.JobMemoryMonitor.lockPath) as locked:
+        assert locked
+        provision.tune_worker_concurrency(settings)
+        assert len(started) == 1
+        # A second monitor exits without sampling
+        provision.JobMemoryMonitor(str(tmp_path / 'history')).run()